@@ -13,24 +13,43 @@ Functions:
         Returns X, Y, Z arrays of adjusted data coordinates. Angles are CCW about
         specified axes. Scaling is applied in rotated coordinate system.
     initialize_variogram_model(x, y, z, variogram_model, variogram_model_parameters,
-                               variogram_function, nlags):
-        Returns lags, semivariance, and variogram model parameters as a list.
+                               variogram_function, nlags, weight, min_theta, max_theta, lag_bins,
+                               max_lag, sample_pairs, random_state):
+        Returns lags, semivariance, semivariance error, and variogram model parameters.
     initialize_variogram_model_3d(x, y, z, values, variogram_model,
-                                  variogram_model_parameters, variogram_function, nlags):
-        Returns lags, semivariance, and variogram model parameters as a list.
+                                  variogram_model_parameters, variogram_function, nlags, weight, lag_bins,
+                                  max_lag, sample_pairs, random_state):
+        Returns lags, semivariance, semivariance error, and variogram model parameters.
+    directional_variograms(x, y, z, sectors, nlags, lag_bins, max_lag):
+        Returns the experimental variogram of each azimuth sector from one pass over the data pairs.
+    directional_variograms_3d(x, y, z, values, sectors, nlags, lag_bins, max_lag):
+        Returns the experimental variogram of each azimuth/dip sector from one pass over the data pairs.
+    variogram_map(x, y, z, lag_dx, lag_dy, nx, ny):
+        Returns the semivariance averaged over a grid of 2D lag vectors.
     variogram_function_error(params, x, y, variogram_function):
         Called by calculate_variogram_model.
-    calculate_variogram_model(lags, semivariance, variogram_model, variogram_function):
+    calculate_variogram_model(lags, semivariance, variogram_model, variogram_function, weight,
+                              semivariance_error):
         Returns variogram model parameters that minimize the RMSE between the specified
         variogram function and the actual calculated variogram points.
+    select_variogram_model(x, y, z, variogram_model_list, nlags, weight, min_theta, max_theta,
+                           lag_bins, max_lag, sample_pairs, random_state, enable_statistics):
+        Fits each of the built-in variogram models to the same experimental variogram.
+        Returns a list of the fits ranked from best to worst.
     krige(x, y, z, coords, variogram_function, variogram_model_parameters):
         Function that solves the ordinary kriging system for a single specified point.
         Returns the Z value and sigma squared for the specified coordinates.
     krige_3d(x, y, z, vals, coords, variogram_function, variogram_model_parameters):
         Function that solves the ordinary kriging system for a single specified point.
         Returns the interpolated value and sigma squared for the specified coordinates.
+    SearchNeighborhood(radius, min_points, max_points, max_per_sector):
+        Search neighborhood of kriging with a moving window. Its query method returns
+        the selected data points of every target point as ragged (CSR) index arrays.
     find_statistics(x, y, z, variogram_funtion, variogram_model_parameters):
         Returns the delta, sigma, and epsilon values for the variogram fit.
+    leave_one_out(factor, values):
+        Returns the leave-one-out cross-validation residuals and kriging variances
+        of the data points from the LU factorization of the kriging matrix.
     calcQ1(epsilon):
         Returns the Q1 statistic for the variogram fit (see Kitanidis).
     calcQ2(epsilon):
@@ -41,12 +60,18 @@ Functions:
 References:
     P.K. Kitanidis, Introduction to Geostatistcs: Applications in Hydrogeology,
     (Cambridge University Press, 1997) 272 p.
+    O. Dubrule, Cross validation of kriging in a unique neighborhood,
+    Mathematical Geology 15 (1983) 687-699.
 
 Copyright (c) 2015 Benjamin S. Murphy
 """
 
+import os
+import itertools
 import numpy as np
+import scipy.linalg
 from scipy.optimize import minimize
+import variogram_models
 
 
 def adjust_for_anisotropy(x, y, xcenter, ycenter, scaling, angle):
@@ -111,38 +136,401 @@ def adjust_for_anisotropy_3d(x, y, z, xcenter, ycenter, zcenter, scaling_y,
     return x, y, z
 
 
-def initialize_variogram_model(x, y, z, variogram_model, variogram_model_parameters,
-                               variogram_function, nlags, weight, min_theta=None, max_theta=None):
-    """Initializes the variogram model for kriging according
-    to user specifications or to defaults"""
+def _close_pairs(coords, max_lag):
+    """Returns the index pairs (i, j), i < j, of the data points that are
+    at most max_lag apart. The pairs are found with a KD-tree, so pairs
+    separated by more than max_lag are never visited."""
+
+    from scipy.spatial import cKDTree
+    tree = cKDTree(coords)
+    return tree.query_pairs(max_lag, output_type='ndarray')
+
+
+def _lag_pairs(coords, values, min_theta=None, max_theta=None, pairs=None, max_pairs=2**22):
+    """Generator over the distinct data pairs (i, j), j < i, walked in blocks of
+    rows so that no more than about max_pairs pairs are held in memory at once.
+    If pairs (an array of index pairs, see _close_pairs) is given, only those
+    pairs are walked. Yields the separation distances and the semivariances
+    (half squared value differences) of each block, restricted to the azimuth
+    sector between min_theta and max_theta (degrees) if one is specified."""
+
+    for delta, g in _pair_blocks(coords, values, pairs, max_pairs):
+        d = np.sqrt(np.sum(delta**2, axis=1))
+
+        if min_theta != None and max_theta != None and max_theta > min_theta:
+            az, az2 = _azimuths(delta)
+            mask = _in_sector(az, az2, min_theta, max_theta)
+            d = d[mask]
+            g = g[mask]
+
+        yield d, g
+
+
+def _azimuths(delta):
+    """Returns the azimuths (degrees CCW from the x axis) of the pair separation
+    vectors delta and of the opposite vectors -delta."""
+
+    az = np.arctan2(delta[:, 1], delta[:, 0])
+    az2 = az + np.pi
+    az2 = np.choose(az2 > np.pi, (az2, az2 - 2 * np.pi))
+    az = 180.0 * az / np.pi
+    az2 = 180.0 * az2 / np.pi
+    return az, az2
+
+
+def _in_sector(az, az2, min_theta, max_theta):
+    """Returns a mask of the pairs whose azimuth, in either direction,
+    lies between min_theta and max_theta."""
+
+    return np.logical_or(np.logical_and(az > min_theta, az < max_theta),
+                         np.logical_and(az2 > min_theta, az2 < max_theta))
+
+
+def _pair_blocks(coords, values, pairs=None, max_pairs=2**22):
+    """Generator over blocks of data pairs for _lag_pairs. Yields the coordinate
+    differences and the semivariances of the pairs in each block."""
+
+    if pairs is None:
+        n = values.shape[0]
+        rows = max(1, max_pairs // max(n, 1))
+        for start in range(1, n, rows):
+            stop = min(start + rows, n)
+            lower = np.arange(stop)[np.newaxis, :] < np.arange(start, stop)[:, np.newaxis]
+            delta = (coords[np.newaxis, :stop, :] - coords[start:stop, np.newaxis, :])[lower]
+            g = 0.5 * (values[np.newaxis, :stop] - values[start:stop, np.newaxis])[lower]**2
+            yield delta, g
+    else:
+        for start in range(0, pairs.shape[0], max_pairs):
+            i = pairs[start:start + max_pairs, 0]
+            j = pairs[start:start + max_pairs, 1]
+            yield coords[i] - coords[j], 0.5 * (values[i] - values[j])**2
+
+
+def _lag_range(coords, values, min_theta=None, max_theta=None, pairs=None):
+    """Returns the smallest, the smallest nonzero, and the largest
+    separation distance of the data pairs."""
+
+    dmin = np.inf
+    dmin_nonzero = np.inf
+    dmax = -np.inf
+    for d, g in _lag_pairs(coords, values, min_theta, max_theta, pairs):
+        if d.size > 0:
+            dmin = min(dmin, np.amin(d))
+            dmax = max(dmax, np.amax(d))
+            if np.any(d > 0.0):
+                dmin_nonzero = min(dmin_nonzero, np.amin(d[d > 0.0]))
+    if dmax < dmin:
+        raise ValueError("No data pairs available to calculate the semivariogram.")
+
+    return dmin, dmin_nonzero, dmax
+
+
+def _lag_bins(lag_bins, nlags, coords, values, min_theta=None, max_theta=None, pairs=None):
+    """Returns the lag bin edges requested by lag_bins: 'linear' for nlags
+    equal-width bins, 'geometric' for nlags bins whose widths grow by a constant
+    factor, or explicitly specified bin edges."""
+
+    if isinstance(lag_bins, basestring):
+        if lag_bins not in ['linear', 'geometric']:
+            raise ValueError("Lag bins must be 'linear', 'geometric', or an array of bin edges.")
+        dmin, dmin_nonzero, dmax = _lag_range(coords, values, min_theta, max_theta, pairs)
+        if lag_bins == 'linear':
+            bins = np.linspace(dmin, dmax, nlags + 1)
+        elif dmin > 0.0:
+            bins = np.logspace(np.log10(dmin), np.log10(dmax), nlags + 1)
+        else:
+            # Zero separation distances (co-located data) get a bin of their own.
+            bins = np.concatenate(([dmin], np.logspace(np.log10(min(dmin_nonzero, dmax)), np.log10(dmax), nlags)))
+    else:
+        bins = np.atleast_1d(np.asarray(lag_bins, dtype=float))
+        if bins.ndim != 1 or bins.size < 2 or np.any(np.diff(bins) < 0.0):
+            raise ValueError("Lag bin edges must be a one-dimensional increasing sequence.")
+
+    return bins
+
 
-    x1, x2 = np.meshgrid(x, x)
-    y1, y2 = np.meshgrid(y, y)
-    z1, z2 = np.meshgrid(z, z)
-
-    dx = x1 - x2
-    dy = y1 - y2
-    dz = z1 - z2
-    d = np.sqrt(dx**2 + dy**2)
-    g = 0.5 * dz**2
-
-    indices = np.indices(d.shape)
-    d = d[(indices[0, :, :] > indices[1, :, :])]
-    g = g[(indices[0, :, :] > indices[1, :, :])]
-
-    if min_theta != None and max_theta != None and max_theta > min_theta:
-        dx = dx[(indices[0, :, :] > indices[1, :, :])]
-        dy = dy[(indices[0, :, :] > indices[1, :, :])]
-        
-        az = np.arctan2(dy,dx)
-        az2 = az + np.pi
-        az2 = np.choose(az2 > np.pi, (az2, az2 - 2* np.pi))
-        az = 180.0 * az / np.pi
-        az2 = 180.0 * az2 / np.pi
-        mask = np.logical_or(np.logical_and(az > min_theta, az < max_theta), np.logical_and(az2 > min_theta, az2 < max_theta))
-        d = d[mask]
-        g = g[mask]
-        
+def _lag_bin_index(bins, d, closed=True):
+    """Returns the lag bin of each distance in d, bin n holding the distances with
+    bins[n] <= d < bins[n + 1] and, if closed, the last bin also holding
+    d = bins[-1]. Distances outside of the bins get -1 or bins.size - 1."""
+
+    index = np.searchsorted(bins, d, side='right') - 1
+    if closed:
+        index[d == bins[-1]] = bins.size - 2
+    return index
+
+
+def _bin_lag_pairs(coords, values, bins, min_theta=None, max_theta=None, pairs=None, closed=True):
+    """Accumulates the data pairs into the lag bins in a single pass, bin n
+    holding the pairs with bins[n] <= d < bins[n + 1] (if closed, the last bin
+    also holds the pairs at d = bins[-1]). Returns the experimental lags,
+    semivariance, and semivariance error; empty bins are dropped."""
+
+    bins = np.asarray(bins, dtype=float)
+    nlags = bins.size - 1
+    n_points = np.zeros(nlags)
+    d_sum = np.zeros(nlags)
+    g_sum = np.zeros(nlags)
+
+    for d, g in _lag_pairs(coords, values, min_theta, max_theta, pairs):
+        index = _lag_bin_index(bins, d, closed)
+        in_bins = (index >= 0) & (index < nlags)
+        index = index[in_bins]
+        n_points += np.bincount(index, minlength=nlags)
+        d_sum += np.bincount(index, weights=d[in_bins], minlength=nlags)
+        g_sum += np.bincount(index, weights=g[in_bins], minlength=nlags)
+
+    # Empty bins are dropped so that numpy doesn't complain about
+    # taking the mean of an empty bin.
+    filled = n_points > 0
+    n_points = n_points[filled]
+    lags = d_sum[filled] / n_points
+    semivariance = g_sum[filled] / n_points
+    semivariance_error = semivariance / np.sqrt(n_points)
+
+    return lags, semivariance, semivariance_error
+
+
+def _sector_masks(delta, sectors):
+    """Returns, for each azimuth sector (min_theta, max_theta), the mask of the pairs
+    in delta that lie in it. The azimuths are computed once for all of the sectors.
+    A sector of None is omnidirectional and gets a mask of None."""
+
+    az, az2 = _azimuths(delta)
+    return [None if sector is None else _in_sector(az, az2, sector[0], sector[1])
+            for sector in sectors]
+
+
+def _sector_masks_3d(delta, sectors):
+    """Returns, for each sector (min_azimuth, max_azimuth, min_dip, max_dip), the mask
+    of the pairs in delta that lie in it, in either direction. Azimuth is measured
+    in degrees CCW from the x axis in the x-y plane and dip in degrees up from
+    the x-y plane. Vertical pairs match any azimuth. A sector of None is
+    omnidirectional and gets a mask of None."""
+
+    az, az2 = _azimuths(delta)
+    h = np.sqrt(delta[:, 0]**2 + delta[:, 1]**2)
+    dip = 180.0 * np.arctan2(delta[:, 2], h) / np.pi
+    vertical = h == 0.0
+    masks = []
+    for sector in sectors:
+        if sector is None:
+            masks.append(None)
+            continue
+        min_az, max_az, min_dip, max_dip = sector
+        up = np.logical_or(np.logical_and(az > min_az, az < max_az), vertical)
+        down = np.logical_or(np.logical_and(az2 > min_az, az2 < max_az), vertical)
+        masks.append(np.logical_or(up & (dip >= min_dip) & (dip <= max_dip),
+                                   down & (-dip >= min_dip) & (-dip <= max_dip)))
+    return masks
+
+
+def _bin_sector_lag_pairs(coords, values, bins, sectors, sector_masks, pairs=None):
+    """Accumulates the data pairs into the lag bins of every sector in a single pass
+    over the pairs; sector_masks(delta, sectors) gives the pairs in each sector.
+    Returns a list of (lags, semivariance, semivariance error), one per sector,
+    as _bin_lag_pairs does for a single sector."""
+
+    bins = np.asarray(bins, dtype=float)
+    nlags = bins.size - 1
+    n_points = np.zeros((len(sectors), nlags))
+    d_sum = np.zeros((len(sectors), nlags))
+    g_sum = np.zeros((len(sectors), nlags))
+
+    for delta, g in _pair_blocks(coords, values, pairs):
+        d = np.sqrt(np.sum(delta**2, axis=1))
+        index = _lag_bin_index(bins, d)
+        in_bins = (index >= 0) & (index < nlags)
+        index, d, g, delta = index[in_bins], d[in_bins], g[in_bins], delta[in_bins]
+        for k, mask in enumerate(sector_masks(delta, sectors)):
+            if mask is None:
+                mask = slice(None)
+            n_points[k] += np.bincount(index[mask], minlength=nlags)
+            d_sum[k] += np.bincount(index[mask], weights=d[mask], minlength=nlags)
+            g_sum[k] += np.bincount(index[mask], weights=g[mask], minlength=nlags)
+
+    variograms = []
+    for k in range(len(sectors)):
+        filled = n_points[k] > 0
+        semivariance = g_sum[k][filled] / n_points[k][filled]
+        variograms.append((d_sum[k][filled] / n_points[k][filled], semivariance,
+                           semivariance / np.sqrt(n_points[k][filled])))
+
+    return variograms
+
+
+def directional_variograms(x, y, z, sectors, nlags=6, lag_bins='linear', max_lag=None):
+    """Calculates the experimental variogram in several azimuth sectors with a single
+    pass over the data pairs, e.g. to look for anisotropy. Each sector is given
+    as (min_theta, max_theta) in degrees CCW from the x axis, as for
+    initialize_variogram_model; a sector of None gives the omnidirectional
+    variogram. All of the sectors share the same lag bins, which are given by
+    lag_bins and nlags as for initialize_variogram_model. Returns a list of
+    (lags, semivariance, semivariance error), one per sector."""
+
+    coords = np.column_stack((x, y))
+    pairs = None
+    if max_lag is not None:
+        pairs = _close_pairs(coords, max_lag)
+    bins = _lag_bins(lag_bins, nlags, coords, z, pairs=pairs)
+
+    return _bin_sector_lag_pairs(coords, z, bins, sectors, _sector_masks, pairs)
+
+
+def directional_variograms_3d(x, y, z, values, sectors, nlags=6, lag_bins='linear', max_lag=None):
+    """Calculates the experimental variogram in several directions with a single pass
+    over the data pairs. Each sector is given as (min_azimuth, max_azimuth, min_dip,
+    max_dip) in degrees, the azimuth CCW from the x axis in the x-y plane (as
+    anisotropy_angle_z of adjust_for_anisotropy_3d) and the dip up from the x-y
+    plane; a sector of None gives the omnidirectional variogram. All of the sectors
+    share the same lag bins. Returns a list of (lags, semivariance, semivariance
+    error), one per sector."""
+
+    coords = np.column_stack((x, y, z))
+    pairs = None
+    if max_lag is not None:
+        pairs = _close_pairs(coords, max_lag)
+    bins = _lag_bins(lag_bins, nlags, coords, values, pairs=pairs)
+
+    return _bin_sector_lag_pairs(coords, values, bins, sectors, _sector_masks_3d, pairs)
+
+
+def variogram_map(x, y, z, lag_dx, lag_dy, nx, ny):
+    """Calculates the variogram map: the semivariance averaged over the cells of a grid
+    of lag vectors, the cells being lag_dx by lag_dy in size and centered on
+    (i*lag_dx, j*lag_dy) for i = -nx..nx and j = -ny..ny. Each pair contributes to
+    the cells of both of its separation vectors, so the map is centrally symmetric;
+    a pair whose two vectors share the center cell is counted there once.
+    Only the pairs that can fall in the grid are looked up (with a KD-tree).
+    Returns the lag grid coordinates gridx and gridy, the semivariance as a masked
+    array of shape (2*ny + 1, 2*nx + 1) with empty cells masked, and the number
+    of pairs in each cell."""
+
+    coords = np.column_stack((x, y))
+    nx = int(nx)
+    ny = int(ny)
+    gridx = lag_dx * np.arange(-nx, nx + 1)
+    gridy = lag_dy * np.arange(-ny, ny + 1)
+    shape = (2*ny + 1, 2*nx + 1)
+    n_points = np.zeros(shape[0]*shape[1])
+    g_sum = np.zeros(shape[0]*shape[1])
+
+    pairs = _close_pairs(coords, np.sqrt(((nx + 0.5)*lag_dx)**2 + ((ny + 0.5)*lag_dy)**2))
+    for delta, g in _pair_blocks(coords, z, pairs):
+        cells = []
+        for sign in [1.0, -1.0]:
+            i = np.floor(sign*delta[:, 0]/lag_dx + 0.5).astype(int) + nx
+            j = np.floor(sign*delta[:, 1]/lag_dy + 0.5).astype(int) + ny
+            in_grid = (i >= 0) & (i < shape[1]) & (j >= 0) & (j < shape[0])
+            cells.append(np.where(in_grid, j*shape[1] + i, -1))
+        # A pair whose two separation vectors fall in the same cell (the center
+        # cell, e.g. for coincident data points) is counted there only once.
+        cells[1][cells[1] == cells[0]] = -1
+        for index in cells:
+            in_grid = index >= 0
+            n_points += np.bincount(index[in_grid], minlength=n_points.size)
+            g_sum += np.bincount(index[in_grid], weights=g[in_grid], minlength=n_points.size)
+
+    n_points = n_points.reshape(shape)
+    semivariance = np.ma.masked_array(g_sum.reshape(shape) / np.maximum(n_points, 1.0),
+                                      mask=n_points == 0)
+
+    return gridx, gridy, semivariance, n_points.astype(int)
+
+
+def _random_state(random_state):
+    """Returns a numpy RandomState from a seed, an existing RandomState, or None."""
+
+    if isinstance(random_state, np.random.RandomState):
+        return random_state
+    return np.random.RandomState(random_state)
+
+
+def _random_pairs(coords, n_pairs, random_state, max_lag=None):
+    """Draws n_pairs index pairs (i, j), i != j, uniformly at random (with
+    replacement) from the data points. If max_lag is specified, the pairs
+    further apart than max_lag are discarded after the draw."""
+
+    n = coords.shape[0]
+    if n < 2:
+        return np.zeros((0, 2), dtype=int)
+    i = random_state.randint(0, n, n_pairs)
+    j = random_state.randint(0, n - 1, n_pairs)
+    j[j >= i] += 1
+    pairs = np.column_stack((i, j))
+    if max_lag is not None:
+        pairs = pairs[np.sum((coords[i] - coords[j])**2, axis=1) <= max_lag**2]
+    return pairs
+
+
+def _sample_lag_pairs(coords, values, bins, sample_pairs, random_state, min_theta=None,
+                      max_theta=None, max_lag=None, max_rounds=10, closed=True):
+    """Estimates the semivariance in the lag bins from a random sample of the data
+    pairs, stratified by lag bin. Pairs are drawn in rounds of sample_pairs and
+    each bin keeps the first sample_pairs/nlags pairs that fall into it, until
+    every bin is full or max_rounds rounds have been drawn. Returns the
+    experimental lags, semivariance, and the standard error of the semivariance
+    in each bin; empty bins are dropped."""
+
+    bins = np.asarray(bins, dtype=float)
+    nlags = bins.size - 1
+    quota = int(np.ceil(float(sample_pairs) / nlags))
+    n_points = np.zeros(nlags, dtype=int)
+    d_sum = np.zeros(nlags)
+    g_sum = np.zeros(nlags)
+    g_sq_sum = np.zeros(nlags)
+
+    for n in range(max_rounds):
+        pairs = _random_pairs(coords, sample_pairs, random_state, max_lag)
+        for d, g in _lag_pairs(coords, values, min_theta, max_theta, pairs):
+            index = _lag_bin_index(bins, d, closed)
+            in_bins = (index >= 0) & (index < nlags)
+            index, d, g = index[in_bins], d[in_bins], g[in_bins]
+
+            # Pairs are taken in the order they were drawn, up to the quota of each bin.
+            order = np.argsort(index, kind='mergesort')
+            index, d, g = index[order], d[order], g[order]
+            rank = np.arange(index.size) - np.searchsorted(index, index)
+            keep = rank < (quota - n_points)[index]
+            index, d, g = index[keep], d[keep], g[keep]
+
+            n_points += np.bincount(index, minlength=nlags)
+            d_sum += np.bincount(index, weights=d, minlength=nlags)
+            g_sum += np.bincount(index, weights=g, minlength=nlags)
+            g_sq_sum += np.bincount(index, weights=g**2, minlength=nlags)
+        if np.all(n_points >= quota):
+            break
+
+    filled = n_points > 0
+    n_points = n_points[filled].astype(float)
+    lags = d_sum[filled] / n_points
+    semivariance = g_sum[filled] / n_points
+    variance = (g_sq_sum[filled] - n_points * semivariance**2) / np.maximum(n_points - 1.0, 1.0)
+    semivariance_error = np.sqrt(np.clip(variance, 0.0, None) / n_points)
+    # A single pair gives no spread, so fall back on the estimate used by _bin_lag_pairs.
+    single = n_points < 2
+    semivariance_error[single] = semivariance[single]
+
+    return lags, semivariance, semivariance_error
+
+
+def _experimental_variogram(x, y, z, nlags, min_theta=None, max_theta=None, lag_bins=None, max_lag=None,
+                            sample_pairs=None, random_state=None):
+    """Returns the experimental lags, semivariance, and semivariance error of the
+    data (see initialize_variogram_model)."""
+
+    # The data pairs are streamed in blocks (see _lag_pairs), so the full
+    # N x N distance matrix is never built. If max_lag is specified, only the
+    # pairs within that distance are enumerated. If sample_pairs is specified,
+    # the semivariance is instead estimated from random pairs (see _sample_lag_pairs),
+    # and the lag range used for the bins comes from a first random draw.
+    coords = np.column_stack((x, y))
+    pairs = None
+    if sample_pairs is not None:
+        random_state = _random_state(random_state)
+        pairs = _random_pairs(coords, sample_pairs, random_state, max_lag)
+    elif max_lag is not None:
+        pairs = _close_pairs(coords, max_lag)
 
     # Equal-sized bins are now implemented. The upper limit on the bins
     # is appended to the list (instead of calculated as part of the
@@ -169,35 +557,39 @@ def initialize_variogram_model(x, y, z, variogram_model, variogram_model_paramet
     #
     # MEG - changed back to this method.  Find that the greater resolution
     # at smaller lags is definitely needed.  Might consider a logorithmic binning of lags
-    dmax = np.amax(d)
-    dmin = np.amin(d)
-    dd = dmax - dmin
-    bins = [dd*(0.5**n) + dmin for n in range(nlags, 1, -1)]
-    bins.insert(0, dmin)
-    bins.append(dmax)
-
-    lags = np.zeros(nlags)
-    semivariance = np.zeros(nlags)
-    semivariance_error = np.zeros(nlags)
-    n_points = np.zeros(nlags)
+    #
+    # The bins may also be requested as 'linear', 'geometric', or given explicitly
+    # through lag_bins (see _lag_bins). Those bins include the pairs at their upper
+    # edge; the default bins are all half-open, as they have always been.
+    if lag_bins is None:
+        dmin, dmin_nonzero, dmax = _lag_range(coords, z, min_theta, max_theta, pairs)
+        dd = dmax - dmin
+        bins = [dd*(0.5**n) + dmin for n in range(nlags, 1, -1)]
+        bins.insert(0, dmin)
+        bins.append(dmax)
+    else:
+        bins = _lag_bins(lag_bins, nlags, coords, z, min_theta, max_theta, pairs)
 
-    for n in range(nlags):
-        # This 'if... else...' statement ensures that there are data
-        # in the bin so that numpy can actually find the mean. If we
-        # don't test this first, then Python kicks out an annoying warning
-        # message when there is an empty bin and we try to calculate the mean.
-        n_points[n] = d[(d >= bins[n]) & (d < bins[n + 1])].size
-        if n_points[n] > 0:
-            lags[n] = np.mean(d[(d >= bins[n]) & (d < bins[n + 1])])
-            semivariance[n] = np.mean(g[(d >= bins[n]) & (d < bins[n + 1])])
-            semivariance_error[n] = semivariance[n] / np.sqrt(n_points[n])
-        else:
-            lags[n] = np.nan
-            semivariance[n] = np.nan
-            semivariance_error[n] = np.nan
+    if sample_pairs is not None:
+        lags, semivariance, semivariance_error = _sample_lag_pairs(coords, z, bins, sample_pairs, random_state,
+                                                                   min_theta, max_theta, max_lag,
+                                                                   closed=lag_bins is not None)
+    else:
+        lags, semivariance, semivariance_error = _bin_lag_pairs(coords, z, bins, min_theta, max_theta, pairs,
+                                                                closed=lag_bins is not None)
+
+    return lags, semivariance, semivariance_error
 
-    lags = lags[~np.isnan(semivariance)]
-    semivariance = semivariance[~np.isnan(semivariance)]
+
+def initialize_variogram_model(x, y, z, variogram_model, variogram_model_parameters,
+                               variogram_function, nlags, weight, min_theta=None, max_theta=None,
+                               lag_bins=None, max_lag=None, sample_pairs=None, random_state=None):
+    """Initializes the variogram model for kriging according
+    to user specifications or to defaults"""
+
+    lags, semivariance, semivariance_error = _experimental_variogram(x, y, z, nlags, min_theta, max_theta,
+                                                                     lag_bins, max_lag, sample_pairs,
+                                                                     random_state)
 
     if variogram_model_parameters is not None:
         if variogram_model == 'linear' and len(variogram_model_parameters) != 2:
@@ -219,54 +611,43 @@ def initialize_variogram_model(x, y, z, variogram_model, variogram_model_paramet
 
 
 def initialize_variogram_model_3d(x, y, z, values, variogram_model, variogram_model_parameters,
-                                  variogram_function, nlags, weight):
+                                  variogram_function, nlags, weight, lag_bins=None, max_lag=None,
+                                  sample_pairs=None, random_state=None):
     """Initializes the variogram model for kriging according
     to user specifications or to defaults"""
 
-    x1, x2 = np.meshgrid(x, x)
-    y1, y2 = np.meshgrid(y, y)
-    z1, z2 = np.meshgrid(z, z)
-    val1, val2 = np.meshgrid(values, values)
-    d = np.sqrt((x1 - x2)**2 + (y1 - y2)**2 + (z1 - z2)**2)
-    g = 0.5 * (val1 - val2)**2
-
-    indices = np.indices(d.shape)
-    d = d[(indices[0, :, :] > indices[1, :, :])]
-    g = g[(indices[0, :, :] > indices[1, :, :])]
+    coords = np.column_stack((x, y, z))
+    pairs = None
+    if sample_pairs is not None:
+        random_state = _random_state(random_state)
+        pairs = _random_pairs(coords, sample_pairs, random_state, max_lag)
+    elif max_lag is not None:
+        pairs = _close_pairs(coords, max_lag)
 
     # The upper limit on the bins is appended to the list (instead of calculated as part of the
     # list comprehension) to avoid any numerical oddities (specifically, say, ending up as
     # 0.99999999999999 instead of 1.0). Appending dmax + 0.001 ensures that the largest distance value
     # is included in the semivariogram calculation.
-    dmax = np.amax(d)
-    dmin = np.amin(d)
-    dd = (dmax - dmin)/nlags
-    bins = [dmin + n*dd for n in range(nlags)]
-    dmax += 0.001
-    bins.append(dmax)
-
-    lags = np.zeros(nlags)
-    semivariance = np.zeros(nlags)
-    semivariance_error = np.zeros(nlags)
-    n_points = np.zeros(nlags)
-
-    for n in range(nlags):
-        # This 'if... else...' statement ensures that there are data
-        # in the bin so that numpy can actually find the mean. If we
-        # don't test this first, then Python kicks out an annoying warning
-        # message when there is an empty bin and we try to calculate the mean.
-        n_points[n] = d[(d >= bins[n]) & (d < bins[n + 1])].size
-        if n_points[n] > 0:
-            lags[n] = np.mean(d[(d >= bins[n]) & (d < bins[n + 1])])
-            semivariance[n] = np.mean(g[(d >= bins[n]) & (d < bins[n + 1])])
-            semivariance_error[n] = semivariance[n] / np.sqrt(n_points[n])
-        else:
-            lags[n] = np.nan
-            semivariance[n] = np.nan
-            semivariance_error[n] = np.nan
+    #
+    # The bins may also be requested as 'linear', 'geometric', or given explicitly
+    # through lag_bins (see _lag_bins). Those bins include the pairs at their upper
+    # edge; the default bins are all half-open, as they have always been.
+    if lag_bins is None:
+        dmin, dmin_nonzero, dmax = _lag_range(coords, values, pairs=pairs)
+        dd = (dmax - dmin)/nlags
+        bins = [dmin + n*dd for n in range(nlags)]
+        dmax += 0.001
+        bins.append(dmax)
+    else:
+        bins = _lag_bins(lag_bins, nlags, coords, values, pairs=pairs)
 
-    lags = lags[~np.isnan(semivariance)]
-    semivariance = semivariance[~np.isnan(semivariance)]
+    if sample_pairs is not None:
+        lags, semivariance, semivariance_error = _sample_lag_pairs(coords, values, bins, sample_pairs,
+                                                                   random_state, max_lag=max_lag,
+                                                                   closed=lag_bins is not None)
+    else:
+        lags, semivariance, semivariance_error = _bin_lag_pairs(coords, values, bins, pairs=pairs,
+                                                                closed=lag_bins is not None)
 
     if variogram_model_parameters is not None:
         if variogram_model == 'linear' and len(variogram_model_parameters) != 2:
@@ -283,58 +664,185 @@ def initialize_variogram_model_3d(x, y, z, values, variogram_model, variogram_mo
             variogram_model_parameters = calculate_variogram_model(lags, semivariance, variogram_model,
                                                                    variogram_function, weight, semivariance_error)
 
-    return lags, semivariance, variogram_model_parameters
+    return lags, semivariance, semivariance_error, variogram_model_parameters
 
 
-def variogram_function_error(params, x, y, variogram_function, weight, semivariance_error):
-    """Function used to in fitting of variogram model.
-    Returns RMSE between calculated fit and actual data."""
-
-    diff = variogram_function(params, x) - y
+def _fit_weights(x, weight, semivariance_error):
+    """Returns the normalized weights of the variogram points used in fitting the
+    variogram model (see variogram_function_error), or None for equal weights."""
 
     # MEG added two new options (1 and 2) old weighting scheme is 3
     if weight == 1:
         weights = 1.0 / x
-        weights /= np.sum(weights)
-        rmse = np.sqrt(np.average(diff**2, weights=weights))
     elif weight == 2:
         weights = 1.0 / (semivariance_error**2)
-        weights /= np.sum(weights)
-        rmse = np.sqrt(np.average(diff**2, weights=weights))
     elif weight == 3:
         weights = np.arange(x.size, 0.0, -1.0)
-        weights /= np.sum(weights)
-        rmse = np.sqrt(np.average(diff**2, weights=weights))
     else:
-        rmse = np.sqrt(np.mean(diff**2))
+        return None
+
+    return weights / np.sum(weights)
+
+
+def variogram_function_error(params, x, y, variogram_function, weight, semivariance_error):
+    """Function used to in fitting of variogram model.
+    Returns RMSE between calculated fit and actual data."""
+
+    return _fit_error(params, x, y, variogram_function, _fit_weights(x, weight, semivariance_error))
 
-    return rmse
+
+def _fit_error(params, x, y, variogram_function, weights):
+    """Returns the (weighted) RMSE of the variogram fit for weights from _fit_weights."""
+
+    diff = variogram_function(params, x) - y
+    if weights is None:
+        return np.sqrt(np.mean(diff**2))
+    return np.sqrt(np.sum(weights * diff**2))
 
 
-def calculate_variogram_model(lags, semivariance, variogram_model, variogram_function, weight, semivariance_error):
-    """Function that fits a variogram model when parameters are not specified."""
+def _fit_error_gradient(params, x, y, variogram_function, weights, jacobian):
+    """Returns the gradient of _fit_error with respect to the params, from the
+    analytic jacobian of the variogram model."""
+
+    diff = variogram_function(params, x) - y
+    if weights is None:
+        weights = np.ones(x.size) / x.size
+    rmse = np.sqrt(np.sum(weights * diff**2))
+    if rmse == 0.0:
+        return np.zeros(len(params))
+    return np.dot(weights * diff, jacobian(params, x)) / rmse
+
+
+def _fit_linear_variogram_model(x, y, weights, bnds):
+    """Returns the slope and nugget of the linear variogram model that minimize the
+    (weighted) squared error within the bounds bnds, in closed form. The error is
+    a convex quadratic, so its minimum lies either at the unconstrained least-squares
+    solution or on one of the edges of the bounds, where it is found by clipping
+    the one-dimensional least-squares solution."""
+
+    if weights is None:
+        weights = np.ones(x.size) / x.size
+    sw = np.sum(weights)
+    sx = np.sum(weights * x)
+    sy = np.sum(weights * y)
+    sxx = np.sum(weights * x**2)
+    sxy = np.sum(weights * x * y)
+
+    candidates = []
+    det = sw*sxx - sx**2
+    if det > 0.0:
+        candidates.append(((sw*sxy - sx*sy)/det, (sxx*sy - sx*sxy)/det))
+    for slope in bnds[0]:
+        candidates.append((slope, np.clip((sy - slope*sx)/sw, bnds[1][0], bnds[1][1])))
+    for nugget in bnds[1]:
+        if sxx > 0.0:
+            candidates.append((np.clip((sxy - nugget*sx)/sxx, bnds[0][0], bnds[0][1]), nugget))
+
+    best = None
+    for slope, nugget in candidates:
+        if not (bnds[0][0] <= slope <= bnds[0][1] and bnds[1][0] <= nugget <= bnds[1][1]):
+            continue
+        err = np.sum(weights * (slope*x + nugget - y)**2)
+        if best is None or err < best[0]:
+            best = (err, slope, nugget)
+
+    return np.array([best[1], best[2]])
+
+
+def calculate_variogram_model(lags, semivariance, variogram_model, variogram_function, weight,
+                              semivariance_error=None):
+    """Function that fits a variogram model when parameters are not specified.
+    The linear model is fit in closed form. The other models are fit with SLSQP
+    (using the analytic jacobians in variogram_models for the built-in models)
+    from several starting points, and the best fit is kept."""
+
+    weights = _fit_weights(lags, weight, semivariance_error)
 
     if variogram_model == 'linear':
-        x0 = [(np.amax(semivariance) - np.amin(semivariance))/(np.amax(lags) - np.amin(lags)),
-              np.amin(semivariance)]
         bnds = ((0.0, 1000000000.0), (0.0, np.amax(semivariance)))
+        return _fit_linear_variogram_model(lags, semivariance, weights, bnds)
     elif variogram_model == 'power':
-        x0 = [(np.amax(semivariance) - np.amin(semivariance))/(np.amax(lags) - np.amin(lags)),
-              1.1, np.amin(semivariance)]
+        x0 = [[(np.amax(semivariance) - np.amin(semivariance))/(np.amax(lags) - np.amin(lags)),
+               exponent, np.amin(semivariance)] for exponent in [1.1, 0.5, 1.5]]
         bnds = ((0.0, 1000000000.0), (0.01, 1.99), (0.0, np.amax(semivariance)))
     else:
-        x0 = [np.amax(semivariance), 0.5*np.amax(lags), np.amin(semivariance)]
+        x0 = [[np.amax(semivariance), scale*np.amax(lags), np.amin(semivariance)] for scale in [0.5, 0.25, 1.0]]
         bnds = ((0.0, 10*np.amax(semivariance)), (0.0, np.amax(lags)), (0.0, np.amax(semivariance)))
 
-    res = minimize(variogram_function_error, x0, args=(lags, semivariance, variogram_function, weight, semivariance_error),
-                   method='SLSQP', bounds=bnds)
+    jacobian = variogram_models.jacobian_dict.get(variogram_model)
+    if jacobian is not None:
+        def jac(params, x, y, variogram_function, weights):
+            return _fit_error_gradient(params, x, y, variogram_function, weights, jacobian)
+    else:
+        jac = None
+
+    results = [minimize(_fit_error, start, args=(lags, semivariance, variogram_function, weights), jac=jac,
+                        method='SLSQP', bounds=bnds) for start in x0]
+
+    # The first starting point is the original default, so ties go to it.
+    best = results[0]
+    for res in results[1:]:
+        if res.fun < best.fun:
+            best = res
+
+    return best.x
+
+
+def select_variogram_model(x, y, z, variogram_model_list=None, nlags=6, weight=False, min_theta=None,
+                           max_theta=None, lag_bins=None, max_lag=None, sample_pairs=None, random_state=None,
+                           enable_statistics=False):
+    """Fits each of the variogram models in variogram_model_list (default is all of the
+    built-in models) to the same experimental variogram, which is computed only once.
+    Each model is scored by the (weighted, see weight) RMSE of its fit and, if
+    enable_statistics is True, by the Q1, Q2, and cR cross-validation statistics
+    (see find_statistics).
+    Returns a list with a dict for each model, holding 'variogram_model',
+    'variogram_model_parameters', 'rmse', and, if enable_statistics is True, 'Q1',
+    'Q2', and 'cR'. The list is ranked from best to worst by cR if enable_statistics
+    is True and otherwise by RMSE. Anisotropy is not adjusted for here, so x and y
+    should already be adjusted if needed (see adjust_for_anisotropy)."""
+
+    x = np.atleast_1d(np.squeeze(np.array(x, copy=True, dtype=np.float64)))
+    y = np.atleast_1d(np.squeeze(np.array(y, copy=True, dtype=np.float64)))
+    z = np.atleast_1d(np.squeeze(np.array(z, copy=True, dtype=np.float64)))
+    if variogram_model_list is None:
+        variogram_model_list = ['linear', 'power', 'gaussian', 'spherical', 'exponential']
+    for variogram_model in variogram_model_list:
+        if variogram_model not in variogram_models.variogram_dict:
+            raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
+
+    lags, semivariance, semivariance_error = _experimental_variogram(x, y, z, nlags, min_theta, max_theta,
+                                                                     lag_bins, max_lag, sample_pairs,
+                                                                     random_state)
+    weights = _fit_weights(lags, weight, semivariance_error)
+
+    def score(variogram_model):
+        variogram_function = variogram_models.variogram_dict[variogram_model]
+        params = calculate_variogram_model(lags, semivariance, variogram_model, variogram_function,
+                                           weight, semivariance_error)
+        result = {'variogram_model': variogram_model, 'variogram_model_parameters': params,
+                  'rmse': _fit_error(params, lags, semivariance, variogram_function, weights)}
+        if enable_statistics:
+            delta, sigma, epsilon = find_statistics(x, y, z, variogram_function, params)
+            result['Q1'] = calcQ1(epsilon)
+            result['Q2'] = calcQ2(epsilon)
+            result['cR'] = calc_cR(result['Q2'], sigma)
+        return result
+
+    results = [score(variogram_model) for variogram_model in variogram_model_list]
+
+    if enable_statistics:
+        results.sort(key=lambda result: result['cR'])
+    else:
+        results.sort(key=lambda result: result['rmse'])
 
-    return res.x
+    return results
 
 
 def krige(x, y, z, coords, variogram_function, variogram_model_parameters):
-        """Sets up and solves the kriging matrix for the given coordinate pair.
-        This function is now only used for the statistics calculations."""
+        """Sets up and solves the ordinary kriging system of a single point from scratch.
+        The kriging classes do not call this function; it is kept as a plain reference
+        solve, e.g. to check the incremental systems of _find_statistics."""
 
         zero_index = None
         zero_value = False
@@ -368,8 +876,9 @@ def krige(x, y, z, coords, variogram_function, variogram_model_parameters):
         return zinterp, sigmasq
 
 def krige_3d(x, y, z, vals, coords, variogram_function, variogram_model_parameters):
-        """Sets up and solves the kriging matrix for the given coordinate pair.
-        This function is now only used for the statistics calculations."""
+        """Sets up and solves the 3D ordinary kriging system of a single point from scratch.
+        The kriging classes do not call this function; it is kept as a plain reference
+        solve, e.g. to check the incremental systems of _find_statistics."""
 
         zero_index = None
         zero_value = False
@@ -404,50 +913,377 @@ def krige_3d(x, y, z, vals, coords, variogram_function, variogram_model_paramete
         return zinterp, sigmasq
 
 
-def find_statistics(x, y, z, variogram_function, variogram_model_parameters):
-    """Calculates variogram fit statistics."""
-
-    delta = np.zeros(z.shape)
-    sigma = np.zeros(z.shape)
-
-    for n in range(z.shape[0]):
-        if n == 0:
-            delta[n] = 0.0
-            sigma[n] = 0.0
+class SearchNeighborhood(object):
+    """Search neighborhood of kriging with a moving window, which can be passed to
+    the execute methods of OrdinaryKriging, SimpleKriging and OrdinaryKriging3D
+    instead of a fixed number of closest points. The distances are those of the
+    anisotropy-adjusted coordinates.
+
+    Inputs:
+        radius (float, optional): Maximum distance of the selected data points from
+            the target point. Default is None, which does not limit the distance; then
+            max_points must be given.
+        min_points (int, optional): Minimum number of selected data points. Target points
+            with fewer are not kriged (their value and variance are NaN). Default is 1.
+        max_points (int, optional): Maximum number of selected data points; the closest
+            ones are kept. Default is None, which keeps all of the points within radius.
+        max_per_sector (int, optional): Maximum number of selected data points in each
+            quadrant (2D) or octant (3D) around the target point, which balances the
+            selection over the directions when the data are clustered. A sector that is
+            not filled leaves room for the closest points of the others, up to max_points.
+            Default is None.
+
+    Callable Methods:
+        query(data, points): Returns the ragged (CSR) arrays indptr, indices and distances:
+            the indices of the data points selected for target point i, and their
+            distances, are indices[indptr[i]:indptr[i+1]] and distances[indptr[i]:indptr[i+1]],
+            from the closest to the farthest.
+    """
+
+    def __init__(self, radius=None, min_points=1, max_points=None, max_per_sector=None):
+
+        if radius is None and max_points is None:
+            raise ValueError("Must specify radius and/or max_points for a search neighborhood.")
+        if radius is not None and radius <= 0.0:
+            raise ValueError("Search radius must be positive.")
+        if max_points is not None and max_points < max(min_points, 1):
+            raise ValueError("max_points must be at least min_points.")
+        if max_per_sector is not None and max_per_sector < 1:
+            raise ValueError("max_per_sector must be at least 1.")
+        self.radius = radius
+        self.min_points = min_points
+        self.max_points = max_points
+        self.max_per_sector = max_per_sector
+
+    def query(self, data, points):
+        """Selects the data points of each target point. All of the target points
+        are treated at once: the candidates of the KD-tree query are flattened into
+        one array of (target, data point) pairs, which is then sorted by target and
+        distance and filtered with the sector and count limits.
+
+        Inputs:
+            data (array-like, dim nxd): Coordinates of the data points (d = 2 or 3).
+            points (array-like, dim Nxd): Coordinates of the target points.
+        Outputs:
+            indptr (numpy array, dim N+1), indices, distances (numpy arrays): Selection
+                of each target point, in compressed sparse row format.
+        """
+
+        from scipy.spatial import cKDTree
+        data = np.atleast_2d(data)
+        points = np.atleast_2d(points)
+        n = data.shape[0]
+        npt = points.shape[0]
+        tree = cKDTree(data)
+
+        if self.radius is None and self.max_per_sector is not None:
+            rows, idx, dist = self._query_sectors(tree, data, points)
+        elif self.max_per_sector is None and self.max_points is not None:
+            k = min(self.max_points, n)
+            upper = np.inf if self.radius is None else self.radius
+            dist, idx = tree.query(points, k=k, eps=0.0, distance_upper_bound=upper)
+            rows = np.repeat(np.arange(npt), k)
+            idx = idx.reshape(-1)
+            dist = dist.reshape(-1)
+            found = np.isfinite(dist)
+            rows, idx, dist = rows[found], idx[found], dist[found]
         else:
-            z_, ss_ = krige(x[:n], y[:n], z[:n], (x[n], y[n]), variogram_function, variogram_model_parameters)
-            d = z[n] - z_
-            delta[n] = d
-            sigma[n] = np.sqrt(ss_)
+            candidates = tree.query_ball_point(points, self.radius, eps=0.0)
+            counts = np.fromiter((len(c) for c in candidates), dtype=int, count=npt)
+            rows = np.repeat(np.arange(npt), counts)
+            idx = np.fromiter(itertools.chain.from_iterable(candidates), dtype=int, count=np.sum(counts))
+            dist = np.sqrt(np.sum((data[idx] - points[rows])**2, axis=1))
+            order = np.lexsort((dist, rows))
+            rows, idx, dist = rows[order], idx[order], dist[order]
+            if self.max_per_sector is not None:
+                keep = self._in_sectors(data, points, rows, idx, dist)
+                rows, idx, dist = rows[keep], idx[keep], dist[keep]
+
+        if self.max_points is not None:
+            keep = _rank_in_groups(rows) < self.max_points
+            rows, idx, dist = rows[keep], idx[keep], dist[keep]
+
+        counts = np.bincount(rows, minlength=npt)
+        too_few = counts < self.min_points
+        if np.any(too_few):
+            keep = ~too_few[rows]
+            rows, idx, dist = rows[keep], idx[keep], dist[keep]
+            counts[too_few] = 0
+
+        indptr = np.zeros(npt + 1, dtype='int64')
+        indptr[1:] = np.cumsum(counts)
+
+        return indptr, idx.astype('int64'), dist
+
+    def _in_sectors(self, data, points, rows, idx, dist):
+        """Flags the candidates (target point rows, data point idx) that are among the
+        max_per_sector closest ones of their sector."""
+
+        n_sectors = 2**data.shape[1]
+        delta = data[idx] - points[rows]
+        sector = np.sum((delta >= 0.0) * 2**np.arange(data.shape[1]), axis=1)
+        keep = np.zeros(rows.size, dtype=bool)
+        order = np.lexsort((dist, rows * n_sectors + sector))
+        keep[order] = _rank_in_groups(rows[order] * n_sectors + sector[order]) < self.max_per_sector
+        return keep
+
+    def _query_sectors(self, tree, data, points):
+        """Returns the candidates (rows, idx, dist, sorted by target and distance) of
+        each sector without a search radius. The k closest points are queried, starting
+        from max_points per sector; a target point whose sectors are not all filled
+        and which has fewer than max_points candidates is queried again with twice k,
+        since clustered data can push the closest points of a sector far down the list."""
+
+        n = data.shape[0]
+        npt = points.shape[0]
+        n_sectors = 2**data.shape[1]
+        enough = min(self.max_points, n_sectors * self.max_per_sector)
+
+        parts = []
+        pending = np.arange(npt)
+        k = min(self.max_points * n_sectors, n)
+        while pending.size > 0:
+            done = np.zeros(npt, dtype=bool)
+            step = max(2**22 // k, 1)
+            for start in range(0, pending.size, step):
+                block = pending[start:start + step]
+                dist, idx = tree.query(points[block], k=k, eps=0.0)
+                rows = np.repeat(block, k)
+                idx = idx.reshape(-1)
+                dist = dist.reshape(-1)
+                keep = self._in_sectors(data, points, rows, idx, dist)
+                rows, idx, dist = rows[keep], idx[keep], dist[keep]
+                done[block] = (np.bincount(rows, minlength=npt)[block] >= enough) | (k == n)
+                found = done[rows]
+                parts.append((rows[found], idx[found], dist[found]))
+            pending = pending[~done[pending]]
+            k = min(2 * k, n)
+
+        rows, idx, dist = [np.concatenate(part) for part in zip(*parts)]
+        order = np.lexsort((dist, rows))
+        return rows[order], idx[order], dist[order]
+
+
+def _rank_in_groups(keys):
+    """Returns the position of each element within its run of equal (sorted) keys."""
+
+    if keys.size == 0:
+        return np.zeros(0, dtype=int)
+    start = np.concatenate(([True], keys[1:] != keys[:-1]))
+    first = np.maximum.accumulate(np.where(start, np.arange(keys.size), 0))
+    return np.arange(keys.size) - first
+
+
+def _neighborhood_groups(indptr, indices, distances, mask):
+    """Groups the unmasked points whose neighborhoods (ragged CSR arrays, see
+    SearchNeighborhood.query) hold the same set of data points, so that the kriging
+    matrix of each set is factored only once and the right hand sides of its points
+    are solved together. The data points of each neighborhood are sorted by index,
+    so that the points of a group share the same matrix. Returns the sorted indices
+    and distances, the unmasked points with a non-empty neighborhood ordered by group,
+    and the start of each group in that order (dim number of groups + 1)."""
+
+    npt = indptr.shape[0] - 1
+    counts = np.diff(indptr)
+    rows = np.repeat(np.arange(npt), counts)
+    order = np.lexsort((indices, rows))
+    indices = indices[order]
+    distances = distances[order]
+
+    points = np.nonzero(~mask & (counts > 0))[0]
+    if points.size == 0:
+        return indices, distances, points.astype('int64'), np.zeros(1, dtype='int64')
+
+    padded = np.full((npt, np.max(counts)), -1, dtype=indices.dtype)
+    padded[rows, np.arange(indices.size) - indptr[rows]] = indices
+    group = np.unique(padded[points], axis=0, return_inverse=True)[1]
+    group_ptr = np.zeros(np.max(group) + 2, dtype='int64')
+    group_ptr[1:] = np.cumsum(np.bincount(group))
+
+    return indices, distances, points[np.argsort(group, kind='mergesort')].astype('int64'), group_ptr
+
+
+def _point_chunks(mask, n_rows, max_memory=None):
+    """Returns the indices of the unmasked points split into blocks, so that the
+    temporary arrays of a vectorized execution (about five arrays of n_rows doubles
+    per point) fit in max_memory megabytes. All the points form one block if
+    max_memory is None."""
+
+    idx = np.nonzero(~mask)[0]
+    if max_memory is None:
+        size = max(idx.size, 1)
+    else:
+        size = max(int(max_memory * 2**20 // (5 * 8 * n_rows)), 1)
+
+    return [idx[i:i + size] for i in range(0, idx.size, size)]
+
+
+def _available_memory():
+    """Returns the available physical memory in MB, or None if it cannot be found."""
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2.**20
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _choose_backend(backends, n_rows, npt, n_closest_points=None, max_memory=None, return_variance=True,
+                    n_jobs=1):
+    """Estimates the run time and the peak memory of kriging npt points with each
+    of the given backends, and picks the fastest one whose memory fits in max_memory
+    (in MB; by default, half of the available physical memory). n_rows is the size
+    of the kriging matrix. The estimates are rough: the flops of the solves at
+    about 5 GFLOPS when many right hand sides are solved at once (1 GFLOPS one at
+    a time), plus the memory traffic of the temporaries and a fixed overhead per
+    Python-level iteration; the 'C' backend runs on n_jobs threads. Returns a dict
+    with the chosen backend, the max_memory to use with it, and the (time in s,
+    memory in MB) estimates of each backend."""
+
+    if max_memory is None:
+        available = _available_memory()
+        max_memory = 0.5 * available if available is not None else 1024.
+    budget = max_memory * 2**20
+
+    estimates = {}
+    for backend in backends:
+        if n_closest_points is not None:
+            m = n_closest_points + 1
+            flops = npt * (2. / 3. * m**3 + 2. * m**2)
+            memory = 16. * npt * n_closest_points
+            if backend == 'loop':
+                time = flops / 1e9 + 5e-5 * npt
+            else:
+                time = (flops / 5e9 + 1e-6 * npt) / n_jobs
+        else:
+            m = n_rows
+            if return_variance:
+                flops = 2. * npt * m**2
+            else:
+                flops = 2. * npt * m
+            if backend == 'vectorized':
+                block = min(max(int(budget // (40. * m)), 1), max(npt, 1))
+                memory = 40. * m * block
+                time = flops / 5e9 + 40. * npt * m / 5e9 + 1e-4 * np.ceil(npt / float(block))
+            elif backend == 'loop':
+                memory = 8. * npt * m
+                time = flops / 1e9 + 2e-5 * npt
+            else:
+                block = min(max(int(budget // (40. * m)), 1), max(npt, 1))
+                memory = 8. * m * block
+                time = (flops / 5e9 + 1e-6 * npt) / n_jobs + 1e-4 * np.ceil(npt / float(block))
+        estimates[backend] = (time, memory / 2.**20)
+
+    feasible = [backend for backend in backends if estimates[backend][1] <= max_memory]
+    if len(feasible) == 0:
+        feasible = backends
+    backend = min(feasible, key=lambda b: estimates[b][0])
+
+    chunked = backend in ['vectorized', 'C'] and n_closest_points is None
+    return {'backend': backend, 'max_memory': max_memory if chunked else None,
+            'estimates': estimates}
+
+
+def _find_statistics(coords, values, variogram_function, variogram_model_parameters):
+    """Kriges each data point from the data points before it and returns the
+    residuals (delta) and kriging standard deviations (sigma). Each kriging matrix is
+    the previous one bordered by one more row and column, so its inverse is grown
+    from the previous inverse in O(N^2) (bordering method) instead of being solved
+    from scratch, which takes the whole calculation from O(N^4) to O(N^3). The
+    unbiasedness row and column are kept first so that each new point is appended."""
+
+    n_points = values.shape[0]
+    delta = np.zeros(max(n_points - 1, 0))
+    sigma = np.zeros(max(n_points - 1, 0))
+    ainv = np.zeros((n_points + 1, n_points + 1))
+    ainv[0, 1] = 1.0
+    ainv[1, 0] = 1.0
+
+    for n in range(1, n_points):
+        bd = np.sqrt(np.sum((coords[:n] - coords[n])**2, axis=1))
+        c = np.ones(n + 1)
+        c[1:] = - variogram_function(variogram_model_parameters, bd)
+        b = c.copy()
+        zero_index = np.where(bd <= 1e-10)[0]
+        if zero_index.size > 0:
+            b[zero_index[0] + 1] = 0.0
+
+        inv = ainv[:n + 1, :n + 1]
+        x_, u = np.dot(inv, np.column_stack((b, c))).T
+        delta[n - 1] = values[n] - np.sum(x_[1:] * values[:n])
+        sigma[n - 1] = np.sqrt(np.sum(x_ * -b))
+
+        # The new point's column c is the right hand side above except at a
+        # coincident data point, so the Schur complement below is sigma**2 in general.
+        # It vanishes for a coincident point without a nugget, where the kriging
+        # matrix of the following points is singular.
+        if n < n_points - 1:
+            schur = - np.dot(c, u)
+            if not abs(schur) > 1e-10 * np.amax(np.abs(c[1:])):
+                raise np.linalg.LinAlgError("Singular kriging matrix: data point %d coincides with "
+                                            "an earlier data point and the variogram has no nugget." % n)
+            inv += np.outer(u, u) / schur
+            ainv[:n + 1, n + 1] = - u / schur
+            ainv[n + 1, :n + 1] = - u / schur
+            ainv[n + 1, n + 1] = 1.0 / schur
 
-    delta = delta[1:]
-    sigma = sigma[1:]
     epsilon = delta/sigma
 
     return delta, sigma, epsilon
 
+
+def find_statistics(x, y, z, variogram_function, variogram_model_parameters):
+    """Calculates variogram fit statistics."""
+
+    return _find_statistics(np.column_stack((x, y)), z, variogram_function, variogram_model_parameters)
+
+
 def find_statistics_3d(x, y, z, vals, variogram_function, variogram_model_parameters):
     """Calculates variogram fit statistics for 3D problems."""
 
-    delta = np.zeros(vals.shape)
-    sigma = np.zeros(vals.shape)
+    return _find_statistics(np.column_stack((x, y, z)), vals, variogram_function, variogram_model_parameters)
 
-    for n in range(z.shape[0]):
-        if n == 0:
-            delta[n] = 0.0
-            sigma[n] = 0.0
-        else:
-            z_, ss_ = krige_3d(x[:n], y[:n], z[:n], vals[:n], (x[n], y[n], z[n]),
-                               variogram_function, variogram_model_parameters)
-            d = z[n] - z_
-            delta[n] = d
-            sigma[n] = np.sqrt(ss_)
-
-    delta = delta[1:]
-    sigma = sigma[1:]
-    epsilon = delta/sigma
 
-    return delta, sigma, epsilon
+def leave_one_out(factor, values):
+    """Returns the leave-one-out cross-validation residuals (each data value minus its
+    kriging estimate from all of the other data) and kriging variances with the closed
+    form of Dubrule (1983). Only the data columns of the inverse of the kriging matrix
+    are needed; they are solved for with its LU factorization (lu, piv), as cached by
+    the kriging classes, so that the matrix is not factored again. The data points must
+    come first in the matrix, followed by any drift and unbiasedness rows."""
+
+    n = values.shape[0]
+    lu, piv = factor
+    a_inv = scipy.linalg.lu_solve((lu, piv), np.eye(lu.shape[0], n))[:n, :]
+    diag = np.diag(a_inv)
+    residuals = np.dot(a_inv, values) / diag
+    sigmasq = 1.0 / diag
+
+    return residuals, sigmasq
+
+
+def _leave_one_out_neighborhoods(coords, n_closest_points):
+    """Returns the neighborhoods of the data points (coords, dim N x number of
+    dimensions) for moving-window cross-validation, as ragged (CSR) arrays like those
+    of SearchNeighborhood.query: the n_closest_points nearest data points of each data
+    point, not counting the point itself."""
+
+    from scipy.spatial import cKDTree
+
+    n = coords.shape[0]
+    if n_closest_points < 1 or n_closest_points >= n:
+        raise ValueError("n_closest_points must be at least 1 and smaller than the number "
+                         "of data points for cross-validation.")
+
+    bd, bd_idx = cKDTree(coords).query(coords, k=n_closest_points + 1, eps=0.0)
+    bd = bd.reshape((n, n_closest_points + 1))
+    bd_idx = bd_idx.reshape((n, n_closest_points + 1))
+    # Drops each data point from its own neighborhood (or the farthest neighbor
+    # if the point is not found among coincident data points).
+    keep = bd_idx != np.arange(n)[:, np.newaxis]
+    keep[np.sum(keep, axis=1) > n_closest_points, -1] = False
+    indptr = np.arange(0, n * n_closest_points + 1, n_closest_points)
+
+    return indptr, bd_idx[keep], bd[keep]
 
 
 def calcQ1(epsilon):
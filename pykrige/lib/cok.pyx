@@ -4,191 +4,249 @@
 # cython: cdivision=True
 import numpy as np
 cimport numpy as np
-import scipy.linalg.blas
-from libc.math cimport sqrt
 import scipy.linalg
-from .lapack cimport dgemv, dgesv
-from .variogram_models cimport get_variogram_model
+from cython.parallel cimport prange, threadid
+from .lapack cimport dgemv, dgetrf, dgetrs
+from .variogram_models cimport variogram_model_t, get_variogram_model
 
 
 cpdef _c_exec_loop(double [:, ::1] a_all,
               double [:, ::1] bd_all,
               char [::1] mask,
               long n,
-              dict pars):
-    cdef long i, j, k
+              dict pars,
+              int n_jobs=1,
+              bint return_variance=True):
+    cdef long p, t, start, stop, n_blocks, n_points
 
     npt = bd_all.shape[0]
 
     cdef double [::1] zvalues = np.zeros(npt, dtype='float64')
     cdef double [::1] sigmasq = np.zeros(npt, dtype='float64')
-    cdef double [::1] x = np.zeros(n+1, dtype='float64')
-    cdef double [::1] b = np.zeros(n+1, dtype='float64')
     cdef double [::1] Z = pars['Z']
-    cdef double [::1] bd
-    cdef double z_tmp, ss_tmp, eps=pars['eps']
-    cdef int nb, inc=1
-    cdef double alpha=1.0, beta=0.0
+    cdef double eps = pars['eps']
+    cdef long [::1] points = np.flatnonzero(np.asarray(mask) == 0).astype('int64')
 
-    nb = n + 1
+    # The right hand sides are collected in blocks of block_size points and solved
+    # together with the LU factorization of the kriging matrix (dgetrs). The blocks
+    # are spread over n_jobs threads, each with its own scratch arrays.
+    cdef long block_size = 128
+    n_jobs = max(n_jobs, 1)
+    cdef double [:, ::1] tmp = np.zeros((n_jobs, max(n, block_size)), dtype='float64')
+    cdef double [:, :, ::1] b = np.zeros((n_jobs, block_size, n+1), dtype='float64')
+    cdef double [:, :, ::1] x = np.zeros((n_jobs, block_size if return_variance else 1, n+1), dtype='float64')
 
-
-    c_variogram_function = get_variogram_model(pars['variogram_function'].__name__)
+    cdef variogram_model_t c_variogram_function = get_variogram_model(pars['variogram_function'].__name__)
 
     cdef double [::1] variogram_model_parameters = np.asarray(pars['variogram_model_parameters'])
 
-    cdef double [::1,:] a_inv = scipy.linalg.inv(a_all)
-
-    for i in range(npt):   # same thing as range(npt) if mask is not defined, otherwise take the non masked elements
-        if mask[i]:
-            continue
-        bd = bd_all[i]
+    if 'lu' in pars:
+        lu_piv = pars['lu']
+    else:
+        lu_piv = scipy.linalg.lu_factor(a_all)
+    cdef double [::1,:] lu = np.asfortranarray(lu_piv[0])
+    cdef int [::1] ipiv = (lu_piv[1] + 1).astype('int32')   # dgetrs takes 1-based pivots
 
-        c_variogram_function(variogram_model_parameters, n, bd, b)
+    # dual kriging weights, used for the kriged values when the variance is not needed
+    cdef double [::1] w = scipy.linalg.lu_solve(lu_piv, np.append(np.asarray(Z), 0.0))
 
-        for k in range(n):
-            b[k] *= -1
-        b[n] = 1.0
-
-        check_b_vect(n, bd, b, eps)
-
-
-        # Do the BLAS matrix-vector multiplication call
-        dgemv(
-                                  # # Compute y := alpha*A*x + beta*y
-             'N',                 # char *trans, # {'T','C'}: o(A)=A'; {'N'}: o(A)=A
-             &nb,                 # int *m, # Rows of A (prior to transpose from *trans)
-             &nb,                 # int *n, # Columns of A / min(len(x))
-             &alpha,              # np.float64_t *alpha, # Scalar multiple
-             &(a_inv[0,0]),          # np.float64_t *a, # Matrix A: mxn
-             &nb,                 # int *lda, # The size of the first dimension of A (in memory)
-             &(b[0]),             # np.float64_t *x, # Vector x, min(len(x)) = n
-             &inc,                # int *incx, # The increment between elements of x (usually 1)
-             &beta,               # np.float64_t *beta, # Scalar multiple
-             &(x[0]),           # np.float64_t *y, # Vector y, min(len(y)) = m
-             &inc                 # int *incy # The increment between elements of y (usually 1)
-            )
-
-        z_tmp = 0.0
-        ss_tmp = 0.0
-        for k in range(n):
-            z_tmp += x[k]*Z[k]
+    n_points = points.shape[0]
+    n_blocks = (n_points + block_size - 1) // block_size
+    cdef int [::1] info = np.zeros(max(n_blocks, 1), dtype='int32')
 
-        for k in range(nb):
-            ss_tmp += x[k]*b[k]
+    for p in prange(n_blocks, nogil=True, schedule='dynamic', num_threads=n_jobs):
+        t = threadid()
+        start = p * block_size
+        stop = start + block_size if start + block_size < n_points else n_points
+        info[p] = _c_krige_block(lu, ipiv, points[start:stop], bd_all, Z, w,
+                                 c_variogram_function, variogram_model_parameters, eps,
+                                 tmp[t], b[t], x[t], zvalues, sigmasq, return_variance)
 
-        zvalues[i] = z_tmp
-        sigmasq[i] = -ss_tmp
+    if np.any(np.asarray(info) != 0):
+        raise ValueError('Wrong arguments')
 
     return zvalues.base, sigmasq.base
 
-cpdef _c_exec_loop_moving_window(double [:, ::1] a_all,
-              double [:, ::1] bd_all,
-              char [::1] mask,
-              long [:,::1] bd_idx,
-              long n_max,
-              dict pars):
-    cdef long i, j, k, p_i, p_j, npt, n
-
-    npt = bd_all.shape[0]
-    n = bd_idx.shape[1]
-
-    cdef double [::1] zvalues = np.zeros(npt, dtype='float64')
-    cdef double [::1] sigmasq = np.zeros(npt, dtype='float64')
-    cdef double [::1] x = np.zeros(n_max+1, dtype='float64')
-    cdef double [::1] tmp = np.zeros(n_max+1, dtype='float64')
-    cdef double [::1] b = np.zeros(n_max+1, dtype='float64')
-    cdef double [::1] Z = pars['Z']
-    cdef double [::1] a_selection = np.zeros((n_max+1)*(n_max+1), dtype='float64')
-    cdef double [::1] bd = np.zeros(n_max, dtype='float64')
-    cdef double z_tmp, ss_tmp, eps=pars['eps']
-    cdef int nb, nrhs=1, info
-    cdef int [::1] ipiv = np.zeros(n_max+1, dtype='int32')
-    cdef double alpha=1.0, beta=0.0
-    cdef long [::1] bd_idx_sel
-
-    nb = n + 1
-
-
-
-    c_variogram_function = get_variogram_model(pars['variogram_function'].__name__)
-
-    cdef double [::1] variogram_model_parameters = np.asarray(pars['variogram_model_parameters'])
-
-
-
-    for i in range(npt):
-        if mask[i]:
-            continue
-
-        bd = bd_all[i, :]
-
-        bd_idx_sel = bd_idx[i, :]
-
 
+cdef int _c_krige_block(double [::1, :] lu,
+                        int [::1] ipiv,
+                        long [::1] points,
+                        double [:, ::1] bd_all,
+                        double [::1] Z,
+                        double [::1] w,
+                        variogram_model_t c_variogram_function,
+                        double [::1] variogram_model_parameters,
+                        double eps,
+                        double [::1] tmp,
+                        double [:, ::1] b,
+                        double [:, ::1] x,
+                        double [::1] zvalues,
+                        double [::1] sigmasq,
+                        bint return_variance) nogil:
+    """Solves the kriging systems of a block of points at once, as the right hand
+    sides (rows of b and x, i.e. columns in LAPACK's layout) of one dgetrs call,
+    and reduces the kriged values and variances in one pass over the solutions.
+    Without the variance, the kriged values are the products of the right hand
+    sides with the dual weights w, from a single dgemv call and no solve.
+    Returns the LAPACK info code."""
+    cdef long j, k, n = Z.shape[0]
+    cdef int nb = n + 1, nrhs = points.shape[0], info, inc = 1
+    cdef double z_tmp, ss_tmp, one = 1.0, zero = 0.0
+
+    for j in range(nrhs):
+        c_variogram_function(variogram_model_parameters, n, bd_all[points[j]], tmp)
         for k in range(n):
-            p_i = bd_idx_sel[k]
-            for j in range(n):
-                p_j = bd_idx_sel[j]
-                a_selection[k + nb*j] = a_all[p_i, p_j]
-
-        for k in range(nb):
-            a_selection[k*nb + n] = 1.0
-            a_selection[n*nb + k] = 1.0
-        a_selection[n*nb + n] = 0.0
-
-        c_variogram_function(variogram_model_parameters, n, bd, tmp)
-
+            if bd_all[points[j], k] <= eps:
+                b[j, k] = 0.0
+            else:
+                b[j, k] = - tmp[k]
+        b[j, n] = 1.0
+
+    if not return_variance:
+        dgemv('T', &nb, &nrhs, &one, &b[0, 0], &nb, &w[0], &inc, &zero, &tmp[0], &inc)
+        for j in range(nrhs):
+            zvalues[points[j]] = tmp[j]
+        return 0
+
+    x[:nrhs, :] = b[:nrhs, :]
+    dgetrs('N', &nb, &nrhs, &lu[0, 0], &nb, &ipiv[0], &x[0, 0], &nb, &info)
+    if info != 0:
+        return info
+
+    for j in range(nrhs):
+        z_tmp = 0.0
+        ss_tmp = x[j, n]*b[j, n]
         for k in range(n):
-            b[k] = - tmp[k]
-        b[n] = 1.0
+            z_tmp = z_tmp + x[j, k]*Z[k]
+            ss_tmp = ss_tmp + x[j, k]*b[j, k]
+        zvalues[points[j]] = z_tmp
+        sigmasq[points[j]] = -ss_tmp
 
-        check_b_vect(n, bd, b, eps)
-
-        for k in range(nb):
-            x[k] = b[k]
-
-        # higher level (and slower) call to do the same thing as dgesv below
-        #a2D = a_selection.base[:nb*nb].reshape((nb, nb))
-        #x =  scipy.linalg.solve(a2D, b.base[:nb])
+    return 0
 
-        dgesv(
-                &nb,
-                &nrhs,
-                &(a_selection[0]),
-                &nb,
-                &(ipiv[0]),
-                &(x[0]),
-                &nb,
-                &info
-                )
 
-        if info > 0:
-            raise ValueError('Singular matrix')
-        elif info < 0:
-            raise ValueError('Wrong arguments')
+cpdef _c_exec_loop_neighborhood(double [:, ::1] a_all,
+              double [::1] distances,
+              long [::1] indices,
+              long [::1] indptr,
+              long [::1] points,
+              long [::1] group_ptr,
+              dict pars,
+              int n_jobs=1):
+    """Kriges each point from the data points of its neighborhood, given as ragged
+    (CSR) arrays: the indices and distances of the data points of point i are
+    indices[indptr[i]:indptr[i+1]] and distances[indptr[i]:indptr[i+1]], sorted by
+    index. The points are grouped by neighborhood (see core._neighborhood_groups):
+    the points of group g, points[group_ptr[g]:group_ptr[g+1]], share their data
+    points, so that the kriging matrix of each group is factored only once."""
+    cdef long g, t, npt, n, n_groups
+
+    npt = indptr.shape[0] - 1
+    n_groups = group_ptr.shape[0] - 1
+    n = max(np.max(np.diff(indptr)), 1) if npt > 0 else 1
 
+    cdef double [::1] zvalues = np.zeros(npt, dtype='float64')
+    cdef double [::1] sigmasq = np.zeros(npt, dtype='float64')
+    cdef double [::1] Z = pars['Z']
+    cdef double eps = pars['eps']
+    cdef int [::1] info = np.zeros(max(n_groups, 1), dtype='int32')
+
+    # scratch arrays of each thread; the right hand sides of a group are solved in
+    # blocks of block_size points. They are sized by the largest neighborhood (plus
+    # the unbiasedness row), never by the number of data points, since there is one
+    # set per thread.
+    cdef long block_size = 128
+    n_jobs = max(n_jobs, 1)
+    cdef double [:, :, ::1] x = np.zeros((n_jobs, block_size, n+1), dtype='float64')
+    cdef double [:, :, ::1] b = np.zeros((n_jobs, block_size, n+1), dtype='float64')
+    cdef double [:, ::1] tmp = np.zeros((n_jobs, n+1), dtype='float64')
+    cdef double [:, ::1] a_selection = np.zeros((n_jobs, (n+1)*(n+1)), dtype='float64')
+    cdef int [:, ::1] ipiv = np.zeros((n_jobs, n+1), dtype='int32')
+
+    cdef variogram_model_t c_variogram_function = get_variogram_model(pars['variogram_function'].__name__)
 
-        z_tmp = 0.0
-        ss_tmp = 0.0
-        for k in range(n):
-            j = bd_idx_sel[k]
-            z_tmp += x[k]*Z[j]
+    cdef double [::1] variogram_model_parameters = np.asarray(pars['variogram_model_parameters'])
 
-        for k in range(nb):
-            ss_tmp += x[k]*b[k]
+    for g in prange(n_groups, nogil=True, schedule='dynamic', num_threads=n_jobs):
+        t = threadid()
+        info[g] = _c_krige_group(a_all, distances, indices, indptr, points[group_ptr[g]:group_ptr[g+1]], Z,
+                                 c_variogram_function, variogram_model_parameters, eps,
+                                 a_selection[t], ipiv[t], b[t], x[t], tmp[t], zvalues, sigmasq)
 
-        zvalues[i] = z_tmp
-        sigmasq[i] = -ss_tmp
+    if np.any(np.asarray(info) > 0):
+        raise ValueError('Singular matrix')
+    elif np.any(np.asarray(info) < 0):
+        raise ValueError('Wrong arguments')
 
     return zvalues.base, sigmasq.base
 
 
-cdef int check_b_vect(long n, double [::1] bd, double[::1] b, double eps) nogil:
-    cdef long k
+cdef int _c_krige_group(double [:, ::1] a_all,
+                        double [::1] distances,
+                        long [::1] indices,
+                        long [::1] indptr,
+                        long [::1] points,
+                        double [::1] Z,
+                        variogram_model_t c_variogram_function,
+                        double [::1] variogram_model_parameters,
+                        double eps,
+                        double [::1] a_selection,
+                        int [::1] ipiv,
+                        double [:, ::1] b,
+                        double [:, ::1] x,
+                        double [::1] tmp,
+                        double [::1] zvalues,
+                        double [::1] sigmasq) nogil:
+    """Assembles and LU factors (dgetrf) the kriging matrix of the data points shared
+    by a group of points, then solves the systems of the points in blocks of
+    right hand sides (dgetrs). Returns the LAPACK info code."""
+    cdef long j, k, p, start, p_j, p_k
+    cdef long n = indptr[points[0]+1] - indptr[points[0]]
+    cdef int nb = n + 1, ldb = b.shape[1], nrhs, info
+    cdef double z_tmp, ss_tmp
 
     for k in range(n):
-        if bd[k] <= eps:
-            b[k] = 0.0
+        p_k = indices[indptr[points[0]] + k]
+        for j in range(n):
+            p_j = indices[indptr[points[0]] + j]
+            a_selection[k + nb*j] = a_all[p_k, p_j]
+        a_selection[k + nb*n] = 1.0
+        a_selection[n + nb*k] = 1.0
+    a_selection[n + nb*n] = 0.0
+
+    dgetrf(&nb, &nb, &a_selection[0], &nb, &ipiv[0], &info)
+    if info != 0:
+        return info
+
+    start = 0
+    while start < points.shape[0]:
+        nrhs = b.shape[0] if start + b.shape[0] < points.shape[0] else points.shape[0] - start
+
+        for j in range(nrhs):
+            p = points[start + j]
+            c_variogram_function(variogram_model_parameters, n, distances[indptr[p]:indptr[p+1]], tmp)
+            for k in range(n):
+                if distances[indptr[p] + k] <= eps:
+                    b[j, k] = 0.0
+                else:
+                    b[j, k] = - tmp[k]
+            b[j, n] = 1.0
+            for k in range(nb):
+                x[j, k] = b[j, k]
+
+        dgetrs('N', &nb, &nrhs, &a_selection[0], &nb, &ipiv[0], &x[0, 0], &ldb, &info)
+        if info != 0:
+            return info
+
+        for j in range(nrhs):
+            p = points[start + j]
+            z_tmp = 0.0
+            ss_tmp = x[j, n]*b[j, n]
+            for k in range(n):
+                z_tmp = z_tmp + x[j, k]*Z[indices[indptr[p] + k]]
+                ss_tmp = ss_tmp + x[j, k]*b[j, k]
+            zvalues[p] = z_tmp
+            sigmasq[p] = -ss_tmp
+        start = start + nrhs
 
     return 0
@@ -0,0 +1,270 @@
+# cython: profile=False
+# cython: boundscheck=False
+# cython: wraparound=False
+# cython: cdivision=True
+import numpy as np
+cimport numpy as np
+import scipy.linalg
+from cython.parallel cimport prange, threadid
+from .lapack cimport dgemv, dgetrf, dgetrs, dpotrf, dpotrs
+from .variogram_models cimport variogram_model_t, get_variogram_model
+
+# Simple kriging in the covariance form: the kriging matrix holds sill - variogram
+# of the data separations, without an unbiasedness row, so that it is symmetric
+# positive definite and solved with its Cholesky factorization.
+
+
+cpdef _c_exec_loop(double [:, ::1] a_all,
+              double [:, ::1] bd_all,
+              char [::1] mask,
+              long n,
+              dict pars,
+              int n_jobs=1,
+              bint return_variance=True):
+    cdef long p, t, start, stop, n_blocks, n_points
+
+    npt = bd_all.shape[0]
+
+    cdef double [::1] zvalues = np.zeros(npt, dtype='float64')
+    cdef double [::1] sigmasq = np.zeros(npt, dtype='float64')
+    cdef double [::1] Z = pars['Z']
+    cdef long [::1] points = np.flatnonzero(np.asarray(mask) == 0).astype('int64')
+
+    # The right hand sides are collected in blocks of block_size points and solved
+    # together (dpotrs, or dgetrs if the matrix could only be LU factored). The blocks
+    # are spread over n_jobs threads, each with its own scratch arrays.
+    cdef long block_size = 128
+    n_jobs = max(n_jobs, 1)
+    cdef double [:, ::1] tmp = np.zeros((n_jobs, max(n, block_size)), dtype='float64')
+    cdef double [:, :, ::1] b = np.zeros((n_jobs, block_size, n), dtype='float64')
+    cdef double [:, :, ::1] x = np.zeros((n_jobs, block_size if return_variance else 1, n), dtype='float64')
+
+    cdef variogram_model_t c_variogram_function = get_variogram_model(pars['variogram_function'].__name__)
+
+    cdef double [::1] variogram_model_parameters = np.asarray(pars['variogram_model_parameters'])
+
+    if 'factor' in pars:
+        method, factor = pars['factor']
+    else:
+        method, factor = 'lu', scipy.linalg.lu_factor(a_all)
+    cdef bint cholesky = method == 'cholesky'
+    cdef double [::1,:] c = np.asfortranarray(factor[0])
+    cdef int [::1] ipiv
+    cdef char uplo = b'U'
+    if cholesky:
+        ipiv = np.zeros(1, dtype='int32')
+        if factor[1]:
+            uplo = b'L'
+        w_solve = scipy.linalg.cho_solve(factor, np.asarray(Z))
+    else:
+        ipiv = (factor[1] + 1).astype('int32')   # dgetrs takes 1-based pivots
+        w_solve = scipy.linalg.lu_solve(factor, np.asarray(Z))
+
+    # dual kriging weights, used for the kriged values when the variance is not needed
+    cdef double [::1] w = w_solve
+
+    n_points = points.shape[0]
+    n_blocks = (n_points + block_size - 1) // block_size
+    cdef int [::1] info = np.zeros(max(n_blocks, 1), dtype='int32')
+
+    for p in prange(n_blocks, nogil=True, schedule='dynamic', num_threads=n_jobs):
+        t = threadid()
+        start = p * block_size
+        stop = start + block_size if start + block_size < n_points else n_points
+        info[p] = _c_krige_block(c, cholesky, uplo, ipiv, points[start:stop], bd_all, Z, w,
+                                 c_variogram_function, variogram_model_parameters,
+                                 tmp[t], b[t], x[t], zvalues, sigmasq, return_variance)
+
+    if np.any(np.asarray(info) != 0):
+        raise ValueError('Wrong arguments')
+
+    return zvalues.base, sigmasq.base
+
+
+cdef int _c_krige_block(double [::1, :] c,
+                        bint cholesky,
+                        char uplo,
+                        int [::1] ipiv,
+                        long [::1] points,
+                        double [:, ::1] bd_all,
+                        double [::1] Z,
+                        double [::1] w,
+                        variogram_model_t c_variogram_function,
+                        double [::1] variogram_model_parameters,
+                        double [::1] tmp,
+                        double [:, ::1] b,
+                        double [:, ::1] x,
+                        double [::1] zvalues,
+                        double [::1] sigmasq,
+                        bint return_variance) nogil:
+    """Solves the simple kriging systems of a block of points at once, as the right
+    hand sides (rows of b and x, i.e. columns in LAPACK's layout) of one solve with
+    the factorization c, and reduces the kriged values and variances in one pass.
+    Without the variance, the kriged values are the products of the right hand
+    sides with the dual weights w, from a single dgemv call and no solve.
+    Returns the LAPACK info code."""
+    cdef long j, k
+    cdef int n = Z.shape[0], nrhs = points.shape[0], info, inc = 1
+    cdef double z_tmp, ss_tmp, one = 1.0, zero = 0.0
+    cdef double sill = variogram_model_parameters[0]
+
+    for j in range(nrhs):
+        c_variogram_function(variogram_model_parameters, n, bd_all[points[j]], tmp)
+        for k in range(n):
+            b[j, k] = sill - tmp[k]
+
+    if not return_variance:
+        dgemv('T', &n, &nrhs, &one, &b[0, 0], &n, &w[0], &inc, &zero, &tmp[0], &inc)
+        for j in range(nrhs):
+            zvalues[points[j]] = tmp[j]
+        return 0
+
+    x[:nrhs, :] = b[:nrhs, :]
+    if cholesky:
+        dpotrs(&uplo, &n, &nrhs, &c[0, 0], &n, &x[0, 0], &n, &info)
+    else:
+        dgetrs('N', &n, &nrhs, &c[0, 0], &n, &ipiv[0], &x[0, 0], &n, &info)
+    if info != 0:
+        return info
+
+    for j in range(nrhs):
+        z_tmp = 0.0
+        ss_tmp = 0.0
+        for k in range(n):
+            z_tmp = z_tmp + x[j, k]*Z[k]
+            ss_tmp = ss_tmp + x[j, k]*b[j, k]
+        zvalues[points[j]] = z_tmp
+        sigmasq[points[j]] = sill - ss_tmp
+
+    return 0
+
+
+cpdef _c_exec_loop_neighborhood(double [:, ::1] a_all,
+              double [::1] distances,
+              long [::1] indices,
+              long [::1] indptr,
+              long [::1] points,
+              long [::1] group_ptr,
+              dict pars,
+              int n_jobs=1):
+    """Kriges each point from the data points of its neighborhood, given as ragged
+    (CSR) arrays: the indices and distances of the data points of point i are
+    indices[indptr[i]:indptr[i+1]] and distances[indptr[i]:indptr[i+1]], sorted by
+    index. The points are grouped by neighborhood (see core._neighborhood_groups):
+    the points of group g, points[group_ptr[g]:group_ptr[g+1]], share their data
+    points, so that the kriging matrix of each group is factored only once."""
+    cdef long g, t, npt, n, n_groups
+
+    npt = indptr.shape[0] - 1
+    n_groups = group_ptr.shape[0] - 1
+    n = max(np.max(np.diff(indptr)), 1) if npt > 0 else 1
+
+    cdef double [::1] zvalues = np.zeros(npt, dtype='float64')
+    cdef double [::1] sigmasq = np.zeros(npt, dtype='float64')
+    cdef double [::1] Z = pars['Z']
+    cdef int [::1] info = np.zeros(max(n_groups, 1), dtype='int32')
+
+    # scratch arrays of each thread; the right hand sides of a group are solved in
+    # blocks of block_size points. They are sized by the largest neighborhood, never
+    # by the number of data points, since there is one set per thread.
+    cdef long block_size = 128
+    n_jobs = max(n_jobs, 1)
+    cdef double [:, :, ::1] x = np.zeros((n_jobs, block_size, n), dtype='float64')
+    cdef double [:, :, ::1] b = np.zeros((n_jobs, block_size, n), dtype='float64')
+    cdef double [:, ::1] tmp = np.zeros((n_jobs, n), dtype='float64')
+    cdef double [:, ::1] a_selection = np.zeros((n_jobs, n*n), dtype='float64')
+    cdef int [:, ::1] ipiv = np.zeros((n_jobs, n), dtype='int32')
+
+    cdef variogram_model_t c_variogram_function = get_variogram_model(pars['variogram_function'].__name__)
+
+    cdef double [::1] variogram_model_parameters = np.asarray(pars['variogram_model_parameters'])
+
+    for g in prange(n_groups, nogil=True, schedule='dynamic', num_threads=n_jobs):
+        t = threadid()
+        info[g] = _c_krige_group(a_all, distances, indices, indptr, points[group_ptr[g]:group_ptr[g+1]], Z,
+                                 c_variogram_function, variogram_model_parameters,
+                                 a_selection[t], ipiv[t], b[t], x[t], tmp[t], zvalues, sigmasq)
+
+    if np.any(np.asarray(info) > 0):
+        raise ValueError('Singular matrix')
+    elif np.any(np.asarray(info) < 0):
+        raise ValueError('Wrong arguments')
+
+    return zvalues.base, sigmasq.base
+
+
+cdef int _c_krige_group(double [:, ::1] a_all,
+                        double [::1] distances,
+                        long [::1] indices,
+                        long [::1] indptr,
+                        long [::1] points,
+                        double [::1] Z,
+                        variogram_model_t c_variogram_function,
+                        double [::1] variogram_model_parameters,
+                        double [::1] a_selection,
+                        int [::1] ipiv,
+                        double [:, ::1] b,
+                        double [:, ::1] x,
+                        double [::1] tmp,
+                        double [::1] zvalues,
+                        double [::1] sigmasq) nogil:
+    """Assembles and factors the kriging matrix of the data points shared by a group
+    of points, with a Cholesky factorization (dpotrf), or an LU factorization (dgetrf)
+    if the matrix is not numerically positive definite, then solves the systems of
+    the points in blocks of right hand sides. Returns the LAPACK info code."""
+    cdef long j, k, p, start
+    cdef long [::1] selection = indices[indptr[points[0]]:indptr[points[0]+1]]
+    cdef int n = selection.shape[0], ldb = b.shape[1], nrhs, info
+    cdef bint cholesky = True
+    cdef double z_tmp, ss_tmp
+    cdef double sill = variogram_model_parameters[0]
+
+    _select_matrix(a_all, selection, a_selection)
+    dpotrf('L', &n, &a_selection[0], &n, &info)
+    if info > 0:
+        cholesky = False
+        _select_matrix(a_all, selection, a_selection)
+        dgetrf(&n, &n, &a_selection[0], &n, &ipiv[0], &info)
+    if info != 0:
+        return info
+
+    start = 0
+    while start < points.shape[0]:
+        nrhs = b.shape[0] if start + b.shape[0] < points.shape[0] else points.shape[0] - start
+
+        for j in range(nrhs):
+            p = points[start + j]
+            c_variogram_function(variogram_model_parameters, n, distances[indptr[p]:indptr[p+1]], tmp)
+            for k in range(n):
+                b[j, k] = sill - tmp[k]
+                x[j, k] = b[j, k]
+
+        if cholesky:
+            dpotrs('L', &n, &nrhs, &a_selection[0], &n, &x[0, 0], &ldb, &info)
+        else:
+            dgetrs('N', &n, &nrhs, &a_selection[0], &n, &ipiv[0], &x[0, 0], &ldb, &info)
+        if info != 0:
+            return info
+
+        for j in range(nrhs):
+            p = points[start + j]
+            z_tmp = 0.0
+            ss_tmp = 0.0
+            for k in range(n):
+                z_tmp = z_tmp + x[j, k]*Z[selection[k]]
+                ss_tmp = ss_tmp + x[j, k]*b[j, k]
+            zvalues[p] = z_tmp
+            sigmasq[p] = sill - ss_tmp
+        start = start + nrhs
+
+    return 0
+
+
+cdef void _select_matrix(double [:, ::1] a_all, long [::1] bd_idx_sel, double [::1] a_selection) nogil:
+    """Copies the kriging matrix of the selected data points into a_selection
+    (column-major)."""
+    cdef long j, k, n = bd_idx_sel.shape[0]
+
+    for k in range(n):
+        for j in range(n):
+            a_selection[k + n*j] = a_all[bd_idx_sel[k], bd_idx_sel[j]]
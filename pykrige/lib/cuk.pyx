@@ -0,0 +1,248 @@
+# cython: profile=False
+# cython: boundscheck=False
+# cython: wraparound=False
+# cython: cdivision=True
+import numpy as np
+cimport numpy as np
+import scipy.linalg
+from cython.parallel cimport prange, threadid
+from .lapack cimport dgemv, dgesv, dgetrs
+from .variogram_models cimport variogram_model_t, get_variogram_model
+
+# Universal kriging: the kriging matrix is bordered by the drift terms (and the
+# unbiasedness row) of the data points. The matching rows of the right hand side
+# of each point (drift[i]) are computed beforehand in Python, so that any drift
+# term (regional linear, point logarithmic, external, specified or functional)
+# is handled by the same compiled loops.
+
+
+cpdef _c_exec_loop(double [:, ::1] a_all,
+              double [:, ::1] bd_all,
+              char [::1] mask,
+              long n,
+              double [:, ::1] drift,
+              dict pars,
+              int n_jobs=1,
+              bint return_variance=True):
+    cdef long p, t, start, stop, n_blocks, n_points
+    cdef long nb = a_all.shape[0]
+
+    npt = bd_all.shape[0]
+
+    cdef double [::1] zvalues = np.zeros(npt, dtype='float64')
+    cdef double [::1] sigmasq = np.zeros(npt, dtype='float64')
+    cdef double [::1] Z = pars['Z']
+    cdef double eps = pars['eps']
+    cdef long [::1] points = np.flatnonzero(np.asarray(mask) == 0).astype('int64')
+
+    # The right hand sides are collected in blocks of block_size points and solved
+    # together with the LU factorization of the kriging matrix (dgetrs). The blocks
+    # are spread over n_jobs threads, each with its own scratch arrays.
+    cdef long block_size = 128
+    n_jobs = max(n_jobs, 1)
+    cdef double [:, ::1] tmp = np.zeros((n_jobs, max(n, block_size)), dtype='float64')
+    cdef double [:, :, ::1] b = np.zeros((n_jobs, block_size, nb), dtype='float64')
+    cdef double [:, :, ::1] x = np.zeros((n_jobs, block_size if return_variance else 1, nb), dtype='float64')
+
+    cdef variogram_model_t c_variogram_function = get_variogram_model(pars['variogram_function'].__name__)
+
+    cdef double [::1] variogram_model_parameters = np.asarray(pars['variogram_model_parameters'])
+
+    if 'lu' in pars:
+        lu_piv = pars['lu']
+    else:
+        lu_piv = scipy.linalg.lu_factor(a_all)
+    cdef double [::1,:] lu = np.asfortranarray(lu_piv[0])
+    cdef int [::1] ipiv = (lu_piv[1] + 1).astype('int32')   # dgetrs takes 1-based pivots
+
+    # dual kriging weights, used for the kriged values when the variance is not needed
+    rhs = np.zeros(nb)
+    rhs[:n] = Z
+    cdef double [::1] w = scipy.linalg.lu_solve(lu_piv, rhs)
+
+    n_points = points.shape[0]
+    n_blocks = (n_points + block_size - 1) // block_size
+    cdef int [::1] info = np.zeros(max(n_blocks, 1), dtype='int32')
+
+    for p in prange(n_blocks, nogil=True, schedule='dynamic', num_threads=n_jobs):
+        t = threadid()
+        start = p * block_size
+        stop = start + block_size if start + block_size < n_points else n_points
+        info[p] = _c_krige_block(lu, ipiv, points[start:stop], bd_all, drift, Z, w,
+                                 c_variogram_function, variogram_model_parameters, eps,
+                                 tmp[t], b[t], x[t], zvalues, sigmasq, return_variance)
+
+    if np.any(np.asarray(info) != 0):
+        raise ValueError('Wrong arguments')
+
+    return zvalues.base, sigmasq.base
+
+
+cdef int _c_krige_block(double [::1, :] lu,
+                        int [::1] ipiv,
+                        long [::1] points,
+                        double [:, ::1] bd_all,
+                        double [:, ::1] drift,
+                        double [::1] Z,
+                        double [::1] w,
+                        variogram_model_t c_variogram_function,
+                        double [::1] variogram_model_parameters,
+                        double eps,
+                        double [::1] tmp,
+                        double [:, ::1] b,
+                        double [:, ::1] x,
+                        double [::1] zvalues,
+                        double [::1] sigmasq,
+                        bint return_variance) nogil:
+    """Solves the universal kriging systems of a block of points at once, as the right
+    hand sides (rows of b and x, i.e. columns in LAPACK's layout) of one dgetrs call,
+    and reduces the kriged values and variances in one pass over the solutions.
+    Without the variance, the kriged values are the products of the right hand
+    sides with the dual weights w, from a single dgemv call and no solve.
+    Returns the LAPACK info code."""
+    cdef long j, k, n = Z.shape[0], n_drift = drift.shape[1]
+    cdef int nb = n + n_drift, nrhs = points.shape[0], info, inc = 1
+    cdef double z_tmp, ss_tmp, one = 1.0, zero = 0.0
+
+    for j in range(nrhs):
+        c_variogram_function(variogram_model_parameters, n, bd_all[points[j]], tmp)
+        for k in range(n):
+            if bd_all[points[j], k] <= eps:
+                b[j, k] = 0.0
+            else:
+                b[j, k] = - tmp[k]
+        for k in range(n_drift):
+            b[j, n + k] = drift[points[j], k]
+
+    if not return_variance:
+        dgemv('T', &nb, &nrhs, &one, &b[0, 0], &nb, &w[0], &inc, &zero, &tmp[0], &inc)
+        for j in range(nrhs):
+            zvalues[points[j]] = tmp[j]
+        return 0
+
+    x[:nrhs, :] = b[:nrhs, :]
+    dgetrs('N', &nb, &nrhs, &lu[0, 0], &nb, &ipiv[0], &x[0, 0], &nb, &info)
+    if info != 0:
+        return info
+
+    for j in range(nrhs):
+        z_tmp = 0.0
+        ss_tmp = 0.0
+        for k in range(n):
+            z_tmp = z_tmp + x[j, k]*Z[k]
+            ss_tmp = ss_tmp + x[j, k]*b[j, k]
+        for k in range(n, nb):
+            ss_tmp = ss_tmp + x[j, k]*b[j, k]
+        zvalues[points[j]] = z_tmp
+        sigmasq[points[j]] = -ss_tmp
+
+    return 0
+
+
+cpdef _c_exec_loop_moving_window(double [:, ::1] a_all,
+              double [:, ::1] bd_all,
+              char [::1] mask,
+              long [:,::1] bd_idx,
+              long n_max,
+              double [:, ::1] drift,
+              dict pars,
+              int n_jobs=1):
+    cdef long i, t, npt, nb
+
+    npt = bd_all.shape[0]
+    nb = bd_idx.shape[1] + drift.shape[1]
+
+    cdef double [::1] zvalues = np.zeros(npt, dtype='float64')
+    cdef double [::1] sigmasq = np.zeros(npt, dtype='float64')
+    cdef double [::1] Z = pars['Z']
+    cdef double eps = pars['eps']
+    cdef int [::1] info = np.zeros(npt, dtype='int32')
+
+    # scratch arrays of each thread
+    n_jobs = max(n_jobs, 1)
+    cdef double [:, ::1] x = np.zeros((n_jobs, nb), dtype='float64')
+    cdef double [:, ::1] tmp = np.zeros((n_jobs, nb), dtype='float64')
+    cdef double [:, ::1] b = np.zeros((n_jobs, nb), dtype='float64')
+    cdef double [:, ::1] a_selection = np.zeros((n_jobs, nb*nb), dtype='float64')
+    cdef int [:, ::1] ipiv = np.zeros((n_jobs, nb), dtype='int32')
+
+    cdef variogram_model_t c_variogram_function = get_variogram_model(pars['variogram_function'].__name__)
+
+    cdef double [::1] variogram_model_parameters = np.asarray(pars['variogram_model_parameters'])
+
+    for i in prange(npt, nogil=True, schedule='guided', num_threads=n_jobs):
+        if mask[i]:
+            continue
+        t = threadid()
+        info[i] = _c_krige_window(a_all, n_max, bd_all[i], bd_idx[i], drift[i], Z,
+                                  c_variogram_function, variogram_model_parameters, eps,
+                                  a_selection[t], b[t], x[t], ipiv[t], tmp[t],
+                                  i, zvalues, sigmasq)
+
+    if np.any(np.asarray(info) > 0):
+        raise ValueError('Singular matrix')
+    elif np.any(np.asarray(info) < 0):
+        raise ValueError('Wrong arguments')
+
+    return zvalues.base, sigmasq.base
+
+
+cdef int _c_krige_window(double [:, ::1] a_all,
+                         long n_max,
+                         double [::1] bd,
+                         long [::1] bd_idx_sel,
+                         double [::1] drift,
+                         double [::1] Z,
+                         variogram_model_t c_variogram_function,
+                         double [::1] variogram_model_parameters,
+                         double eps,
+                         double [::1] a_selection,
+                         double [::1] b,
+                         double [::1] x,
+                         int [::1] ipiv,
+                         double [::1] tmp,
+                         long i,
+                         double [::1] zvalues,
+                         double [::1] sigmasq) nogil:
+    """Assembles and solves the universal kriging system of point i from its n
+    closest data points and all of the drift terms (dgesv). The drift rows and
+    columns of the kriging matrix follow the n_max data points in a_all.
+    Returns the LAPACK info code."""
+    cdef long j, k, p_j, p_k, n = bd_idx_sel.shape[0], n_drift = drift.shape[0]
+    cdef int nb = n + n_drift, nrhs = 1, info
+    cdef double z_tmp, ss_tmp
+
+    for k in range(nb):
+        p_k = bd_idx_sel[k] if k < n else n_max + k - n
+        for j in range(nb):
+            p_j = bd_idx_sel[j] if j < n else n_max + j - n
+            a_selection[k + nb*j] = a_all[p_k, p_j]
+
+    c_variogram_function(variogram_model_parameters, n, bd, tmp)
+
+    for k in range(n):
+        if bd[k] <= eps:
+            b[k] = 0.0
+        else:
+            b[k] = - tmp[k]
+    for k in range(n_drift):
+        b[n + k] = drift[k]
+
+    for k in range(nb):
+        x[k] = b[k]
+
+    dgesv(&nb, &nrhs, &a_selection[0], &nb, &ipiv[0], &x[0], &nb, &info)
+    if info != 0:
+        return info
+
+    z_tmp = 0.0
+    ss_tmp = 0.0
+    for k in range(n):
+        z_tmp = z_tmp + x[k]*Z[bd_idx_sel[k]]
+    for k in range(nb):
+        ss_tmp = ss_tmp + x[k]*b[k]
+
+    zvalues[i] = z_tmp
+    sigmasq[i] = -ss_tmp
+
+    return 0
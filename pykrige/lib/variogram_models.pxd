@@ -1,4 +1,4 @@
 
-ctypedef void (*variogram_model_t)(double [::1], long, double [::1], double [::1])
+ctypedef void (*variogram_model_t)(double [::1], long, double [::1], double [::1]) nogil
 
 cdef variogram_model_t get_variogram_model(function_name)
@@ -65,6 +65,22 @@ class OrdinaryKriging:
             variogram_parameters will be passed to the function as the first argument.
         nlags (int, optional): Number of averaging bins for the semivariogram.
             Default is 6.
+        lag_bins (string or array-like, optional): Specifies the semivariogram lag bins.
+            'linear' gives nlags bins of equal width and 'geometric' gives nlags bins
+            whose widths grow by a constant factor; an array of bin edges may also be
+            given, in which case nlags is ignored. Default is None, which halves
+            the bin widths toward the shortest lags.
+        max_lag (float, optional): Largest separation distance of the data pairs used
+            to calculate the semivariogram. Only the pairs within max_lag are looked up
+            (with a KD-tree), which saves time and memory for large data sets.
+            Default is None, which uses all of the data pairs.
+        sample_pairs (int, optional): If specified, the semivariogram is estimated from
+            a random sample of the data pairs instead of all of them, for very large
+            data sets. Pairs are drawn until each lag bin holds about sample_pairs/nlags
+            of them (or for at most ten rounds of sample_pairs draws). Default is None.
+        random_state (int or numpy RandomState, optional): Seed or random number
+            generator used with sample_pairs, so that the sample can be reproduced.
+            Default is None.
         weight (boolean, optional): Flag that specifies if semivariance at smaller lags
             should be weighted more heavily when automatically calculating variogram model.
             True indicates that weights will be applied. Default is False.
@@ -103,6 +119,22 @@ class OrdinaryKriging:
                     more information.
                 nlags (int, optional): Number of averaging bins for the semivariogram.
                     Defualt is 6.
+                lag_bins (string or array-like, optional): Specifies the semivariogram lag bins.
+                    'linear' gives nlags bins of equal width and 'geometric' gives nlags bins
+                    whose widths grow by a constant factor; an array of bin edges may also be
+                    given, in which case nlags is ignored. Default is None, which halves
+                    the bin widths toward the shortest lags.
+                max_lag (float, optional): Largest separation distance of the data pairs used
+                    to calculate the semivariogram. Only the pairs within max_lag are looked up
+                    (with a KD-tree), which saves time and memory for large data sets.
+                    Default is None, which uses all of the data pairs.
+                sample_pairs (int, optional): If specified, the semivariogram is estimated from
+                    a random sample of the data pairs instead of all of them, for very large
+                    data sets. Pairs are drawn until each lag bin holds about sample_pairs/nlags
+                    of them (or for at most ten rounds of sample_pairs draws). Default is None.
+                random_state (int or numpy RandomState, optional): Seed or random number
+                    generator used with sample_pairs, so that the sample can be reproduced.
+                    Default is None.
                 weight (boolean, optional): Flag that specifies if semivariance at smaller lags
                     should be weighted more heavily when automatically calculating variogram model.
                     True indicates that weights will be applied. Default is False.
@@ -128,6 +160,13 @@ class OrdinaryKriging:
             the variogram fit. NOTE that ideally Q1 is close to zero,
             Q2 is close to 1, and cR is as small as possible.
 
+        cross_validate(n_closest_points=None, backend='loop', n_jobs=1): Returns the leave-one-out
+            cross-validation residuals and kriging variances at the data points.
+
+        clear_kriging_cache(): Clears the kriging matrix, its factorization and the dual weights,
+            which are cached (as kriging_matrix, kriging_matrix_factor and dual_weights) and reused
+            by execute until the variogram model is updated or the data coordinates change.
+
         execute(style, xpoints, ypoints, mask=None): Calculates a kriged grid.
             Inputs:
                 style (string): Specifies how to treat input kriging points.
@@ -156,11 +195,29 @@ class OrdinaryKriging:
                     Specifying 'loop' will loop through each point at which the kriging system
                     is to be solved. This approach is slower but also less memory-intensive.
                     Specifying 'C' will utilize a loop in Cython.
+                    Specifying 'auto' will pick the fastest of these that fits in memory (max_memory,
+                    or half of the available memory if not given) from a rough estimate of the cost,
+                    and store the choice and the estimates in backend_choice.
                     Default is 'vectorized'.
                 n_closest_points (int, optional): For kriging with a moving window, specifies the number
                     of nearby points to use in the calculation. This can speed up the calculation for large
                     datasets, but should be used with caution. As Kitanidis notes, kriging with a moving
                     window can produce unexpected oddities if the variogram model is not carefully chosen.
+                search_neighborhood (SearchNeighborhood, optional): For kriging with a moving window, the
+                    core.SearchNeighborhood that selects the data points of each point from a search radius,
+                    a minimum and maximum number of points and a maximum number of points per quadrant
+                    (octant in 3D), instead of n_closest_points. Points with fewer than its min_points data
+                    points in range are not kriged, and get NaN values and variances. Supported by the 'loop'
+                    and 'C' backends.
+                return_variance (bool, optional): If False, only the kriged values are calculated
+                    and returned, using dual kriging: the kriging system is solved once for the data
+                    values, so that each point only costs a dot product instead of a solve.
+                    Default is True.
+                max_memory (float, optional): For the vectorized and C backends, the approximate memory (in MB)
+                    that the temporary arrays may take. The points are then kriged in blocks of the
+                    largest size that fits. Default is None, which kriges all the points at once.
+                n_jobs (int, optional): Number of threads over which the points are spread with the
+                    'C' backend (requires the extension to be built with OpenMP). Default is 1.
             Outputs:
                 zvalues (numpy array, dim MxN or dim Nx1): Z-values of specified grid or at the
                     specified set of points. If style was specified as 'masked', zvalues will
@@ -168,6 +225,7 @@ class OrdinaryKriging:
                 sigmasq (numpy array, dim MxN or dim Nx1): Variance at specified grid points or
                     at the specified set of points. If style was specified as 'masked', sigmasq
                     will be a numpy masked array.
+                    Only returned if return_variance is True.
 
     References:
         P.K. Kitanidis, Introduction to Geostatistcs: Applications in Hydrogeology,
@@ -184,7 +242,8 @@ class OrdinaryKriging:
     def __init__(self, x, y, z, variogram_model='linear', variogram_parameters=None,
                  variogram_function=None, nlags=6, weight=False, anisotropy_scaling=1.0,
                  anisotropy_angle=0.0, verbose=False, enable_plotting=False,
-                 enable_statistics=False):
+                 enable_statistics=False, lag_bins=None, max_lag=None,
+                 sample_pairs=None, random_state=None):
 
         # Code assumes 1D input arrays. Ensures that any extraneous dimensions
         # don't get in the way. Copies are created to avoid any problems with
@@ -193,6 +252,7 @@ class OrdinaryKriging:
         self.Y_ORIG = np.atleast_1d(np.squeeze(np.array(y, copy=True)))
         self.Z = np.atleast_1d(np.squeeze(np.array(z, copy=True)))
 
+        self.backend_choice = None
         self.verbose = verbose
         self.enable_plotting = enable_plotting
         if self.enable_plotting and self.verbose:
@@ -209,6 +269,7 @@ class OrdinaryKriging:
                                        self.XCENTER, self.YCENTER,
                                        self.anisotropy_scaling, self.anisotropy_angle)
 
+        self.clear_kriging_cache()
         self.variogram_model = variogram_model
         if self.variogram_model not in self.variogram_dict.keys() and self.variogram_model != 'custom':
             raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
@@ -221,10 +282,12 @@ class OrdinaryKriging:
             self.variogram_function = self.variogram_dict[self.variogram_model]
         if self.verbose:
             print "Initializing variogram model..."
-        self.lags, self.semivariance, self.variogram_model_parameters = \
+        self.lags, self.semivariance, self.semivariance_error, self.variogram_model_parameters = \
             core.initialize_variogram_model(self.X_ADJUSTED, self.Y_ADJUSTED, self.Z,
                                             self.variogram_model, variogram_parameters,
-                                            self.variogram_function, nlags, weight)
+                                            self.variogram_function, nlags, weight, lag_bins=lag_bins,
+                                            max_lag=max_lag, sample_pairs=sample_pairs,
+                                            random_state=random_state)
         if self.verbose:
             if self.variogram_model == 'linear':
                 print "Using '%s' Variogram Model" % 'linear'
@@ -263,7 +326,8 @@ class OrdinaryKriging:
 
     def update_variogram_model(self, variogram_model, variogram_parameters=None,
                                variogram_function=None, nlags=6, weight=False,
-                               anisotropy_scaling=1.0, anisotropy_angle=0.0):
+                               anisotropy_scaling=1.0, anisotropy_angle=0.0, lag_bins=None,
+                               max_lag=None, sample_pairs=None, random_state=None):
         """Allows user to update variogram type and/or variogram model parameters."""
 
         if anisotropy_scaling != self.anisotropy_scaling or \
@@ -279,6 +343,7 @@ class OrdinaryKriging:
                                            self.anisotropy_scaling,
                                            self.anisotropy_angle)
 
+        self.clear_kriging_cache()
         self.variogram_model = variogram_model
         if self.variogram_model not in self.variogram_dict.keys() and self.variogram_model != 'custom':
             raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
@@ -291,10 +356,12 @@ class OrdinaryKriging:
             self.variogram_function = self.variogram_dict[self.variogram_model]
         if self.verbose:
             print "Updating variogram mode..."
-        self.lags, self.semivariance, self.variogram_model_parameters = \
+        self.lags, self.semivariance, self.semivariance_error, self.variogram_model_parameters = \
             core.initialize_variogram_model(self.X_ADJUSTED, self.Y_ADJUSTED, self.Z,
                                             self.variogram_model, variogram_parameters,
-                                            self.variogram_function, nlags, weight)
+                                            self.variogram_function, nlags, weight, lag_bins=lag_bins,
+                                            max_lag=max_lag, sample_pairs=sample_pairs,
+                                            random_state=random_state)
         if self.verbose:
             if self.variogram_model == 'linear':
                 print "Using '%s' Variogram Model" % 'linear'
@@ -365,6 +432,122 @@ class OrdinaryKriging:
         print "Q2 =", self.Q2
         print "cR =", self.cR
 
+    def cross_validate(self, n_closest_points=None, backend='loop', n_jobs=1):
+        """Leave-one-out cross-validation of the kriging model. Each data point is
+        kriged from all of the other data points; for a global model, this is done
+        for all of the points at once from a single inversion of the kriging matrix
+        (see core.leave_one_out).
+
+        Inputs:
+            n_closest_points (int, optional): For kriging with a moving window, specifies
+                the number of nearby points to use in kriging each data point (not counting
+                the point itself), as in execute. Each data point is then kriged from its own
+                neighborhood. Must be smaller than the number of data points.
+                Default is None, which uses all of the other data points.
+            backend (string, optional): For a moving window, specifies whether the
+                neighborhoods are kriged in a Python loop ('loop') or in Cython ('C'),
+                as in execute. Default is 'loop'.
+            n_jobs (int, optional): Number of threads over which the data points are
+                spread with the 'C' backend. Default is 1.
+
+        Outputs:
+            residuals (numpy array, dim N): Data values minus their kriging estimates
+                from the other data points.
+            sigmasq (numpy array, dim N): Kriging variances at the data points.
+        """
+
+        n = self.X_ADJUSTED.shape[0]
+        a = self._get_cached_kriging_matrix(n)
+        if n_closest_points is None:
+            return core.leave_one_out(self._get_cached_kriging_matrix_factor(), self.Z)
+
+        xy_data = np.concatenate((self.X_ADJUSTED[:, np.newaxis], self.Y_ADJUSTED[:, np.newaxis]), axis=1)
+        indptr, indices, distances = core._leave_one_out_neighborhoods(xy_data, n_closest_points)
+        mask = np.zeros(n, dtype='bool')
+
+        if backend == 'C':
+            try:
+                from .lib.cok import _c_exec_loop_neighborhood
+            except ImportError:
+                print('Warning: failed to load Cython extensions.\n'\
+                      '   See https://github.com/bsmurphy/PyKrige/issues/8 \n'\
+                      '   Falling back to a pure python backend...')
+                backend = 'loop'
+            except:
+                raise RuntimeError("Unknown error in trying to load Cython extension.")
+
+        if backend == 'loop':
+            zvalues, sigmasq = self._exec_loop_moving_window(a, distances, indices, indptr, mask)
+        elif backend == 'C':
+            c_pars = {key: getattr(self, key) for key in ['Z', 'eps', 'variogram_model_parameters',
+                                                          'variogram_function']}
+            indices, distances, points, group_ptr = core._neighborhood_groups(indptr, indices, distances, mask)
+            zvalues, sigmasq = _c_exec_loop_neighborhood(a, distances, indices, indptr, points, group_ptr,
+                                                         c_pars, n_jobs)
+        else:
+            raise ValueError('Specified backend {} for a moving window is not supported.'.format(backend))
+
+        return self.Z - zvalues, sigmasq
+
+    def clear_kriging_cache(self):
+        """Clears the cached kriging matrix, its factorization and the dual weights.
+        These are otherwise assembled once and reused by every call to execute; they are
+        also cleared by update_variogram_model and rebuilt if the data coordinates change."""
+        self.kriging_matrix = None
+        self.kriging_matrix_factor = None
+        self.dual_weights = None
+        self._kriging_matrix_coords = None
+
+    def _get_cached_kriging_matrix(self, n):
+        """Returns the kriging matrix, assembling it only if it is not cached."""
+
+        coords = (self.X_ADJUSTED, self.Y_ADJUSTED)
+        if self.kriging_matrix is None or \
+                not all([np.array_equal(c, c_) for c, c_ in zip(coords, self._kriging_matrix_coords)]):
+            self.clear_kriging_cache()
+            self.kriging_matrix = self._get_kriging_matrix(n)
+            self._kriging_matrix_coords = tuple([np.copy(c) for c in coords])
+
+        return self.kriging_matrix
+
+    def _get_cached_kriging_matrix_factor(self):
+        """Returns the LU factorization of the cached kriging matrix, factoring it
+        only if it is not cached."""
+
+        if self.kriging_matrix_factor is None:
+            lu, piv = scipy.linalg.lu_factor(self.kriging_matrix)
+            if np.any(np.diag(lu) == 0.0):
+                raise np.linalg.LinAlgError("Singular matrix")
+            self.kriging_matrix_factor = (lu, piv)
+
+        return self.kriging_matrix_factor
+
+    def _solve_kriging_system(self, b):
+        """Solves the kriging system for the right hand sides in the columns of b,
+        all at once, with the cached factorization of the kriging matrix. LAPACK is
+        called directly, since scipy's wrappers cost more than the solve itself
+        for one right hand side of a small system."""
+
+        lu, piv = self._get_cached_kriging_matrix_factor()
+        x, info = scipy.linalg.lapack.dgetrs(lu, piv, np.asarray(b))
+
+        return x
+
+    def _get_dual_weights(self):
+        """Solves the kriging system once for the data values (with zeros in the
+        remaining rows). The kriged value at a point is then simply the dot product
+        of these dual weights with the right hand side of the point. The weights are
+        cached with the factorization, so that the points of every block and every
+        call to execute share the one solve."""
+
+        if self.dual_weights is None:
+            n = self.X_ADJUSTED.shape[0]
+            rhs = np.zeros((self.kriging_matrix.shape[0], 1))
+            rhs[:n, 0] = self.Z
+            self.dual_weights = self._solve_kriging_system(rhs)[:, 0]
+
+        return self.dual_weights
+
     def _get_kriging_matrix(self, n):
         """Assembles the kriging matrix."""
 
@@ -379,7 +562,7 @@ class OrdinaryKriging:
 
         return a
 
-    def _exec_vector(self, a, bd, mask):
+    def _exec_vector(self, a, bd, mask, return_variance=True):
         """Solves the kriging system as a vectorized operation. This method
         can take a lot of memory for large grids and/or large datasets."""
 
@@ -388,8 +571,6 @@ class OrdinaryKriging:
         zero_index = None
         zero_value = False
 
-        a_inv = scipy.linalg.inv(a)
-
         if np.any(np.absolute(bd) <= self.eps):
             zero_value = True
             zero_index = np.where(np.absolute(bd) <= self.eps)
@@ -400,17 +581,21 @@ class OrdinaryKriging:
             b[zero_index[0], zero_index[1], 0] = 0.0
         b[:, n, 0] = 1.0
 
-        if (~mask).any():
+        if mask.any():
             mask_b = np.repeat(mask[:, np.newaxis, np.newaxis], n+1, axis=1)
             b = np.ma.array(b, mask=mask_b)
 
-        x = np.dot(a_inv, b.reshape((npt, n+1)).T).reshape((1, n+1, npt)).T
+        if not return_variance:
+            zvalues = np.dot(np.asarray(b)[:, :, 0], self._get_dual_weights())
+            return zvalues, None
+
+        x = self._solve_kriging_system(b.reshape((npt, n+1)).T).reshape((1, n+1, npt)).T
         zvalues = np.sum(x[:, :n, 0] * self.Z, axis=1)
         sigmasq = np.sum(x[:, :, 0] * -b[:, :, 0], axis=1)
 
         return zvalues, sigmasq
 
-    def _exec_loop(self, a, bd_all, mask):
+    def _exec_loop(self, a, bd_all, mask, return_variance=True):
         """Solves the kriging system by looping over all specified points.
         Less memory-intensive, but involves a Python-level loop."""
 
@@ -418,8 +603,8 @@ class OrdinaryKriging:
         n = self.X_ADJUSTED.shape[0]
         zvalues = np.zeros(npt)
         sigmasq = np.zeros(npt)
-
-        a_inv = scipy.linalg.inv(a)
+        if not return_variance:
+            w = self._get_dual_weights()
 
         for j in np.nonzero(~mask)[0]:   # Note that this is the same thing as range(npt) if mask is not defined,
             bd = bd_all[j]               # otherwise it takes the non-masked elements.
@@ -435,49 +620,51 @@ class OrdinaryKriging:
             if zero_value:
                 b[zero_index[0], 0] = 0.0
             b[n, 0] = 1.0
-            x = np.dot(a_inv, b)
+            if not return_variance:
+                zvalues[j] = np.sum(b[:, 0] * w)
+                continue
+
+            x = self._solve_kriging_system(b)
             zvalues[j] = np.sum(x[:n, 0] * self.Z)
             sigmasq[j] = np.sum(x[:, 0] * -b[:, 0])
 
         return zvalues, sigmasq
 
-    def _exec_loop_moving_window(self, a_all, bd_all, mask, bd_idx):
-        """Solves the kriging system by looping over all specified points.
-        Less memory-intensive, but involves a Python-level loop."""
-        import scipy.linalg.lapack
+    def _exec_loop_moving_window(self, a_all, distances, indices, indptr, mask):
+        """Solves the kriging system of each specified point from the data points of its
+        neighborhood, given as ragged (CSR) arrays as returned by SearchNeighborhood.query.
+        Points whose neighborhoods hold the same data points are solved together, as the
+        right hand sides of one solve (see core._neighborhood_groups).
+        Less memory-intensive, but involves a Python-level loop over the neighborhoods."""
 
-        npt = bd_all.shape[0]
-        n = bd_idx.shape[1]
+        npt = indptr.shape[0] - 1
         zvalues = np.zeros(npt)
         sigmasq = np.zeros(npt)
 
-        for i in np.nonzero(~mask)[0]:   # Note that this is the same thing as range(npt) if mask is not defined,
-            b_selector = bd_idx[i]       # otherwise it takes the non-masked elements.
-            bd = bd_all[i]
+        indices, distances, points, group_ptr = core._neighborhood_groups(indptr, indices, distances, mask)
+        for g in range(group_ptr.shape[0] - 1):
+            members = points[group_ptr[g]:group_ptr[g+1]]
+            b_selector = indices[indptr[members[0]]:indptr[members[0]+1]]
+            n = b_selector.shape[0]
 
             a_selector = np.concatenate((b_selector, np.array([a_all.shape[0] - 1])))
             a = a_all[a_selector[:, None], a_selector]
 
-            if np.any(np.absolute(bd) <= self.eps):
-                zero_value = True
-                zero_index = np.where(np.absolute(bd) <= self.eps)
-            else:
-                zero_index = None
-                zero_value = False
-            b = np.zeros((n+1, 1))
-            b[:n, 0] = - self.variogram_function(self.variogram_model_parameters, bd)
-            if zero_value:
-                b[zero_index[0], 0] = 0.0
-            b[n, 0] = 1.0
+            bd = distances[indptr[members][:, None] + np.arange(n)].T
+            b = np.zeros((n+1, members.shape[0]))
+            b[:n, :] = - self.variogram_function(self.variogram_model_parameters, bd)
+            b[:n, :][np.absolute(bd) <= self.eps] = 0.0
+            b[n, :] = 1.0
 
             x = scipy.linalg.solve(a, b)
 
-            zvalues[i] = x[:n, 0].dot(self.Z[b_selector])
-            sigmasq[i] = - x[:, 0].dot(b[:, 0])
+            zvalues[members] = x[:n, :].T.dot(self.Z[b_selector])
+            sigmasq[members] = - np.sum(x * b, axis=0)
 
         return zvalues, sigmasq
 
-    def execute(self, style, xpoints, ypoints, mask=None, backend='vectorized', n_closest_points=None):
+    def execute(self, style, xpoints, ypoints, mask=None, backend='vectorized', n_closest_points=None,
+                return_variance=True, max_memory=None, n_jobs=1, search_neighborhood=None):
         """Calculates a kriged grid and the associated variance.
 
         This is now the method that performs the main kriging calculation. Note that currently
@@ -526,11 +713,29 @@ class OrdinaryKriging:
                 Specifying 'loop' will loop through each point at which the kriging system
                 is to be solved. This approach is slower but also less memory-intensive.
                 Specifying 'C' will utilize a loop in Cython.
+                Specifying 'auto' will pick the fastest of these that fits in memory (max_memory,
+                or half of the available memory if not given) from a rough estimate of the cost,
+                and store the choice and the estimates in backend_choice.
                 Default is 'vectorized'.
             n_closest_points (int, optional): For kriging with a moving window, specifies the number
                 of nearby points to use in the calculation. This can speed up the calculation for large
                 datasets, but should be used with caution. As Kitanidis notes, kriging with a moving
                 window can produce unexpected oddities if the variogram model is not carefully chosen.
+            search_neighborhood (SearchNeighborhood, optional): For kriging with a moving window, the
+                core.SearchNeighborhood that selects the data points of each point from a search radius,
+                a minimum and maximum number of points and a maximum number of points per quadrant
+                (octant in 3D), instead of n_closest_points. Points with fewer than its min_points data
+                points in range are not kriged, and get NaN values and variances. Supported by the 'loop'
+                and 'C' backends.
+            return_variance (bool, optional): If False, only the kriged values are calculated
+                and returned, using dual kriging: the kriging system is solved once for the data
+                values, so that each point only costs a dot product instead of a solve.
+                Default is True.
+            max_memory (float, optional): For the vectorized and C backends, the approximate memory (in MB)
+                that the temporary arrays may take. The points are then kriged in blocks of the
+                largest size that fits. Default is None, which kriges all the points at once.
+            n_jobs (int, optional): Number of threads over which the points are spread with the
+                'C' backend (requires the extension to be built with OpenMP). Default is 1.
         Outputs:
             zvalues (numpy array, dim MxN or dim Nx1): Z-values of specified grid or at the
                 specified set of points. If style was specified as 'masked', zvalues will
@@ -538,6 +743,7 @@ class OrdinaryKriging:
             sigmasq (numpy array, dim MxN or dim Nx1): Variance at specified grid points or
                 at the specified set of points. If style was specified as 'masked', sigmasq
                 will be a numpy masked array.
+                Only returned if return_variance is True.
         """
 
         if self.verbose:
@@ -551,7 +757,7 @@ class OrdinaryKriging:
         n = self.X_ADJUSTED.shape[0]
         nx = xpts.size
         ny = ypts.size
-        a = self._get_kriging_matrix(n)
+        a = self._get_cached_kriging_matrix(n)
 
         if style in ['grid', 'masked']:
             if style == 'masked':
@@ -585,10 +791,29 @@ class OrdinaryKriging:
         xy_points = np.concatenate((xpts[:, np.newaxis], ypts[:, np.newaxis]), axis=1)
         xy_data = np.concatenate((self.X_ADJUSTED[:, np.newaxis], self.Y_ADJUSTED[:, np.newaxis]), axis=1)
 
+        if n_closest_points is not None and search_neighborhood is not None:
+            raise ValueError("Specify either n_closest_points or search_neighborhood, not both.")
+
+        if backend == 'auto':
+            backends = ['vectorized', 'loop'] if n_closest_points is None and search_neighborhood is None else ['loop']
+            try:
+                from .lib.cok import _c_exec_loop, _c_exec_loop_neighborhood
+                backends.append('C')
+            except ImportError:
+                pass
+            if search_neighborhood is not None:
+                n_closest_points = search_neighborhood.max_points or a.shape[0] - 1
+            self.backend_choice = core._choose_backend(backends, a.shape[0], np.sum(~mask), n_closest_points,
+                                                       max_memory, return_variance, n_jobs)
+            backend = self.backend_choice['backend']
+            max_memory = self.backend_choice['max_memory']
+            if self.verbose:
+                print "Backend chosen automatically:", backend, "\n"
+
         c_pars = None
         if backend == 'C':
             try:
-                from .lib.cok import _c_exec_loop, _c_exec_loop_moving_window
+                from .lib.cok import _c_exec_loop, _c_exec_loop_neighborhood
             except ImportError:
                 print('Warning: failed to load Cython extensions.\n'\
                       '   See https://github.com/bsmurphy/PyKrige/issues/8 \n'\
@@ -600,28 +825,60 @@ class OrdinaryKriging:
             c_pars = {key: getattr(self, key) for key in ['Z', 'eps', 'variogram_model_parameters',
                                                           'variogram_function']}
 
-        if n_closest_points is not None:
-            from scipy.spatial import cKDTree
-            tree = cKDTree(xy_data)
-            bd, bd_idx = tree.query(xy_points, k=n_closest_points, eps=0.0)
+        if search_neighborhood is not None or n_closest_points is not None:
+            if search_neighborhood is not None:
+                indptr, indices, distances = search_neighborhood.query(xy_data, xy_points)
+            else:
+                from scipy.spatial import cKDTree
+                tree = cKDTree(xy_data)
+                bd, bd_idx = tree.query(xy_points, k=n_closest_points, eps=0.0)
+                indptr = np.arange(0, bd.size + 1, n_closest_points)
+                indices = bd_idx.reshape(-1)
+                distances = bd.reshape(-1)
+            empty = indptr[1:] == indptr[:-1]
 
             if backend == 'loop':
-                zvalues, sigmasq = self._exec_loop_moving_window(a, bd, mask, bd_idx)
+                zvalues, sigmasq = self._exec_loop_moving_window(a, distances, indices, indptr, mask | empty)
             elif backend == 'C':
-                zvalues, sigmasq = _c_exec_loop_moving_window(a, bd, mask.astype('int8'),
-                                                              bd_idx, self.X_ADJUSTED.shape[0], c_pars)
+                indices, distances, points, group_ptr = core._neighborhood_groups(indptr, indices, distances,
+                                                                                  mask | empty)
+                zvalues, sigmasq = _c_exec_loop_neighborhood(a, distances, indices, indptr, points, group_ptr,
+                                                             c_pars, n_jobs)
             else:
                 raise ValueError('Specified backend {} for a moving window is not supported.'.format(backend))
-        else:
+            zvalues[empty] = np.nan
+            sigmasq[empty] = np.nan
+        elif backend == 'vectorized':
+            zvalues = np.zeros(npt)
+            sigmasq = np.zeros(npt)
+            for idx in core._point_chunks(mask, a.shape[0], max_memory):
+                bd = cdist(xy_points[idx], xy_data, 'euclidean')
+                z, ss = self._exec_vector(a, bd, mask[idx], return_variance)
+                zvalues[idx] = z
+                if return_variance:
+                    sigmasq[idx] = ss
+        elif backend == 'C':
+            zvalues = np.zeros(npt)
+            sigmasq = np.zeros(npt)
+            c_pars['lu'] = self._get_cached_kriging_matrix_factor()
+            for idx in core._point_chunks(mask, a.shape[0], max_memory):
+                bd = cdist(xy_points[idx], xy_data, 'euclidean')
+                z, ss = _c_exec_loop(a, bd, np.zeros(idx.size, dtype='int8'), self.X_ADJUSTED.shape[0], c_pars,
+                                     n_jobs, return_variance)
+                zvalues[idx] = z
+                sigmasq[idx] = ss
+        elif backend == 'loop':
             bd = cdist(xy_points,  xy_data, 'euclidean')
-            if backend == 'vectorized':
-                zvalues, sigmasq = self._exec_vector(a, bd, mask)
-            elif backend == 'loop':
-                zvalues, sigmasq = self._exec_loop(a, bd, mask)
-            elif backend == 'C':
-                zvalues, sigmasq = _c_exec_loop(a, bd, mask.astype('int8'), self.X_ADJUSTED.shape[0],  c_pars)
-            else:
-                raise ValueError('Specified backend {} is not supported for 2D ordinary kriging.'.format(backend))
+            zvalues, sigmasq = self._exec_loop(a, bd, mask, return_variance)
+        else:
+            raise ValueError('Specified backend {} is not supported for 2D ordinary kriging.'.format(backend))
+
+        if not return_variance:
+            if style == 'masked':
+                zvalues = np.ma.array(zvalues, mask=mask)
+            if style in ['masked', 'grid']:
+                zvalues = zvalues.reshape((ny, nx))
+            return zvalues
 
         if style == 'masked':
             zvalues = np.ma.array(zvalues, mask=mask)
@@ -65,6 +65,22 @@ class OrdinaryKriging3D:
             variogram_parameters will be passed to the function as the first argument.
         nlags (int, optional): Number of averaging bins for the semivariogram.
             Default is 6.
+        lag_bins (string or array-like, optional): Specifies the semivariogram lag bins.
+            'linear' gives nlags bins of equal width and 'geometric' gives nlags bins
+            whose widths grow by a constant factor; an array of bin edges may also be
+            given, in which case nlags is ignored. Default is None, which also gives
+            bins of equal width.
+        max_lag (float, optional): Largest separation distance of the data pairs used
+            to calculate the semivariogram. Only the pairs within max_lag are looked up
+            (with a KD-tree), which saves time and memory for large data sets.
+            Default is None, which uses all of the data pairs.
+        sample_pairs (int, optional): If specified, the semivariogram is estimated from
+            a random sample of the data pairs instead of all of them, for very large
+            data sets. Pairs are drawn until each lag bin holds about sample_pairs/nlags
+            of them (or for at most ten rounds of sample_pairs draws). Default is None.
+        random_state (int or numpy RandomState, optional): Seed or random number
+            generator used with sample_pairs, so that the sample can be reproduced.
+            Default is None.
         weight (boolean, optional): Flag that specifies if semivariance at smaller lags
             should be weighted more heavily when automatically calculating variogram model.
             True indicates that weights will be applied. Default is False.
@@ -116,6 +132,22 @@ class OrdinaryKriging3D:
                     more information.
                 nlags (int, optional): Number of averaging bins for the semivariogram.
                     Defualt is 6.
+                lag_bins (string or array-like, optional): Specifies the semivariogram lag bins.
+                    'linear' gives nlags bins of equal width and 'geometric' gives nlags bins
+                    whose widths grow by a constant factor; an array of bin edges may also be
+                    given, in which case nlags is ignored. Default is None, which also gives
+                    bins of equal width.
+                max_lag (float, optional): Largest separation distance of the data pairs used
+                    to calculate the semivariogram. Only the pairs within max_lag are looked up
+                    (with a KD-tree), which saves time and memory for large data sets.
+                    Default is None, which uses all of the data pairs.
+                sample_pairs (int, optional): If specified, the semivariogram is estimated from
+                    a random sample of the data pairs instead of all of them, for very large
+                    data sets. Pairs are drawn until each lag bin holds about sample_pairs/nlags
+                    of them (or for at most ten rounds of sample_pairs draws). Default is None.
+                random_state (int or numpy RandomState, optional): Seed or random number
+                    generator used with sample_pairs, so that the sample can be reproduced.
+                    Default is None.
                 weight (boolean, optional): Flag that specifies if semivariance at smaller lags
                     should be weighted more heavily when automatically calculating variogram model.
                     True indicates that weights will be applied. Default is False.
@@ -141,6 +173,13 @@ class OrdinaryKriging3D:
             the variogram fit. NOTE that ideally Q1 is close to zero,
             Q2 is close to 1, and cR is as small as possible.
 
+        cross_validate(n_closest_points=None, backend='loop', n_jobs=1): Returns the leave-one-out
+            cross-validation residuals and kriging variances at the data points.
+
+        clear_kriging_cache(): Clears the kriging matrix, its factorization and the dual weights,
+            which are cached (as kriging_matrix, kriging_matrix_factor and dual_weights) and reused
+            by execute until the variogram model is updated or the data coordinates change.
+
         execute(style, xpoints, ypoints, mask=None): Calculates a kriged grid.
             Inputs:
                 style (string): Specifies how to treat input kriging points.
@@ -175,7 +214,31 @@ class OrdinaryKriging3D:
                     significant amount of memory for large grids and/or large datasets.
                     Specifying 'loop' will loop through each point at which the kriging system
                     is to be solved. This approach is slower but also less memory-intensive.
+                    Specifying 'C' will utilize a loop in Cython.
+                    Specifying 'auto' will pick the fastest of these that fits in memory (max_memory,
+                    or half of the available memory if not given) from a rough estimate of the cost,
+                    and store the choice and the estimates in backend_choice.
                     Default is 'vectorized'.
+                n_closest_points (int, optional): For kriging with a moving window, specifies the number
+                    of nearby points to use in the calculation. The points are found with a 3D KD-tree over
+                    the anisotropy-adjusted coordinates. This can speed up the calculation for large
+                    datasets, but should be used with caution. As Kitanidis notes, kriging with a moving
+                    window can produce unexpected oddities if the variogram model is not carefully chosen.
+                search_neighborhood (SearchNeighborhood, optional): For kriging with a moving window, the
+                    core.SearchNeighborhood that selects the data points of each point from a search radius,
+                    a minimum and maximum number of points and a maximum number of points per quadrant
+                    (octant in 3D), instead of n_closest_points. Points with fewer than its min_points data
+                    points in range are not kriged, and get NaN values and variances. Supported by the 'loop'
+                    and 'C' backends.
+                return_variance (bool, optional): If False, only the kriged values are calculated
+                    and returned, using dual kriging: the kriging system is solved once for the data
+                    values, so that each point only costs a dot product instead of a solve.
+                    Default is True.
+                max_memory (float, optional): For the vectorized and C backends, the approximate memory (in MB)
+                    that the temporary arrays may take. The points are then kriged in blocks of the
+                    largest size that fits. Default is None, which kriges all the points at once.
+                n_jobs (int, optional): Number of threads over which the points are spread with the
+                    'C' backend (requires the extension to be built with OpenMP). Default is 1.
             Outputs:
                 kvalues (numpy array, dim LxMxN or dim Nx1): Interpolated values of specified grid
                     or at the specified set of points. If style was specified as 'masked',
@@ -183,6 +246,7 @@ class OrdinaryKriging3D:
                 sigmasq (numpy array, dim LxMxN or dim Nx1): Variance at specified grid points or
                     at the specified set of points. If style was specified as 'masked', sigmasq
                     will be a numpy masked array.
+                    Only returned if return_variance is True.
 
     References:
         P.K. Kitanidis, Introduction to Geostatistcs: Applications in Hydrogeology,
@@ -199,7 +263,8 @@ class OrdinaryKriging3D:
     def __init__(self, x, y, z, val, variogram_model='linear', variogram_parameters=None,
                  variogram_function=None, nlags=6, weight=False, anisotropy_scaling_y=1.0,
                  anisotropy_scaling_z=1.0, anisotropy_angle_x=0.0, anisotropy_angle_y=0.0,
-                 anisotropy_angle_z=0.0, verbose=False, enable_plotting=False):
+                 anisotropy_angle_z=0.0, verbose=False, enable_plotting=False, lag_bins=None,
+                 max_lag=None, sample_pairs=None, random_state=None):
 
         # Code assumes 1D input arrays. Ensures that any extraneous dimensions
         # don't get in the way. Copies are created to avoid any problems with
@@ -209,6 +274,7 @@ class OrdinaryKriging3D:
         self.Z_ORIG = np.atleast_1d(np.squeeze(np.array(z, copy=True)))
         self.VALUES = np.atleast_1d(np.squeeze(np.array(val, copy=True)))
 
+        self.backend_choice = None
         self.verbose = verbose
         self.enable_plotting = enable_plotting
         if self.enable_plotting and self.verbose:
@@ -230,6 +296,7 @@ class OrdinaryKriging3D:
                                           self.anisotropy_scaling_z, self.anisotropy_angle_x, self.anisotropy_angle_y,
                                           self.anisotropy_angle_z)
 
+        self.clear_kriging_cache()
         self.variogram_model = variogram_model
         if self.variogram_model not in self.variogram_dict.keys() and self.variogram_model != 'custom':
             raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
@@ -242,10 +309,11 @@ class OrdinaryKriging3D:
             self.variogram_function = self.variogram_dict[self.variogram_model]
         if self.verbose:
             print "Initializing variogram model..."
-        self.lags, self.semivariance, self.variogram_model_parameters = \
+        self.lags, self.semivariance, self.semivariance_error, self.variogram_model_parameters = \
             core.initialize_variogram_model_3d(self.X_ADJUSTED, self.Y_ADJUSTED, self.Z_ADJUSTED, self.VALUES,
                                                self.variogram_model, variogram_parameters, self.variogram_function,
-                                               nlags, weight)
+                                               nlags, weight, lag_bins=lag_bins, max_lag=max_lag,
+                                               sample_pairs=sample_pairs, random_state=random_state)
         if self.verbose:
             if self.variogram_model == 'linear':
                 print "Using '%s' Variogram Model" % 'linear'
@@ -282,7 +350,8 @@ class OrdinaryKriging3D:
 
     def update_variogram_model(self, variogram_model, variogram_parameters=None, variogram_function=None,
                                nlags=6, weight=False, anisotropy_scaling_y=1.0, anisotropy_scaling_z=1.0,
-                               anisotropy_angle_x=0.0, anisotropy_angle_y=0.0, anisotropy_angle_z=0.0):
+                               anisotropy_angle_x=0.0, anisotropy_angle_y=0.0, anisotropy_angle_z=0.0,
+                               lag_bins=None, max_lag=None, sample_pairs=None, random_state=None):
         """Allows user to update variogram type and/or variogram model parameters."""
 
         if anisotropy_scaling_y != self.anisotropy_scaling_y or anisotropy_scaling_z != self.anisotropy_scaling_z or \
@@ -301,6 +370,7 @@ class OrdinaryKriging3D:
                                               self.anisotropy_scaling_z, self.anisotropy_angle_x,
                                               self.anisotropy_angle_y, self.anisotropy_angle_z)
 
+        self.clear_kriging_cache()
         self.variogram_model = variogram_model
         if self.variogram_model not in self.variogram_dict.keys() and self.variogram_model != 'custom':
             raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
@@ -313,10 +383,11 @@ class OrdinaryKriging3D:
             self.variogram_function = self.variogram_dict[self.variogram_model]
         if self.verbose:
             print "Updating variogram mode..."
-        self.lags, self.semivariance, self.variogram_model_parameters = \
+        self.lags, self.semivariance, self.semivariance_error, self.variogram_model_parameters = \
             core.initialize_variogram_model_3d(self.X_ADJUSTED, self.Y_ADJUSTED, self.Z_ADJUSTED, self.VALUES,
                                                self.variogram_model, variogram_parameters, self.variogram_function,
-                                               nlags, weight)
+                                               nlags, weight, lag_bins=lag_bins, max_lag=max_lag,
+                                               sample_pairs=sample_pairs, random_state=random_state)
         if self.verbose:
             if self.variogram_model == 'linear':
                 print "Using '%s' Variogram Model" % 'linear'
@@ -388,6 +459,123 @@ class OrdinaryKriging3D:
         print "Q2 =", self.Q2
         print "cR =", self.cR
 
+    def cross_validate(self, n_closest_points=None, backend='loop', n_jobs=1):
+        """Leave-one-out cross-validation of the kriging model. Each data point is
+        kriged from all of the other data points; for a global model, this is done
+        for all of the points at once from a single inversion of the kriging matrix
+        (see core.leave_one_out).
+
+        Inputs:
+            n_closest_points (int, optional): For kriging with a moving window, specifies
+                the number of nearby points to use in kriging each data point (not counting
+                the point itself), as in execute. Each data point is then kriged from its own
+                neighborhood. Must be smaller than the number of data points.
+                Default is None, which uses all of the other data points.
+            backend (string, optional): For a moving window, specifies whether the
+                neighborhoods are kriged in a Python loop ('loop') or in Cython ('C'),
+                as in execute. Default is 'loop'.
+            n_jobs (int, optional): Number of threads over which the data points are
+                spread with the 'C' backend. Default is 1.
+
+        Outputs:
+            residuals (numpy array, dim N): Data values minus their kriging estimates
+                from the other data points.
+            sigmasq (numpy array, dim N): Kriging variances at the data points.
+        """
+
+        n = self.X_ADJUSTED.shape[0]
+        a = self._get_cached_kriging_matrix(n)
+        if n_closest_points is None:
+            return core.leave_one_out(self._get_cached_kriging_matrix_factor(), self.VALUES)
+
+        xyz_data = np.concatenate((self.Z_ADJUSTED[:, np.newaxis], self.Y_ADJUSTED[:, np.newaxis],
+                                   self.X_ADJUSTED[:, np.newaxis]), axis=1)
+        indptr, indices, distances = core._leave_one_out_neighborhoods(xyz_data, n_closest_points)
+        mask = np.zeros(n, dtype='bool')
+
+        if backend == 'C':
+            try:
+                from .lib.cok import _c_exec_loop_neighborhood
+            except ImportError:
+                print('Warning: failed to load Cython extensions.\n'\
+                      '   See https://github.com/bsmurphy/PyKrige/issues/8 \n'\
+                      '   Falling back to a pure python backend...')
+                backend = 'loop'
+            except:
+                raise RuntimeError("Unknown error in trying to load Cython extension.")
+
+        if backend == 'loop':
+            kvalues, sigmasq = self._exec_loop_moving_window(a, distances, indices, indptr, mask)
+        elif backend == 'C':
+            c_pars = {'Z': self.VALUES, 'eps': self.eps, 'variogram_function': self.variogram_function,
+                      'variogram_model_parameters': self.variogram_model_parameters}
+            indices, distances, points, group_ptr = core._neighborhood_groups(indptr, indices, distances, mask)
+            kvalues, sigmasq = _c_exec_loop_neighborhood(a, distances, indices, indptr, points, group_ptr,
+                                                         c_pars, n_jobs)
+        else:
+            raise ValueError('Specified backend {} for a moving window is not supported.'.format(backend))
+
+        return self.VALUES - kvalues, sigmasq
+
+    def clear_kriging_cache(self):
+        """Clears the cached kriging matrix, its factorization and the dual weights.
+        These are otherwise assembled once and reused by every call to execute; they are
+        also cleared by update_variogram_model and rebuilt if the data coordinates change."""
+        self.kriging_matrix = None
+        self.kriging_matrix_factor = None
+        self.dual_weights = None
+        self._kriging_matrix_coords = None
+
+    def _get_cached_kriging_matrix(self, n):
+        """Returns the kriging matrix, assembling it only if it is not cached."""
+
+        coords = (self.X_ADJUSTED, self.Y_ADJUSTED, self.Z_ADJUSTED)
+        if self.kriging_matrix is None or \
+                not all([np.array_equal(c, c_) for c, c_ in zip(coords, self._kriging_matrix_coords)]):
+            self.clear_kriging_cache()
+            self.kriging_matrix = self._get_kriging_matrix(n)
+            self._kriging_matrix_coords = tuple([np.copy(c) for c in coords])
+
+        return self.kriging_matrix
+
+    def _get_cached_kriging_matrix_factor(self):
+        """Returns the LU factorization of the cached kriging matrix, factoring it
+        only if it is not cached."""
+
+        if self.kriging_matrix_factor is None:
+            lu, piv = scipy.linalg.lu_factor(self.kriging_matrix)
+            if np.any(np.diag(lu) == 0.0):
+                raise np.linalg.LinAlgError("Singular matrix")
+            self.kriging_matrix_factor = (lu, piv)
+
+        return self.kriging_matrix_factor
+
+    def _solve_kriging_system(self, b):
+        """Solves the kriging system for the right hand sides in the columns of b,
+        all at once, with the cached factorization of the kriging matrix. LAPACK is
+        called directly, since scipy's wrappers cost more than the solve itself
+        for one right hand side of a small system."""
+
+        lu, piv = self._get_cached_kriging_matrix_factor()
+        x, info = scipy.linalg.lapack.dgetrs(lu, piv, np.asarray(b))
+
+        return x
+
+    def _get_dual_weights(self):
+        """Solves the kriging system once for the data values (with zeros in the
+        remaining rows). The kriged value at a point is then simply the dot product
+        of these dual weights with the right hand side of the point. The weights are
+        cached with the factorization, so that the points of every block and every
+        call to execute share the one solve."""
+
+        if self.dual_weights is None:
+            n = self.X_ADJUSTED.shape[0]
+            rhs = np.zeros((self.kriging_matrix.shape[0], 1))
+            rhs[:n, 0] = self.VALUES
+            self.dual_weights = self._solve_kriging_system(rhs)[:, 0]
+
+        return self.dual_weights
+
     def _get_kriging_matrix(self, n):
         """Assembles the kriging matrix."""
 
@@ -403,7 +591,7 @@ class OrdinaryKriging3D:
 
         return a
 
-    def _exec_vector(self, a, bd, mask):
+    def _exec_vector(self, a, bd, mask, return_variance=True):
         """Solves the kriging system as a vectorized operation. This method
         can take a lot of memory for large grids and/or large datasets."""
 
@@ -412,8 +600,6 @@ class OrdinaryKriging3D:
         zero_index = None
         zero_value = False
 
-        a_inv = scipy.linalg.inv(a)
-
         if np.any(np.absolute(bd) <= self.eps):
             zero_value = True
             zero_index = np.where(np.absolute(bd) <= self.eps)
@@ -424,17 +610,21 @@ class OrdinaryKriging3D:
             b[zero_index[0], zero_index[1], 0] = 0.0
         b[:, n, 0] = 1.0
 
-        if (~mask).any():
+        if mask.any():
             mask_b = np.repeat(mask[:, np.newaxis, np.newaxis], n+1, axis=1)
             b = np.ma.array(b, mask=mask_b)
 
-        x = np.dot(a_inv, b.reshape((npt, n+1)).T).reshape((1, n+1, npt)).T
+        if not return_variance:
+            kvalues = np.dot(np.asarray(b)[:, :, 0], self._get_dual_weights())
+            return kvalues, None
+
+        x = self._solve_kriging_system(b.reshape((npt, n+1)).T).reshape((1, n+1, npt)).T
         kvalues = np.sum(x[:, :n, 0] * self.VALUES, axis=1)
         sigmasq = np.sum(x[:, :, 0] * -b[:, :, 0], axis=1)
 
         return kvalues, sigmasq
 
-    def _exec_loop(self, a, bd_all, mask):
+    def _exec_loop(self, a, bd_all, mask, return_variance=True):
         """Solves the kriging system by looping over all specified points.
         Less memory-intensive, but involves a Python-level loop."""
 
@@ -442,8 +632,8 @@ class OrdinaryKriging3D:
         n = self.X_ADJUSTED.shape[0]
         kvalues = np.zeros(npt)
         sigmasq = np.zeros(npt)
-
-        a_inv = scipy.linalg.inv(a)
+        if not return_variance:
+            w = self._get_dual_weights()
 
         for j in np.nonzero(~mask)[0]:   # Note that this is the same thing as range(npt) if mask is not defined,
             bd = bd_all[j]               # otherwise it takes the non-masked elements.
@@ -460,13 +650,51 @@ class OrdinaryKriging3D:
                 b[zero_index[0], 0] = 0.0
             b[n, 0] = 1.0
 
-            x = np.dot(a_inv, b)
+            if not return_variance:
+                kvalues[j] = np.sum(b[:, 0] * w)
+                continue
+
+            x = self._solve_kriging_system(b)
             kvalues[j] = np.sum(x[:n, 0] * self.VALUES)
             sigmasq[j] = np.sum(x[:, 0] * -b[:, 0])
 
         return kvalues, sigmasq
 
-    def execute(self, style, xpoints, ypoints, zpoints, mask=None, backend='vectorized'):
+    def _exec_loop_moving_window(self, a_all, distances, indices, indptr, mask):
+        """Solves the kriging system of each specified point from the data points of its
+        neighborhood, given as ragged (CSR) arrays as returned by SearchNeighborhood.query.
+        Points whose neighborhoods hold the same data points are solved together, as the
+        right hand sides of one solve (see core._neighborhood_groups).
+        Less memory-intensive, but involves a Python-level loop over the neighborhoods."""
+
+        npt = indptr.shape[0] - 1
+        kvalues = np.zeros(npt)
+        sigmasq = np.zeros(npt)
+
+        indices, distances, points, group_ptr = core._neighborhood_groups(indptr, indices, distances, mask)
+        for g in range(group_ptr.shape[0] - 1):
+            members = points[group_ptr[g]:group_ptr[g+1]]
+            b_selector = indices[indptr[members[0]]:indptr[members[0]+1]]
+            n = b_selector.shape[0]
+
+            a_selector = np.concatenate((b_selector, np.array([a_all.shape[0] - 1])))
+            a = a_all[a_selector[:, None], a_selector]
+
+            bd = distances[indptr[members][:, None] + np.arange(n)].T
+            b = np.zeros((n+1, members.shape[0]))
+            b[:n, :] = - self.variogram_function(self.variogram_model_parameters, bd)
+            b[:n, :][np.absolute(bd) <= self.eps] = 0.0
+            b[n, :] = 1.0
+
+            x = scipy.linalg.solve(a, b)
+
+            kvalues[members] = x[:n, :].T.dot(self.VALUES[b_selector])
+            sigmasq[members] = - np.sum(x * b, axis=0)
+
+        return kvalues, sigmasq
+
+    def execute(self, style, xpoints, ypoints, zpoints, mask=None, backend='vectorized', n_closest_points=None,
+                return_variance=True, max_memory=None, n_jobs=1, search_neighborhood=None):
         """Calculates a kriged grid and the associated variance.
 
         This is now the method that performs the main kriging calculation. Note that currently
@@ -519,7 +747,31 @@ class OrdinaryKriging3D:
                 significant amount of memory for large grids and/or large datasets.
                 Specifying 'loop' will loop through each point at which the kriging system
                 is to be solved. This approach is slower but also less memory-intensive.
+                Specifying 'C' will utilize a loop in Cython.
+                Specifying 'auto' will pick the fastest of these that fits in memory (max_memory,
+                or half of the available memory if not given) from a rough estimate of the cost,
+                and store the choice and the estimates in backend_choice.
                 Default is 'vectorized'.
+            n_closest_points (int, optional): For kriging with a moving window, specifies the number
+                of nearby points to use in the calculation. The points are found with a 3D KD-tree over
+                the anisotropy-adjusted coordinates. This can speed up the calculation for large
+                datasets, but should be used with caution. As Kitanidis notes, kriging with a moving
+                window can produce unexpected oddities if the variogram model is not carefully chosen.
+            search_neighborhood (SearchNeighborhood, optional): For kriging with a moving window, the
+                core.SearchNeighborhood that selects the data points of each point from a search radius,
+                a minimum and maximum number of points and a maximum number of points per quadrant
+                (octant in 3D), instead of n_closest_points. Points with fewer than its min_points data
+                points in range are not kriged, and get NaN values and variances. Supported by the 'loop'
+                and 'C' backends.
+            return_variance (bool, optional): If False, only the kriged values are calculated
+                and returned, using dual kriging: the kriging system is solved once for the data
+                values, so that each point only costs a dot product instead of a solve.
+                Default is True.
+            max_memory (float, optional): For the vectorized and C backends, the approximate memory (in MB)
+                that the temporary arrays may take. The points are then kriged in blocks of the
+                largest size that fits. Default is None, which kriges all the points at once.
+            n_jobs (int, optional): Number of threads over which the points are spread with the
+                'C' backend (requires the extension to be built with OpenMP). Default is 1.
         Outputs:
             kvalues (numpy array, dim LxMxN or dim Nx1): Interpolated values of specified grid
                 or at the specified set of points. If style was specified as 'masked',
@@ -527,6 +779,7 @@ class OrdinaryKriging3D:
             sigmasq (numpy array, dim LxMxN or dim Nx1): Variance at specified grid points or
                 at the specified set of points. If style was specified as 'masked', sigmasq
                 will be a numpy masked array.
+                Only returned if return_variance is True.
         """
 
         if self.verbose:
@@ -542,7 +795,7 @@ class OrdinaryKriging3D:
         nx = xpts.size
         ny = ypts.size
         nz = zpts.size
-        a = self._get_kriging_matrix(n)
+        a = self._get_cached_kriging_matrix(n)
 
         if style in ['grid', 'masked']:
             if style == 'masked':
@@ -580,15 +833,95 @@ class OrdinaryKriging3D:
         xyz_points = np.concatenate((zpts[:, np.newaxis], ypts[:, np.newaxis], xpts[:, np.newaxis]), axis=1)
         xyz_data = np.concatenate((self.Z_ADJUSTED[:, np.newaxis], self.Y_ADJUSTED[:, np.newaxis],
                                    self.X_ADJUSTED[:, np.newaxis]), axis=1)
-        bd = cdist(xyz_points, xyz_data, 'euclidean')
 
-        if backend == 'vectorized':
-            kvalues, sigmasq = self._exec_vector(a, bd, mask)
+        if n_closest_points is not None and search_neighborhood is not None:
+            raise ValueError("Specify either n_closest_points or search_neighborhood, not both.")
+
+        if backend == 'auto':
+            backends = ['vectorized', 'loop'] if n_closest_points is None and search_neighborhood is None else ['loop']
+            try:
+                from .lib.cok import _c_exec_loop, _c_exec_loop_neighborhood
+                backends.append('C')
+            except ImportError:
+                pass
+            if search_neighborhood is not None:
+                n_closest_points = search_neighborhood.max_points or a.shape[0] - 1
+            self.backend_choice = core._choose_backend(backends, a.shape[0], np.sum(~mask), n_closest_points,
+                                                       max_memory, return_variance, n_jobs)
+            backend = self.backend_choice['backend']
+            max_memory = self.backend_choice['max_memory']
+            if self.verbose:
+                print "Backend chosen automatically:", backend, "\n"
+
+        c_pars = None
+        if backend == 'C':
+            try:
+                from .lib.cok import _c_exec_loop, _c_exec_loop_neighborhood
+            except ImportError:
+                print('Warning: failed to load Cython extensions.\n'\
+                      '   See https://github.com/bsmurphy/PyKrige/issues/8 \n'\
+                      '   Falling back to a pure python backend...')
+                backend = 'loop'
+            except:
+                raise RuntimeError("Unknown error in trying to load Cython extension.")
+            c_pars = {'Z': self.VALUES, 'eps': self.eps, 'variogram_function': self.variogram_function,
+                      'variogram_model_parameters': self.variogram_model_parameters}
+
+        if search_neighborhood is not None or n_closest_points is not None:
+            if search_neighborhood is not None:
+                indptr, indices, distances = search_neighborhood.query(xyz_data, xyz_points)
+            else:
+                from scipy.spatial import cKDTree
+                tree = cKDTree(xyz_data)
+                bd, bd_idx = tree.query(xyz_points, k=n_closest_points, eps=0.0)
+                indptr = np.arange(0, bd.size + 1, n_closest_points)
+                indices = bd_idx.reshape(-1)
+                distances = bd.reshape(-1)
+            empty = indptr[1:] == indptr[:-1]
+
+            if backend == 'loop':
+                kvalues, sigmasq = self._exec_loop_moving_window(a, distances, indices, indptr, mask | empty)
+            elif backend == 'C':
+                indices, distances, points, group_ptr = core._neighborhood_groups(indptr, indices, distances,
+                                                                                  mask | empty)
+                kvalues, sigmasq = _c_exec_loop_neighborhood(a, distances, indices, indptr, points, group_ptr,
+                                                             c_pars, n_jobs)
+            else:
+                raise ValueError('Specified backend {} for a moving window is not supported.'.format(backend))
+            kvalues[empty] = np.nan
+            sigmasq[empty] = np.nan
+        elif backend == 'vectorized':
+            kvalues = np.zeros(npt)
+            sigmasq = np.zeros(npt)
+            for idx in core._point_chunks(mask, a.shape[0], max_memory):
+                bd = cdist(xyz_points[idx], xyz_data, 'euclidean')
+                k, ss = self._exec_vector(a, bd, mask[idx], return_variance)
+                kvalues[idx] = k
+                if return_variance:
+                    sigmasq[idx] = ss
         elif backend == 'loop':
-            kvalues, sigmasq = self._exec_loop(a, bd, mask)
+            bd = cdist(xyz_points, xyz_data, 'euclidean')
+            kvalues, sigmasq = self._exec_loop(a, bd, mask, return_variance)
+        elif backend == 'C':
+            # the kernels of OrdinaryKriging only see distances, so they serve 3D as well
+            kvalues = np.zeros(npt)
+            sigmasq = np.zeros(npt)
+            c_pars['lu'] = self._get_cached_kriging_matrix_factor()
+            for idx in core._point_chunks(mask, a.shape[0], max_memory):
+                bd = cdist(xyz_points[idx], xyz_data, 'euclidean')
+                k, ss = _c_exec_loop(a, bd, np.zeros(idx.size, dtype='int8'), n, c_pars, n_jobs, return_variance)
+                kvalues[idx] = k
+                sigmasq[idx] = ss
         else:
             raise ValueError('Specified backend {} is not supported for 3D ordinary kriging.'.format(backend))
 
+        if not return_variance:
+            if style == 'masked':
+                kvalues = np.ma.array(kvalues, mask=mask)
+            if style in ['masked', 'grid']:
+                kvalues = kvalues.reshape((nz, ny, nx))
+            return kvalues
+
         if style == 'masked':
             kvalues = np.ma.array(kvalues, mask=mask)
             sigmasq = np.ma.array(sigmasq, mask=mask)
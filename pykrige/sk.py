@@ -65,6 +65,22 @@ class SimpleKriging:
             variogram_parameters will be passed to the function as the first argument.
         nlags (int, optional): Number of averaging bins for the semivariogram.
             Default is 6.
+        lag_bins (string or array-like, optional): Specifies the semivariogram lag bins.
+            'linear' gives nlags bins of equal width and 'geometric' gives nlags bins
+            whose widths grow by a constant factor; an array of bin edges may also be
+            given, in which case nlags is ignored. Default is None, which halves
+            the bin widths toward the shortest lags.
+        max_lag (float, optional): Largest separation distance of the data pairs used
+            to calculate the semivariogram. Only the pairs within max_lag are looked up
+            (with a KD-tree), which saves time and memory for large data sets.
+            Default is None, which uses all of the data pairs.
+        sample_pairs (int, optional): If specified, the semivariogram is estimated from
+            a random sample of the data pairs instead of all of them, for very large
+            data sets. Pairs are drawn until each lag bin holds about sample_pairs/nlags
+            of them (or for at most ten rounds of sample_pairs draws). Default is None.
+        random_state (int or numpy RandomState, optional): Seed or random number
+            generator used with sample_pairs, so that the sample can be reproduced.
+            Default is None.
         weight (int, optional): If weight=1, semivariance at smaller lags
             is weighted more heavily when automatically calculating variogram model.  The
             weight is 1/lag.  If weight=2, then fit is weighted by the error in the estimate 
@@ -103,6 +119,22 @@ class SimpleKriging:
                     more information.
                 nlags (int, optional): Number of averaging bins for the semivariogram.
                     Defualt is 6.
+                lag_bins (string or array-like, optional): Specifies the semivariogram lag bins.
+                    'linear' gives nlags bins of equal width and 'geometric' gives nlags bins
+                    whose widths grow by a constant factor; an array of bin edges may also be
+                    given, in which case nlags is ignored. Default is None, which halves
+                    the bin widths toward the shortest lags.
+                max_lag (float, optional): Largest separation distance of the data pairs used
+                    to calculate the semivariogram. Only the pairs within max_lag are looked up
+                    (with a KD-tree), which saves time and memory for large data sets.
+                    Default is None, which uses all of the data pairs.
+                sample_pairs (int, optional): If specified, the semivariogram is estimated from
+                    a random sample of the data pairs instead of all of them, for very large
+                    data sets. Pairs are drawn until each lag bin holds about sample_pairs/nlags
+                    of them (or for at most ten rounds of sample_pairs draws). Default is None.
+                random_state (int or numpy RandomState, optional): Seed or random number
+                    generator used with sample_pairs, so that the sample can be reproduced.
+                    Default is None.
                 weight (int, optional): If weight=1, semivariance at smaller lags
                     is weighted more heavily when automatically calculating variogram model.  The
                     weight is 1/lag.  If weight=2, then fit is weighted by the error in the estimate 
@@ -130,6 +162,10 @@ class SimpleKriging:
             the variogram fit. NOTE that ideally Q1 is close to zero,
             Q2 is close to 1, and cR is as small as possible.
 
+        clear_kriging_cache(): Clears the kriging matrix, its factorization and the dual weights,
+            which are cached (as kriging_matrix, kriging_matrix_factor and dual_weights) and reused
+            by execute until the variogram model is updated or the data coordinates change.
+
         execute(style, xpoints, ypoints, mask=None): Calculates a kriged grid.
             Inputs:
                 style (string): Specifies how to treat input kriging points.
@@ -158,11 +194,29 @@ class SimpleKriging:
                     Specifying 'loop' will loop through each point at which the kriging system
                     is to be solved. This approach is slower but also less memory-intensive.
                     Specifying 'C' will utilize a loop in Cython.
+                    Specifying 'auto' will pick the fastest of these that fits in memory (max_memory,
+                    or half of the available memory if not given) from a rough estimate of the cost,
+                    and store the choice and the estimates in backend_choice.
                     Default is 'vectorized'.
                 n_closest_points (int, optional): For kriging with a moving window, specifies the number
                     of nearby points to use in the calculation. This can speed up the calculation for large
                     datasets, but should be used with caution. As Kitanidis notes, kriging with a moving
                     window can produce unexpected oddities if the variogram model is not carefully chosen.
+                search_neighborhood (SearchNeighborhood, optional): For kriging with a moving window, the
+                    core.SearchNeighborhood that selects the data points of each point from a search radius,
+                    a minimum and maximum number of points and a maximum number of points per quadrant
+                    (octant in 3D), instead of n_closest_points. Points with fewer than its min_points data
+                    points in range are not kriged, and get NaN values and variances. Supported by the 'loop'
+                    and 'C' backends.
+                return_variance (bool, optional): If False, only the kriged values are calculated
+                    and returned, using dual kriging: the kriging system is solved once for the data
+                    values, so that each point only costs a dot product instead of a solve.
+                    Default is True.
+                max_memory (float, optional): For the vectorized and C backends, the approximate memory (in MB)
+                    that the temporary arrays may take. The points are then kriged in blocks of the
+                    largest size that fits. Default is None, which kriges all the points at once.
+                n_jobs (int, optional): Number of threads over which the points are spread with the
+                    'C' backend (requires the extension to be built with OpenMP). Default is 1.
             Outputs:
                 zvalues (numpy array, dim MxN or dim Nx1): Z-values of specified grid or at the
                     specified set of points. If style was specified as 'masked', zvalues will
@@ -170,6 +224,7 @@ class SimpleKriging:
                 sigmasq (numpy array, dim MxN or dim Nx1): Variance at specified grid points or
                     at the specified set of points. If style was specified as 'masked', sigmasq
                     will be a numpy masked array.
+                    Only returned if return_variance is True.
 
     References:
         P.K. Kitanidis, Introduction to Geostatistcs: Applications in Hydrogeology,
@@ -186,7 +241,8 @@ class SimpleKriging:
     def __init__(self, x, y, z, variogram_model='linear', variogram_parameters=None,
                  variogram_function=None, nlags=6, weight=0, anisotropy_scaling=1.0,
                  anisotropy_angle=0.0, verbose=False, enable_plotting=False,
-                 enable_statistics=False, min_theta=None, max_theta=None):
+                 enable_statistics=False, min_theta=None, max_theta=None, lag_bins=None,
+                 max_lag=None, sample_pairs=None, random_state=None):
 
         # Code assumes 1D input arrays. Ensures that any extraneous dimensions
         # don't get in the way. Copies are created to avoid any problems with
@@ -195,6 +251,7 @@ class SimpleKriging:
         self.Y_ORIG = np.atleast_1d(np.squeeze(np.array(y, copy=True)))
         self.Z = np.atleast_1d(np.squeeze(np.array(z, copy=True)))
 
+        self.backend_choice = None
         self.verbose = verbose
         self.enable_plotting = enable_plotting
         if self.enable_plotting and self.verbose:
@@ -211,6 +268,7 @@ class SimpleKriging:
                                        self.XCENTER, self.YCENTER,
                                        self.anisotropy_scaling, self.anisotropy_angle)
 
+        self.clear_kriging_cache()
         self.variogram_model = variogram_model
         if self.variogram_model not in self.variogram_dict.keys() and self.variogram_model != 'custom':
             raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
@@ -226,7 +284,9 @@ class SimpleKriging:
         self.lags, self.semivariance, self.semivariance_error, self.variogram_model_parameters = \
             core.initialize_variogram_model(self.X_ADJUSTED, self.Y_ADJUSTED, self.Z,
                                             self.variogram_model, variogram_parameters,
-                                            self.variogram_function, nlags, weight, min_theta, max_theta)
+                                            self.variogram_function, nlags, weight, min_theta, max_theta,
+                                            lag_bins=lag_bins, max_lag=max_lag,
+                                            sample_pairs=sample_pairs, random_state=random_state)
         if self.verbose:
             if self.variogram_model == 'linear':
                 print "Using '%s' Variogram Model" % 'linear'
@@ -265,7 +325,8 @@ class SimpleKriging:
 
     def update_variogram_model(self, variogram_model, variogram_parameters=None,
                                variogram_function=None, nlags=6, weight=False,
-                               anisotropy_scaling=1.0, anisotropy_angle=0.0):
+                               anisotropy_scaling=1.0, anisotropy_angle=0.0, lag_bins=None,
+                               max_lag=None, sample_pairs=None, random_state=None):
         """Allows user to update variogram type and/or variogram model parameters."""
 
         if anisotropy_scaling != self.anisotropy_scaling or \
@@ -281,6 +342,7 @@ class SimpleKriging:
                                            self.anisotropy_scaling,
                                            self.anisotropy_angle)
 
+        self.clear_kriging_cache()
         self.variogram_model = variogram_model
         if self.variogram_model not in self.variogram_dict.keys() and self.variogram_model != 'custom':
             raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
@@ -296,7 +358,9 @@ class SimpleKriging:
         self.lags, self.semivariance, self.semivariance_error, self.variogram_model_parameters = \
             core.initialize_variogram_model(self.X_ADJUSTED, self.Y_ADJUSTED, self.Z,
                                             self.variogram_model, variogram_parameters,
-                                            self.variogram_function, nlags, weight)
+                                            self.variogram_function, nlags, weight, lag_bins=lag_bins,
+                                            max_lag=max_lag, sample_pairs=sample_pairs,
+                                            random_state=random_state)
         if self.verbose:
             if self.variogram_model == 'linear':
                 print "Using '%s' Variogram Model" % 'linear'
@@ -391,6 +455,72 @@ class SimpleKriging:
         print "Q2 =", self.Q2
         print "cR =", self.cR
 
+    def clear_kriging_cache(self):
+        """Clears the cached kriging matrix, its factorization and the dual weights.
+        These are otherwise assembled once and reused by every call to execute; they are
+        also cleared by update_variogram_model and rebuilt if the data coordinates change."""
+        self.kriging_matrix = None
+        self.kriging_matrix_factor = None
+        self.dual_weights = None
+        self._kriging_matrix_coords = None
+
+    def _get_cached_kriging_matrix(self, n):
+        """Returns the kriging matrix, assembling it only if it is not cached."""
+
+        coords = (self.X_ADJUSTED, self.Y_ADJUSTED)
+        if self.kriging_matrix is None or \
+                not all([np.array_equal(c, c_) for c, c_ in zip(coords, self._kriging_matrix_coords)]):
+            self.clear_kriging_cache()
+            self.kriging_matrix = self._get_kriging_matrix(n)
+            self._kriging_matrix_coords = tuple([np.copy(c) for c in coords])
+
+        return self.kriging_matrix
+
+    def _get_cached_kriging_matrix_factor(self):
+        """Returns the Cholesky factorization of the cached (covariance) kriging matrix,
+        factoring it only if it is not cached. Falls back on an LU factorization if the
+        matrix is not numerically positive definite."""
+
+        if self.kriging_matrix_factor is None:
+            try:
+                self.kriging_matrix_factor = ('cholesky', scipy.linalg.cho_factor(self.kriging_matrix))
+            except np.linalg.LinAlgError:
+                lu, piv = scipy.linalg.lu_factor(self.kriging_matrix)
+                if np.any(np.diag(lu) == 0.0):
+                    raise np.linalg.LinAlgError("Singular matrix")
+                self.kriging_matrix_factor = ('lu', (lu, piv))
+
+        return self.kriging_matrix_factor
+
+    def _solve_kriging_system(self, b):
+        """Solves the kriging system for the right hand sides in the columns of b,
+        all at once, with the cached factorization of the kriging matrix. LAPACK is
+        called directly, since scipy's wrappers cost more than the solve itself
+        for one right hand side of a small system."""
+
+        method, factor = self._get_cached_kriging_matrix_factor()
+        if method == 'cholesky':
+            x, info = scipy.linalg.lapack.dpotrs(factor[0], np.asarray(b), lower=factor[1])
+        else:
+            x, info = scipy.linalg.lapack.dgetrs(factor[0], factor[1], np.asarray(b))
+
+        return x
+
+    def _get_dual_weights(self):
+        """Solves the kriging system once for the data values (with zeros in the
+        remaining rows). The kriged value at a point is then simply the dot product
+        of these dual weights with the right hand side of the point. The weights are
+        cached with the factorization, so that the points of every block and every
+        call to execute share the one solve."""
+
+        if self.dual_weights is None:
+            n = self.X_ADJUSTED.shape[0]
+            rhs = np.zeros((self.kriging_matrix.shape[0], 1))
+            rhs[:n, 0] = self.Z
+            self.dual_weights = self._solve_kriging_system(rhs)[:, 0]
+
+        return self.dual_weights
+
     def _get_kriging_matrix(self, n):
         """Assembles the kriging matrix."""
 
@@ -401,7 +531,7 @@ class SimpleKriging:
 
         return a
 
-    def _exec_vector(self, a, bd, mask):
+    def _exec_vector(self, a, bd, mask, return_variance=True):
         """Solves the kriging system as a vectorized operation. This method
         can take a lot of memory for large grids and/or large datasets."""
 
@@ -410,22 +540,24 @@ class SimpleKriging:
         #zero_index = None
         #zero_value = False
 
-        a_inv = scipy.linalg.inv(a)
-
         b = np.zeros((npt, n, 1))
         b[:, :, 0] = self.variogram_model_parameters[0] - self.variogram_function(self.variogram_model_parameters, bd)
 
-        if (~mask).any():
+        if mask.any():
             mask_b = np.repeat(mask[:, np.newaxis, np.newaxis], n, axis=1)
             b = np.ma.array(b, mask=mask_b)
 
-        x = np.dot(a_inv, b.reshape((npt, n)).T).reshape((1, n, npt)).T
+        if not return_variance:
+            zvalues = np.dot(np.asarray(b)[:, :, 0], self._get_dual_weights())
+            return zvalues, None
+
+        x = self._solve_kriging_system(b.reshape((npt, n)).T).reshape((1, n, npt)).T
         zvalues = np.sum(x[:, :, 0] * self.Z, axis=1)
         sigmasq = self.variogram_model_parameters[0] - np.sum(x[:, :, 0] * b[:, :, 0], axis=1)
 
         return zvalues, sigmasq
 
-    def _exec_loop(self, a, bd_all, mask):
+    def _exec_loop(self, a, bd_all, mask, return_variance=True):
         """Solves the kriging system by looping over all specified points.
         Less memory-intensive, but involves a Python-level loop."""
 
@@ -433,48 +565,55 @@ class SimpleKriging:
         n = self.X_ADJUSTED.shape[0]
         zvalues = np.zeros(npt)
         sigmasq = np.zeros(npt)
-
-        a_inv = scipy.linalg.inv(a)
+        if not return_variance:
+            w = self._get_dual_weights()
 
         for j in np.nonzero(~mask)[0]:   # Note that this is the same thing as range(npt) if mask is not defined,
             bd = bd_all[j]               # otherwise it takes the non-masked elements.
 
             b = np.zeros((n, 1))
             b[:, 0] = self.variogram_model_parameters[0] -  self.variogram_function(self.variogram_model_parameters, bd)
-            x = np.dot(a_inv, b)
+            if not return_variance:
+                zvalues[j] = np.sum(b[:, 0] * w)
+                continue
+
+            x = self._solve_kriging_system(b)
             zvalues[j] = np.sum(x[:, 0] * self.Z)
             sigmasq[j] = self.variogram_model_parameters[0] - np.sum(x[:, 0] * b[:, 0])
 
         return zvalues, sigmasq
 
-    def _exec_loop_moving_window(self, a_all, bd_all, mask, bd_idx):
-        """Solves the kriging system by looping over all specified points.
-        Less memory-intensive, but involves a Python-level loop."""
-        import scipy.linalg.lapack
+    def _exec_loop_moving_window(self, a_all, distances, indices, indptr, mask):
+        """Solves the kriging system of each specified point from the data points of its
+        neighborhood, given as ragged (CSR) arrays as returned by SearchNeighborhood.query.
+        Points whose neighborhoods hold the same data points are solved together, as the
+        right hand sides of one solve (see core._neighborhood_groups).
+        Less memory-intensive, but involves a Python-level loop over the neighborhoods."""
 
-        npt = bd_all.shape[0]
-        n = bd_idx.shape[1]
+        npt = indptr.shape[0] - 1
         zvalues = np.zeros(npt)
         sigmasq = np.zeros(npt)
 
-        for i in np.nonzero(~mask)[0]:   # Note that this is the same thing as range(npt) if mask is not defined,
-            b_selector = bd_idx[i]       # otherwise it takes the non-masked elements.
-            bd = bd_all[i]
+        indices, distances, points, group_ptr = core._neighborhood_groups(indptr, indices, distances, mask)
+        for g in range(group_ptr.shape[0] - 1):
+            members = points[group_ptr[g]:group_ptr[g+1]]
+            b_selector = indices[indptr[members[0]]:indptr[members[0]+1]]
+            n = b_selector.shape[0]
 
-            a_selector = np.concatenate((b_selector, np.array([a_all.shape[0] - 1])))
-            a = a_all[a_selector[:, None], a_selector]
+            a = a_all[b_selector[:, None], b_selector]
 
-            b = np.zeros((n, 1))
-            b[:, 0] = self.variogram_model_parameters[0] -  self.variogram_function(self.variogram_model_parameters, bd)
+            bd = distances[indptr[members][:, None] + np.arange(n)].T
+            b = self.variogram_model_parameters[0] - self.variogram_function(self.variogram_model_parameters, bd)
 
             x = scipy.linalg.solve(a, b)
 
-            zvalues[i] = x[:, 0].dot(self.Z[b_selector])
-            sigmasq[i] = self.variogram_model_parameters[0] -  x[:, 0].dot(b[:, 0])
+            zvalues[members] = x.T.dot(self.Z[b_selector])
+            sigmasq[members] = self.variogram_model_parameters[0] - np.sum(x * b, axis=0)
 
         return zvalues, sigmasq
 
-    def execute(self, style, xpoints, ypoints, mask=None, backend='vectorized', n_closest_points=None):
+    def execute(self, style, xpoints, ypoints, mask=None, backend='vectorized', n_closest_points=None,
+                return_variance=True, max_memory=None, n_jobs=1, search_neighborhood=None):
         """Calculates a kriged grid and the associated variance.
 
         This is now the method that performs the main kriging calculation. Note that currently
@@ -523,11 +662,29 @@ class SimpleKriging:
                 Specifying 'loop' will loop through each point at which the kriging system
                 is to be solved. This approach is slower but also less memory-intensive.
                 Specifying 'C' will utilize a loop in Cython.
+                Specifying 'auto' will pick the fastest of these that fits in memory (max_memory,
+                or half of the available memory if not given) from a rough estimate of the cost,
+                and store the choice and the estimates in backend_choice.
                 Default is 'vectorized'.
             n_closest_points (int, optional): For kriging with a moving window, specifies the number
                 of nearby points to use in the calculation. This can speed up the calculation for large
                 datasets, but should be used with caution. As Kitanidis notes, kriging with a moving
                 window can produce unexpected oddities if the variogram model is not carefully chosen.
+            search_neighborhood (SearchNeighborhood, optional): For kriging with a moving window, the
+                core.SearchNeighborhood that selects the data points of each point from a search radius,
+                a minimum and maximum number of points and a maximum number of points per quadrant
+                (octant in 3D), instead of n_closest_points. Points with fewer than its min_points data
+                points in range are not kriged, and get NaN values and variances. Supported by the 'loop'
+                and 'C' backends.
+            return_variance (bool, optional): If False, only the kriged values are calculated
+                and returned, using dual kriging: the kriging system is solved once for the data
+                values, so that each point only costs a dot product instead of a solve.
+                Default is True.
+            max_memory (float, optional): For the vectorized and C backends, the approximate memory (in MB)
+                that the temporary arrays may take. The points are then kriged in blocks of the
+                largest size that fits. Default is None, which kriges all the points at once.
+            n_jobs (int, optional): Number of threads over which the points are spread with the
+                'C' backend (requires the extension to be built with OpenMP). Default is 1.
         Outputs:
             zvalues (numpy array, dim MxN or dim Nx1): Z-values of specified grid or at the
                 specified set of points. If style was specified as 'masked', zvalues will
@@ -535,6 +692,7 @@ class SimpleKriging:
             sigmasq (numpy array, dim MxN or dim Nx1): Variance at specified grid points or
                 at the specified set of points. If style was specified as 'masked', sigmasq
                 will be a numpy masked array.
+                Only returned if return_variance is True.
         """
 
         if self.verbose:
@@ -551,7 +709,7 @@ class SimpleKriging:
         n = self.X_ADJUSTED.shape[0]
         nx = xpts.size
         ny = ypts.size
-        a = self._get_kriging_matrix(n)
+        a = self._get_cached_kriging_matrix(n)
 
         if style in ['grid', 'masked']:
             if style == 'masked':
@@ -585,43 +743,94 @@ class SimpleKriging:
         xy_points = np.concatenate((xpts[:, np.newaxis], ypts[:, np.newaxis]), axis=1)
         xy_data = np.concatenate((self.X_ADJUSTED[:, np.newaxis], self.Y_ADJUSTED[:, np.newaxis]), axis=1)
 
+        if n_closest_points is not None and search_neighborhood is not None:
+            raise ValueError("Specify either n_closest_points or search_neighborhood, not both.")
+
+        if backend == 'auto':
+            backends = ['vectorized', 'loop'] if n_closest_points is None and search_neighborhood is None else ['loop']
+            try:
+                from .lib.csk import _c_exec_loop, _c_exec_loop_neighborhood
+                backends.append('C')
+            except ImportError:
+                pass
+            if search_neighborhood is not None:
+                n_closest_points = search_neighborhood.max_points or a.shape[0] - 1
+            self.backend_choice = core._choose_backend(backends, a.shape[0], np.sum(~mask), n_closest_points,
+                                                       max_memory, return_variance, n_jobs)
+            backend = self.backend_choice['backend']
+            max_memory = self.backend_choice['max_memory']
+            if self.verbose:
+                print "Backend chosen automatically:", backend, "\n"
+
         c_pars = None
-#        if backend == 'C':
-#            try:
-#                from .lib.cok import _c_exec_loop, _c_exec_loop_moving_window
-#            except ImportError:
-#                print('Warning: failed to load Cython extensions.\n'\
-#                      '   See https://github.com/bsmurphy/PyKrige/issues/8 \n'\
-#                      '   Falling back to a pure python backend...')
-#                backend = 'loop'
-#            except:
-#                raise RuntimeError("Unknown error in trying to load Cython extension.")
-#
-#            c_pars = {key: getattr(self, key) for key in ['Z', 'eps', 'variogram_model_parameters',
-#                                                          'variogram_function']}
-
-        if n_closest_points is not None:
-            from scipy.spatial import cKDTree
-            tree = cKDTree(xy_data)
-            bd, bd_idx = tree.query(xy_points, k=n_closest_points, eps=0.0)
+        if backend == 'C':
+            try:
+                from .lib.csk import _c_exec_loop, _c_exec_loop_neighborhood
+            except ImportError:
+                print('Warning: failed to load Cython extensions.\n'\
+                      '   See https://github.com/bsmurphy/PyKrige/issues/8 \n'\
+                      '   Falling back to a pure python backend...')
+                backend = 'loop'
+            except:
+                raise RuntimeError("Unknown error in trying to load Cython extension.")
+
+            c_pars = {key: getattr(self, key) for key in ['Z', 'eps', 'variogram_model_parameters',
+                                                          'variogram_function']}
+
+        if search_neighborhood is not None or n_closest_points is not None:
+            if search_neighborhood is not None:
+                indptr, indices, distances = search_neighborhood.query(xy_data, xy_points)
+            else:
+                from scipy.spatial import cKDTree
+                tree = cKDTree(xy_data)
+                bd, bd_idx = tree.query(xy_points, k=n_closest_points, eps=0.0)
+                indptr = np.arange(0, bd.size + 1, n_closest_points)
+                indices = bd_idx.reshape(-1)
+                distances = bd.reshape(-1)
+            empty = indptr[1:] == indptr[:-1]
 
             if backend == 'loop':
-                zvalues, sigmasq = self._exec_loop_moving_window(a, bd, mask, bd_idx)
-            #elif backend == 'C':
-            #    zvalues, sigmasq = _c_exec_loop_moving_window(a, bd, mask.astype('int8'),
-            #                                                  bd_idx, self.X_ADJUSTED.shape[0], c_pars)
+                zvalues, sigmasq = self._exec_loop_moving_window(a, distances, indices, indptr, mask | empty)
+            elif backend == 'C':
+                indices, distances, points, group_ptr = core._neighborhood_groups(indptr, indices, distances,
+                                                                                  mask | empty)
+                zvalues, sigmasq = _c_exec_loop_neighborhood(a, distances, indices, indptr, points, group_ptr,
+                                                             c_pars, n_jobs)
             else:
                 raise ValueError('Specified backend {} for a moving window is not supported.'.format(backend))
-        else:
+            zvalues[empty] = np.nan
+            sigmasq[empty] = np.nan
+        elif backend == 'vectorized':
+            zvalues = np.zeros(npt)
+            sigmasq = np.zeros(npt)
+            for idx in core._point_chunks(mask, a.shape[0], max_memory):
+                bd = cdist(xy_points[idx], xy_data, 'euclidean')
+                z, ss = self._exec_vector(a, bd, mask[idx], return_variance)
+                zvalues[idx] = z
+                if return_variance:
+                    sigmasq[idx] = ss
+        elif backend == 'C':
+            zvalues = np.zeros(npt)
+            sigmasq = np.zeros(npt)
+            c_pars['factor'] = self._get_cached_kriging_matrix_factor()
+            for idx in core._point_chunks(mask, a.shape[0], max_memory):
+                bd = cdist(xy_points[idx], xy_data, 'euclidean')
+                z, ss = _c_exec_loop(a, bd, np.zeros(idx.size, dtype='int8'), self.X_ADJUSTED.shape[0], c_pars,
+                                     n_jobs, return_variance)
+                zvalues[idx] = z
+                sigmasq[idx] = ss
+        elif backend == 'loop':
             bd = cdist(xy_points,  xy_data, 'euclidean')
-            if backend == 'vectorized':
-                zvalues, sigmasq = self._exec_vector(a, bd, mask)
-            elif backend == 'loop':
-                zvalues, sigmasq = self._exec_loop(a, bd, mask)
-            #elif backend == 'C':
-            #    zvalues, sigmasq = _c_exec_loop(a, bd, mask.astype('int8'), self.X_ADJUSTED.shape[0],  c_pars)
-            else:
-                raise ValueError('Specified backend {} is not supported for 2D ordinary kriging.'.format(backend))
+            zvalues, sigmasq = self._exec_loop(a, bd, mask, return_variance)
+        else:
+            raise ValueError('Specified backend {} is not supported for 2D simple kriging.'.format(backend))
+
+        if not return_variance:
+            if style == 'masked':
+                zvalues = np.ma.array(zvalues, mask=mask)
+            if style in ['masked', 'grid']:
+                zvalues = zvalues.reshape((ny, nx))
+            return zvalues
 
         if style == 'masked':
             zvalues = np.ma.array(zvalues, mask=mask)
@@ -9,6 +9,7 @@ import numpy as np
 import kriging_tools as kt
 import core
 import variogram_models
+from sk import SimpleKriging
 from ok import OrdinaryKriging
 from uk import UniversalKriging
 from ok3d import OrdinaryKriging3D
@@ -85,12 +86,152 @@ class TestPyKrige(unittest.TestCase):
         x = np.array([1.0 + n/np.sqrt(2) for n in range(4)])
         y = np.array([1.0 + n/np.sqrt(2) for n in range(4)])
         z = np.arange(1.0, 5.0, 1.0)
-        lags, semivariance, variogram_model_parameters = core.initialize_variogram_model(x, y, z, 'linear',
-                                                                                         [0.0, 0.0], 'linear',
-                                                                                         6, False)
+        lags, semivariance, semivariance_error, variogram_model_parameters = \
+            core.initialize_variogram_model(x, y, z, 'linear', [0.0, 0.0], 'linear', 6, False)
 
+        # The default lag bins are half-open, so the pair at the largest distance is left out.
+        self.assertTrue(np.allclose(lags, np.array([1.0, 2.0])))
+        self.assertTrue(np.allclose(semivariance, np.array([0.5, 2.0])))
+        self.assertEqual(semivariance_error.shape, semivariance.shape)
+
+    def test_core_lag_bins(self):
+
+        x = np.array([1.0 + n/np.sqrt(2) for n in range(4)])
+        y = np.array([1.0 + n/np.sqrt(2) for n in range(4)])
+        z = np.arange(1.0, 5.0, 1.0)
+        lags, semivariance, semivariance_error, variogram_model_parameters = \
+            core.initialize_variogram_model(x, y, z, 'linear', [0.0, 0.0], 'linear', 6, False, lag_bins='linear')
         self.assertTrue(np.allclose(lags, np.array([1.0, 2.0, 3.0])))
         self.assertTrue(np.allclose(semivariance, np.array([0.5, 2.0, 4.5])))
+        self.assertEqual(semivariance_error.shape, semivariance.shape)
+        lags_unicode = core.initialize_variogram_model(x, y, z, 'linear', [0.0, 0.0], 'linear', 6, False,
+                                                       lag_bins=u'linear')[0]
+        self.assertTrue(np.allclose(lags_unicode, lags))
+
+        # The default bins are half-open, so the pair at the largest distance is left out.
+        lags, semivariance, semivariance_error = core._experimental_variogram(x, y, z, 6)
+        self.assertTrue(np.allclose(lags, np.array([1.0, 2.0])))
+        self.assertTrue(np.allclose(semivariance, np.array([0.5, 2.0])))
+
+        lags, semivariance, semivariance_error, variogram_model_parameters = \
+            core.initialize_variogram_model(x, y, z, 'linear', [0.0, 0.0], 'linear', 6, False,
+                                            lag_bins=[0.5, 2.5, 3.5])
+        self.assertTrue(np.allclose(lags, np.array([1.4, 3.0])))
+        self.assertTrue(np.allclose(semivariance, np.array([1.1, 4.5])))
+
+        lags, semivariance, semivariance_error, variogram_model_parameters = \
+            core.initialize_variogram_model(x, y, z, 'linear', [0.0, 0.0], 'linear', 2, False, lag_bins='geometric')
+        self.assertTrue(np.allclose(lags, np.array([1.0, 7.0/3.0])))
+
+        self.assertRaises(ValueError, core.initialize_variogram_model, x, y, z, 'linear', [0.0, 0.0], 'linear',
+                          6, False, lag_bins='blurg')
+        self.assertRaises(ValueError, core.initialize_variogram_model, x, y, z, 'linear', [0.0, 0.0], 'linear',
+                          6, False, lag_bins=[2.0, 1.0])
+
+        lags, semivariance, semivariance_error, variogram_model_parameters = \
+            core.initialize_variogram_model(x, y, z, 'linear', [0.0, 0.0], 'linear', 2, False, lag_bins='linear',
+                                            max_lag=2.5)
+        self.assertTrue(np.allclose(lags, np.array([1.0, 2.0])))
+        self.assertTrue(np.allclose(semivariance, np.array([0.5, 2.0])))
+
+        bins = np.linspace(0.0, 2000.0, 5)
+        full = core.initialize_variogram_model(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2],
+                                               'linear', [0.0, 0.0], 'linear', 6, False, lag_bins=bins)
+        close = core.initialize_variogram_model(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2],
+                                                'linear', [0.0, 0.0], 'linear', 6, False, lag_bins=bins, max_lag=2000.0)
+        self.assertEqual(full[0].size, 4)
+        for a, b in zip(full[:3], close[:3]):
+            self.assertTrue(np.allclose(a, b))
+
+        # A cutoff inside the bins, checked against all of the pairs binned by hand.
+        xy = self.test_data[:, :2]
+        dist = np.sqrt(np.sum((xy[:, np.newaxis, :] - xy[np.newaxis, :, :])**2, axis=2))
+        g = 0.5 * (self.test_data[:, 2][:, np.newaxis] - self.test_data[:, 2][np.newaxis, :])**2
+        upper = np.triu_indices(xy.shape[0], 1)
+        kept = dist[upper] <= 1200.0
+        index = np.digitize(dist[upper][kept], bins) - 1
+        expected = [np.mean(g[upper][kept][index == n]) for n in range(4) if np.any(index == n)]
+        close = core.initialize_variogram_model(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2],
+                                                'linear', [0.0, 0.0], 'linear', 6, False, lag_bins=bins, max_lag=1200.0)
+        self.assertEqual(len(expected), 3)
+        self.assertTrue(np.allclose(close[1], expected))
+        self.assertFalse(np.allclose(close[1], full[1][:3]))
+
+        first = core.initialize_variogram_model(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2],
+                                                'linear', [0.0, 0.0], 'linear', 6, False, lag_bins=bins,
+                                                sample_pairs=2000, random_state=42)
+        second = core.initialize_variogram_model(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2],
+                                                 'linear', [0.0, 0.0], 'linear', 6, False, lag_bins=bins,
+                                                 sample_pairs=2000, random_state=42)
+        for a, b in zip(first[:3], second[:3]):
+            self.assertTrue(np.allclose(a, b))
+        self.assertTrue(np.allclose(first[1], full[1], rtol=0.2))
+        self.assertTrue(np.all(first[2] > 0.0))
+
+        data = np.genfromtxt('./test_data/test3d_data.txt', skip_header=1)
+        for krige in [OrdinaryKriging3D, UniversalKriging3D]:
+            k3d = krige(data[:, 0], data[:, 1], data[:, 2], data[:, 3], variogram_model='linear',
+                        variogram_parameters=[1., 0.1], sample_pairs=500, random_state=0)
+            self.assertEqual(k3d.semivariance_error.shape, k3d.semivariance.shape)
+            self.assertTrue(np.all(k3d.semivariance_error >= 0.0))
+
+    def test_core_directional_variograms(self):
+
+        x = np.array([1.0 + n/np.sqrt(2) for n in range(4)])
+        y = np.array([1.0 + n/np.sqrt(2) for n in range(4)])
+        z = np.arange(1.0, 5.0, 1.0)
+        variograms = core.directional_variograms(x, y, z, [(30.0, 60.0), (-60.0, -30.0), None], nlags=3)
+        self.assertEqual(len(variograms), 3)
+        self.assertTrue(np.allclose(variograms[0][0], np.array([1.0, 2.0, 3.0])))
+        self.assertTrue(np.allclose(variograms[0][1], np.array([0.5, 2.0, 4.5])))
+        self.assertEqual(variograms[1][0].size, 0)
+        for a, b in zip(variograms[0], variograms[2]):
+            self.assertTrue(np.allclose(a, b))
+
+        x = self.test_data[:, 0]
+        y = self.test_data[:, 1]
+        z = self.test_data[:, 2]
+        bins = np.linspace(0.0, 4000.0, 5)
+        variograms = core.directional_variograms(x, y, z, [(-45.0, 45.0), (45.0, 135.0), None], lag_bins=bins)
+        for k, (min_theta, max_theta) in enumerate([(-45.0, 45.0), (45.0, 135.0), (None, None)]):
+            res = core.initialize_variogram_model(x, y, z, 'linear', [0.0, 0.0], 'linear', 6, False,
+                                                  min_theta, max_theta, lag_bins=bins)
+            for a, b in zip(variograms[k], res[:3]):
+                self.assertTrue(np.allclose(a, b))
+
+        v = np.array([1., 2., 3., 4.])
+        variograms = core.directional_variograms_3d(v, v, v, v, [(30.0, 60.0, 20.0, 50.0),
+                                                                 (30.0, 60.0, -50.0, -20.0), None], nlags=3)
+        self.assertTrue(np.allclose(variograms[0][0], np.array([np.sqrt(3.), 2.*np.sqrt(3.), 3.*np.sqrt(3.)])))
+        self.assertTrue(np.allclose(variograms[0][1], np.array([0.5, 2.0, 4.5])))
+        self.assertEqual(variograms[1][0].size, 0)
+        self.assertTrue(np.allclose(variograms[2][1], np.array([0.5, 2.0, 4.5])))
+
+    def test_core_variogram_map(self):
+
+        x = np.array([0.0, 1.0, 0.0, 5.0])
+        y = np.array([0.0, 0.0, 2.0, 5.0])
+        z = np.array([1.0, 2.0, 4.0, 0.0])
+        gridx, gridy, semivariance, n_pairs = core.variogram_map(x, y, z, 1.0, 1.0, 2, 2)
+        self.assertTrue(np.allclose(gridx, np.arange(-2.0, 3.0)))
+        self.assertTrue(np.allclose(gridy, np.arange(-2.0, 3.0)))
+        self.assertEqual(semivariance.shape, (5, 5))
+        self.assertEqual(np.sum(n_pairs), 6)
+        self.assertEqual(n_pairs[2, 3], 1)
+        self.assertEqual(n_pairs[2, 1], 1)
+        self.assertAlmostEqual(semivariance[2, 3], 0.5)
+        self.assertAlmostEqual(semivariance[4, 2], 4.5)
+        self.assertAlmostEqual(semivariance[0, 2], 4.5)
+        self.assertAlmostEqual(semivariance[4, 1], 2.0)
+        self.assertAlmostEqual(semivariance[0, 3], 2.0)
+        self.assertTrue(semivariance.mask[2, 2])
+
+        # A coincident pair lands in the center cell once, not once per direction.
+        gridx, gridy, semivariance, n_pairs = core.variogram_map(np.append(x, 0.0), np.append(y, 0.0),
+                                                                 np.append(z, 3.0), 1.0, 1.0, 2, 2)
+        self.assertEqual(n_pairs[2, 2], 1)
+        self.assertAlmostEqual(semivariance[2, 2], 2.0)
+        self.assertEqual(n_pairs[2, 3], 2)
 
     def test_core_initialize_variogram_model_3d(self):
 
@@ -103,14 +244,21 @@ class TestPyKrige(unittest.TestCase):
                           self.simple_data_3d[:, 1], self.simple_data_3d[:, 2], self.simple_data_3d[:, 3],
                           'spherical', [0.0], 'spherical', 6, False)
 
-        lags, semivariance, variogram_model_parameters = core.initialize_variogram_model_3d(np.array([1., 2., 3., 4.]),
-                                                                                            np.array([1., 2., 3., 4.]),
-                                                                                            np.array([1., 2., 3., 4.]),
-                                                                                            np.array([1., 2., 3., 4.]),
-                                                                                            'linear', [0.0, 0.0],
-                                                                                            'linear', 3, False)
+        lags, semivariance, semivariance_error, variogram_model_parameters = \
+            core.initialize_variogram_model_3d(np.array([1., 2., 3., 4.]), np.array([1., 2., 3., 4.]),
+                                               np.array([1., 2., 3., 4.]), np.array([1., 2., 3., 4.]),
+                                               'linear', [0.0, 0.0], 'linear', 3, False)
         self.assertTrue(np.allclose(lags, np.array([np.sqrt(3.), 2.*np.sqrt(3.), 3.*np.sqrt(3.)])))
         self.assertTrue(np.allclose(semivariance, np.array([0.5, 2.0, 4.5])))
+        self.assertEqual(semivariance_error.shape, semivariance.shape)
+
+        lags, semivariance, semivariance_error, variogram_model_parameters = \
+            core.initialize_variogram_model_3d(np.array([1., 2., 3., 4.]), np.array([1., 2., 3., 4.]),
+                                               np.array([1., 2., 3., 4.]), np.array([1., 2., 3., 4.]),
+                                               'linear', [0.0, 0.0], 'linear', 2, False,
+                                               lag_bins='linear', max_lag=4.0)
+        self.assertTrue(np.allclose(lags, np.array([np.sqrt(3.), 2.*np.sqrt(3.)])))
+        self.assertTrue(np.allclose(semivariance, np.array([0.5, 2.0])))
 
     def test_core_calculate_variogram_model(self):
 
@@ -126,9 +274,10 @@ class TestPyKrige(unittest.TestCase):
                                              'power', variogram_models.power_variogram_model, False)
         self.assertTrue(np.allclose(res, np.array([1.0, 1.5, 0.0])))
 
+        # The semivariances are rounded to four places, which moves the best fit exponent by about 1e-5.
         res = core.calculate_variogram_model(np.array([1.0, 2.0, 3.0, 4.0]), np.array([1.0, 1.4142, 1.7321, 2.0]),
                                              'power', variogram_models.power_variogram_model, False)
-        self.assertTrue(np.allclose(res, np.array([1.0, 0.5, 0.0])))
+        self.assertTrue(np.allclose(res, np.array([1.0, 0.5, 0.0]), 1e-4, 1e-4))
 
         res = core.calculate_variogram_model(np.array([1.0, 2.0, 3.0, 4.0]), np.array([1.2642, 1.7293, 1.9004, 1.9634]),
                                              'exponential', variogram_models.exponential_variogram_model, False)
@@ -138,6 +287,171 @@ class TestPyKrige(unittest.TestCase):
                                              'gaussian', variogram_models.gaussian_variogram_model, False)
         self.assertTrue(np.allclose(res, np.array([2.0, 3.0, 0.0]), 0.001, 0.001))
 
+        # The best linear fit has a negative slope, so it lies on the bounds.
+        res = core.calculate_variogram_model(np.array([1.0, 2.0, 3.0, 4.0]), np.array([4.0, 3.0, 3.0, 2.0]),
+                                             'linear', variogram_models.linear_variogram_model, False)
+        self.assertTrue(np.allclose(res, np.array([0.0, 3.0])))
+
+    def test_core_find_statistics(self):
+
+        x = self.test_data[:, 0]
+        y = self.test_data[:, 1]
+        z = self.test_data[:, 2]
+        params = [500.0, 3000.0, 10.0]
+        delta, sigma, epsilon = core.find_statistics(x, y, z, variogram_models.spherical_variogram_model, params)
+        self.assertEqual(delta.shape, (z.size - 1,))
+        for n in range(1, z.size):
+            z_, ss_ = core.krige(x[:n], y[:n], z[:n], (x[n], y[n]), variogram_models.spherical_variogram_model,
+                                 params)
+            self.assertAlmostEqual(delta[n - 1], z[n] - z_)
+            self.assertAlmostEqual(sigma[n - 1], np.sqrt(ss_))
+        self.assertTrue(np.allclose(epsilon, delta/sigma))
+
+        # Coincident data points
+        x = np.array([0.0, 1.0, 0.0, 2.0, 1.0])
+        y = np.array([0.0, 0.0, 0.0, 1.0, 2.0])
+        z = np.array([1.0, 2.0, 1.5, 3.0, 2.5])
+        params = [1.0, 0.5]
+        delta, sigma, epsilon = core.find_statistics(x, y, z, variogram_models.linear_variogram_model, params)
+        for n in range(1, z.size):
+            z_, ss_ = core.krige(x[:n], y[:n], z[:n], (x[n], y[n]), variogram_models.linear_variogram_model,
+                                 params)
+            self.assertAlmostEqual(delta[n - 1], z[n] - z_)
+            self.assertAlmostEqual(sigma[n - 1], np.sqrt(ss_))
+
+        # Without a nugget, the coincident points make the later kriging matrices singular.
+        self.assertRaises(np.linalg.LinAlgError, core.find_statistics, x, y, z,
+                          variogram_models.linear_variogram_model, [1.0, 0.0])
+
+        data = self.simple_data_3d
+        params = [1.0, 0.1]
+        delta, sigma, epsilon = core.find_statistics_3d(data[:, 0], data[:, 1], data[:, 2], data[:, 3],
+                                                        variogram_models.linear_variogram_model, params)
+        for n in range(1, data.shape[0]):
+            z_, ss_ = core.krige_3d(data[:n, 0], data[:n, 1], data[:n, 2], data[:n, 3], data[n, :3],
+                                    variogram_models.linear_variogram_model, params)
+            self.assertAlmostEqual(delta[n - 1], data[n, 3] - z_)
+            self.assertAlmostEqual(sigma[n - 1], np.sqrt(ss_))
+
+    def test_cross_validate(self):
+
+        x, y, z = self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2]
+        params = [500.0, 3000.0, 10.0]
+        ok = OrdinaryKriging(x, y, z, variogram_model='spherical', variogram_parameters=params)
+        uk = UniversalKriging(x, y, z, variogram_model='spherical', variogram_parameters=params,
+                              drift_terms=['regional_linear'])
+        residuals, sigmasq = ok.cross_validate()
+        uk_residuals, uk_sigmasq = uk.cross_validate()
+        mw_residuals, mw_sigmasq = ok.cross_validate(n_closest_points=6)
+        c_residuals, c_sigmasq = ok.cross_validate(n_closest_points=6, backend='C', n_jobs=2)
+        self.assertTrue(np.allclose(mw_residuals, c_residuals))
+        self.assertTrue(np.allclose(mw_sigmasq, c_sigmasq))
+        self.assertRaises(ValueError, ok.cross_validate, n_closest_points=z.size)
+        all_residuals, all_sigmasq = ok.cross_validate(n_closest_points=z.size - 1)
+        self.assertTrue(np.allclose(residuals, all_residuals))
+        self.assertTrue(np.allclose(sigmasq, all_sigmasq))
+        uk_mw_residuals, uk_mw_sigmasq = uk.cross_validate(n_closest_points=6)
+        for k in [2, 6]:
+            # with two points in the window, the regional linear drift is dropped at every point
+            c_residuals, c_sigmasq = uk.cross_validate(n_closest_points=k, backend='C', n_jobs=2)
+            loop_residuals, loop_sigmasq = uk.cross_validate(n_closest_points=k)
+            self.assertTrue(np.allclose(loop_residuals, c_residuals))
+            self.assertTrue(np.allclose(loop_sigmasq, c_sigmasq))
+        self.assertRaises(ValueError, uk.cross_validate, n_closest_points=z.size)
+        for i in range(z.size):
+            others = np.arange(z.size) != i
+            ok_ = OrdinaryKriging(x[others], y[others], z[others], variogram_model='spherical',
+                                  variogram_parameters=params)
+            z_, ss_ = ok_.execute('points', x[i], y[i])
+            self.assertAlmostEqual(residuals[i], z[i] - z_[0])
+            self.assertAlmostEqual(sigmasq[i], ss_[0])
+            z_, ss_ = ok_.execute('points', x[i], y[i], backend='loop', n_closest_points=6)
+            self.assertAlmostEqual(mw_residuals[i], z[i] - z_[0])
+            self.assertAlmostEqual(mw_sigmasq[i], ss_[0])
+            uk_ = UniversalKriging(x[others], y[others], z[others], variogram_model='spherical',
+                                   variogram_parameters=params, drift_terms=['regional_linear'])
+            z_, ss_ = uk_.execute('points', x[i], y[i])
+            self.assertAlmostEqual(uk_residuals[i], z[i] - z_[0])
+            self.assertAlmostEqual(uk_sigmasq[i], ss_[0])
+            z_, ss_ = uk_.execute('points', x[i], y[i], backend='loop', n_closest_points=6)
+            self.assertAlmostEqual(uk_mw_residuals[i], z[i] - z_[0])
+            self.assertAlmostEqual(uk_mw_sigmasq[i], ss_[0])
+
+        data = np.random.RandomState(0).rand(12, 4)
+        params = [1.0, 0.1]
+        ok3d = OrdinaryKriging3D(data[:, 0], data[:, 1], data[:, 2], data[:, 3], variogram_model='linear',
+                                 variogram_parameters=params)
+        uk3d = UniversalKriging3D(data[:, 0], data[:, 1], data[:, 2], data[:, 3], variogram_model='linear',
+                                  variogram_parameters=params, drift_terms=['regional_linear'])
+        residuals, sigmasq = ok3d.cross_validate()
+        uk_residuals, uk_sigmasq = uk3d.cross_validate()
+        mw_residuals, mw_sigmasq = ok3d.cross_validate(n_closest_points=5)
+        c_residuals, c_sigmasq = ok3d.cross_validate(n_closest_points=5, backend='C', n_jobs=2)
+        self.assertTrue(np.allclose(mw_residuals, c_residuals))
+        self.assertTrue(np.allclose(mw_sigmasq, c_sigmasq))
+        self.assertRaises(ValueError, ok3d.cross_validate, n_closest_points=data.shape[0])
+        for i in range(data.shape[0]):
+            others = np.arange(data.shape[0]) != i
+            ok3d_ = OrdinaryKriging3D(data[others, 0], data[others, 1], data[others, 2], data[others, 3],
+                                      variogram_model='linear', variogram_parameters=params)
+            z_, ss_ = ok3d_.execute('points', data[i, 0], data[i, 1], data[i, 2])
+            self.assertAlmostEqual(residuals[i], data[i, 3] - z_[0])
+            self.assertAlmostEqual(sigmasq[i], ss_[0])
+            z_, ss_ = ok3d_.execute('points', data[i, 0], data[i, 1], data[i, 2], backend='loop',
+                                    n_closest_points=5)
+            self.assertAlmostEqual(mw_residuals[i], data[i, 3] - z_[0])
+            self.assertAlmostEqual(mw_sigmasq[i], ss_[0])
+            uk3d_ = UniversalKriging3D(data[others, 0], data[others, 1], data[others, 2], data[others, 3],
+                                       variogram_model='linear', variogram_parameters=params,
+                                       drift_terms=['regional_linear'])
+            z_, ss_ = uk3d_.execute('points', data[i, 0], data[i, 1], data[i, 2])
+            self.assertAlmostEqual(uk_residuals[i], data[i, 3] - z_[0])
+            self.assertAlmostEqual(uk_sigmasq[i], ss_[0])
+
+    def test_core_select_variogram_model(self):
+
+        results = core.select_variogram_model(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2])
+        self.assertEqual(sorted([result['variogram_model'] for result in results]),
+                         ['exponential', 'gaussian', 'linear', 'power', 'spherical'])
+        rmse = [result['rmse'] for result in results]
+        self.assertEqual(rmse, sorted(rmse))
+
+        ok = OrdinaryKriging(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2],
+                             variogram_model='spherical')
+        for result in results:
+            if result['variogram_model'] == 'spherical':
+                self.assertTrue(np.allclose(result['variogram_model_parameters'], ok.variogram_model_parameters))
+
+        results = core.select_variogram_model(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2],
+                                              ['linear', 'spherical'], enable_statistics=True)
+        self.assertEqual(len(results), 2)
+        self.assertTrue(results[0]['cR'] <= results[1]['cR'])
+        for result in results:
+            ok = OrdinaryKriging(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2],
+                                 variogram_model=result['variogram_model'], enable_statistics=True)
+            self.assertAlmostEqual(result['Q1'], ok.Q1)
+            self.assertAlmostEqual(result['Q2'], ok.Q2)
+            self.assertAlmostEqual(result['cR'], ok.cR)
+
+        self.assertRaises(ValueError, core.select_variogram_model, self.test_data[:, 0], self.test_data[:, 1],
+                          self.test_data[:, 2], ['blurg'])
+
+    def test_variogram_models_jacobian(self):
+
+        dist = np.array([0.0, 0.5, 1.0, 2.0, 3.5, 5.0])
+        params = {'linear': [1.3, 0.2], 'power': [1.3, 1.4, 0.2], 'gaussian': [2.0, 3.0, 0.5],
+                  'exponential': [2.0, 3.0, 0.5], 'spherical': [2.0, 3.0, 0.5]}
+        for model in params:
+            function = getattr(variogram_models, model + '_variogram_model')
+            jacobian = variogram_models.jacobian_dict[model](params[model], dist)
+            self.assertEqual(jacobian.shape, (dist.size, len(params[model])))
+            for k in range(len(params[model])):
+                step = np.zeros(len(params[model]))
+                step[k] = 1e-6
+                diff = (function(np.array(params[model]) + step, dist) -
+                        function(np.array(params[model]) - step, dist)) / 2e-6
+                self.assertTrue(np.allclose(jacobian[:, k], diff, 1e-4, 1e-6))
+
     def test_core_krige(self):
 
         # Example 3.2 from Kitanidis
@@ -198,6 +512,168 @@ class TestPyKrige(unittest.TestCase):
         self.assertFalse(anisotropy_scaling == ok.anisotropy_scaling)
         self.assertFalse(anisotropy_angle == ok.anisotropy_angle)
 
+    def test_kriging_matrix_cache(self):
+
+        ok = OrdinaryKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2])
+        self.assertTrue(ok.kriging_matrix is None)
+        z1, ss1 = ok.execute('grid', self.simple_gridx, self.simple_gridy)
+        a = ok.kriging_matrix
+        a_inv = ok.kriging_matrix_factor
+        self.assertEqual(a.shape, (6, 6))
+        z2, ss2 = ok.execute('grid', self.simple_gridx, self.simple_gridy, backend='loop')
+        self.assertTrue(ok.kriging_matrix is a)
+        self.assertTrue(ok.kriging_matrix_factor is a_inv)
+        self.assertTrue(np.allclose(z1, z2))
+        self.assertTrue(np.allclose(ss1, ss2))
+
+        ok.clear_kriging_cache()
+        self.assertTrue(ok.kriging_matrix is None)
+        self.assertTrue(ok.kriging_matrix_factor is None)
+
+        ok.execute('points', 1.0, 1.0)
+        ok.update_variogram_model('spherical')
+        self.assertTrue(ok.kriging_matrix is None)
+        z3, ss3 = ok.execute('grid', self.simple_gridx, self.simple_gridy)
+        self.assertFalse(np.allclose(ss1, ss3))
+
+        ok.X_ADJUSTED[0] += 1.0
+        ok.execute('points', 1.0, 1.0)
+        ok_ = OrdinaryKriging(ok.X_ADJUSTED, ok.Y_ADJUSTED, self.simple_data[:, 2], variogram_model='spherical',
+                              variogram_parameters=ok.variogram_model_parameters)
+        self.assertTrue(np.allclose(ok.kriging_matrix, ok_._get_kriging_matrix(5)))
+
+        uk = UniversalKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2],
+                              drift_terms=['regional_linear'])
+        uk.execute('grid', self.simple_gridx, self.simple_gridy)
+        self.assertEqual(uk.kriging_matrix.shape, (8, 8))
+        uk.update_variogram_model('linear')
+        self.assertTrue(uk.kriging_matrix is None)
+
+    def test_dual_kriging(self):
+
+        mask = np.zeros((self.simple_gridy.size, self.simple_gridx.size), dtype=bool)
+        mask[0, :] = True
+        drift_terms = ['regional_linear', 'functional']
+        functional_drift = [lambda x, y: x * y]
+        for k in [OrdinaryKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2],
+                                  variogram_model='spherical'),
+                  SimpleKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2],
+                                variogram_model='spherical'),
+                  UniversalKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2],
+                                   variogram_model='spherical', drift_terms=drift_terms,
+                                   functional_drift=functional_drift)]:
+            z, ss = k.execute('masked', self.simple_gridx, self.simple_gridy, mask=mask)
+            for backend in ['vectorized', 'loop']:
+                z_dual = k.execute('masked', self.simple_gridx, self.simple_gridy, mask=mask,
+                                   backend=backend, return_variance=False)
+                self.assertTrue(np.ma.allclose(z, z_dual))
+                self.assertTrue(np.all(z_dual.mask[0, :]))
+            # the dual weights are solved for once and shared by the blocks of max_memory
+            w = k.dual_weights
+            z_dual = k.execute('masked', self.simple_gridx, self.simple_gridy, mask=mask, return_variance=False,
+                               max_memory=1e-4)
+            self.assertTrue(np.ma.allclose(z, z_dual))
+            self.assertTrue(k.dual_weights is w)
+            k.clear_kriging_cache()
+            self.assertTrue(k.dual_weights is None)
+            z_dual = k.execute('points', self.simple_data[:, 0], self.simple_data[:, 1], return_variance=False)
+            self.assertTrue(np.allclose(z_dual, self.simple_data[:, 2]))
+
+        gridz = np.array([0., 0.5])
+        z_coords = self.simple_data[:, 0] * self.simple_data[:, 1]
+        for k in [OrdinaryKriging3D(self.simple_data[:, 0], self.simple_data[:, 1], z_coords,
+                                    self.simple_data[:, 2], variogram_model='spherical'),
+                  UniversalKriging3D(self.simple_data[:, 0], self.simple_data[:, 1], z_coords,
+                                     self.simple_data[:, 2], variogram_model='spherical',
+                                     drift_terms=['regional_linear'])]:
+            k3d, ss3d = k.execute('grid', self.simple_gridx, self.simple_gridy, gridz)
+            for backend in ['vectorized', 'loop']:
+                k3d_dual = k.execute('grid', self.simple_gridx, self.simple_gridy, gridz,
+                                     backend=backend, return_variance=False)
+                self.assertTrue(np.allclose(k3d, k3d_dual))
+
+    def test_vectorized_max_memory(self):
+
+        mask = np.zeros((self.simple_gridy.size, self.simple_gridx.size), dtype=bool)
+        mask[:, 2] = True
+        blocks = core._point_chunks(mask.flatten(), 6, max_memory=1e-3)
+        self.assertTrue(len(blocks) > 1)
+        self.assertTrue(np.all(np.concatenate(blocks) == np.nonzero(~mask.flatten())[0]))
+        self.assertEqual(len(core._point_chunks(mask.flatten(), 6)), 1)
+        self.assertEqual(len(core._point_chunks(np.ones(4, dtype=bool), 6)), 0)
+
+        for k in [OrdinaryKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2]),
+                  SimpleKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2],
+                                variogram_model='spherical')]:
+            z, ss = k.execute('masked', self.simple_gridx, self.simple_gridy, mask=mask, backend='loop')
+            z_b, ss_b = k.execute('masked', self.simple_gridx, self.simple_gridy, mask=mask, max_memory=1e-3)
+            self.assertTrue(np.ma.allclose(z, z_b))
+            self.assertTrue(np.ma.allclose(ss, ss_b))
+            self.assertTrue(np.all(z_b.mask == mask))
+            z_b, ss_b = k.execute('masked', self.simple_gridx, self.simple_gridy, mask=mask, backend='C',
+                                  max_memory=1e-3)
+            self.assertTrue(np.ma.allclose(z, z_b))
+            self.assertTrue(np.ma.allclose(ss, ss_b))
+            self.assertTrue(np.all(z_b.mask == mask))
+
+        xg, yg = np.meshgrid(self.simple_gridx, self.simple_gridy)
+        uk = UniversalKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2],
+                              drift_terms=['regional_linear', 'specified'],
+                              specified_drift=[self.simple_data[:, 0] * self.simple_data[:, 1]])
+        z, ss = uk.execute('grid', self.simple_gridx, self.simple_gridy, specified_drift_arrays=[xg * yg])
+        z_b, ss_b = uk.execute('grid', self.simple_gridx, self.simple_gridy, specified_drift_arrays=[xg * yg],
+                               max_memory=1e-3)
+        self.assertTrue(np.allclose(z, z_b))
+        self.assertTrue(np.allclose(ss, ss_b))
+        z_b, ss_b = uk.execute('grid', self.simple_gridx, self.simple_gridy, specified_drift_arrays=[xg * yg],
+                               backend='C', max_memory=1e-3)
+        self.assertTrue(np.allclose(z, z_b))
+        self.assertTrue(np.allclose(ss, ss_b))
+
+        z_coords = self.simple_data[:, 0] * self.simple_data[:, 1]
+        gridz = np.array([0., 0.5])
+        for k in [OrdinaryKriging3D(self.simple_data[:, 0], self.simple_data[:, 1], z_coords, self.simple_data[:, 2]),
+                  UniversalKriging3D(self.simple_data[:, 0], self.simple_data[:, 1], z_coords, self.simple_data[:, 2],
+                                     drift_terms=['regional_linear'])]:
+            k3d, ss3d = k.execute('grid', self.simple_gridx, self.simple_gridy, gridz)
+            k3d_b, ss3d_b = k.execute('grid', self.simple_gridx, self.simple_gridy, gridz, max_memory=1e-3)
+            self.assertTrue(np.allclose(k3d, k3d_b))
+            self.assertTrue(np.allclose(ss3d, ss3d_b))
+
+    def test_auto_backend(self):
+
+        choice = core._choose_backend(['vectorized', 'loop', 'C'], 101, 10000, max_memory=1000.)
+        self.assertEqual(set(choice['estimates'].keys()), set(['vectorized', 'loop', 'C']))
+        self.assertNotEqual(choice['backend'], 'loop')
+        choice = core._choose_backend(['vectorized', 'loop'], 5001, 4000000, max_memory=100.)
+        self.assertEqual(choice['backend'], 'vectorized')
+        self.assertEqual(choice['max_memory'], 100.)
+        choice = core._choose_backend(['loop', 'C'], 5001, 4000000, max_memory=100.)
+        self.assertEqual(choice['backend'], 'C')
+        self.assertEqual(choice['max_memory'], 100.)
+        self.assertTrue(choice['estimates']['C'][1] <= 100.)
+        choice = core._choose_backend(['loop', 'C'], 5001, 10000, n_closest_points=10, max_memory=100.)
+        self.assertEqual(choice['backend'], 'C')
+        self.assertTrue(choice['max_memory'] is None)
+
+        ok = OrdinaryKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2])
+        self.assertTrue(ok.backend_choice is None)
+        z, ss = ok.execute('grid', self.simple_gridx, self.simple_gridy)
+        z_a, ss_a = ok.execute('grid', self.simple_gridx, self.simple_gridy, backend='auto')
+        self.assertTrue(ok.backend_choice['backend'] in ['vectorized', 'loop', 'C'])
+        self.assertTrue(np.allclose(z, z_a))
+        self.assertTrue(np.allclose(ss, ss_a))
+        z_a, ss_a = ok.execute('grid', self.simple_gridx, self.simple_gridy, backend='auto', n_closest_points=3)
+        self.assertTrue(ok.backend_choice['backend'] in ['loop', 'C'])
+
+        uk = UniversalKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2],
+                              drift_terms=['regional_linear'])
+        z, ss = uk.execute('grid', self.simple_gridx, self.simple_gridy)
+        z_a, ss_a = uk.execute('grid', self.simple_gridx, self.simple_gridy, backend='auto')
+        self.assertTrue(uk.backend_choice['backend'] in ['vectorized', 'loop', 'C'])
+        self.assertTrue(np.allclose(z, z_a))
+        self.assertTrue(np.allclose(ss, ss_a))
+
     def test_ok_execute(self):
 
         ok = OrdinaryKriging(self.simple_data[:, 0], self.simple_data[:, 1], self.simple_data[:, 2])
@@ -278,6 +754,51 @@ class TestPyKrige(unittest.TestCase):
         self.assertTrue(np.allclose(z1, z2))
         self.assertTrue(np.allclose(ss1, ss2))
 
+    def test_cython_ok_n_jobs(self):
+
+        gridx = np.linspace(1067000.0, 1072000.0, 60)
+        gridy = np.linspace(241500.0, 244000.0, 40)
+        mask = np.zeros((gridy.size, gridx.size), dtype=bool)
+        mask[::3, ::2] = True
+        ok = OrdinaryKriging(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2],
+                             variogram_model='exponential')
+        z1, ss1 = ok.execute('masked', gridx, gridy, mask=mask, backend='vectorized')
+        z2, ss2 = ok.execute('masked', gridx, gridy, mask=mask, backend='C', n_jobs=4)
+        self.assertTrue(np.ma.allclose(z1, z2))
+        self.assertTrue(np.ma.allclose(ss1, ss2))
+        self.assertTrue(np.all(z2.mask == mask))
+        z3 = ok.execute('masked', gridx, gridy, mask=mask, backend='C', n_jobs=4, return_variance=False)
+        self.assertTrue(np.ma.allclose(z1, z3))
+        self.assertTrue(np.all(z3.mask == mask))
+
+        z1, ss1 = ok.execute('masked', gridx, gridy, mask=mask, backend='loop', n_closest_points=10)
+        z2, ss2 = ok.execute('masked', gridx, gridy, mask=mask, backend='C', n_closest_points=10, n_jobs=4)
+        self.assertTrue(np.ma.allclose(z1, z2))
+        self.assertTrue(np.ma.allclose(ss1, ss2))
+
+    def test_cython_sk(self):
+
+        gridx = np.linspace(1067000.0, 1072000.0, 30)
+        gridy = np.linspace(241500.0, 244000.0, 20)
+        mask = np.zeros((gridy.size, gridx.size), dtype=bool)
+        mask[::3, ::2] = True
+        sk = SimpleKriging(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2] - np.mean(self.test_data[:, 2]),
+                           variogram_model='spherical')
+        z1, ss1 = sk.execute('masked', gridx, gridy, mask=mask, backend='loop')
+        z2, ss2 = sk.execute('masked', gridx, gridy, mask=mask, backend='C', n_jobs=2)
+        self.assertTrue(np.ma.allclose(z1, z2))
+        self.assertTrue(np.ma.allclose(ss1, ss2))
+        self.assertTrue(np.all(z2.mask == mask))
+        z3 = sk.execute('masked', gridx, gridy, mask=mask, backend='C', return_variance=False)
+        self.assertTrue(np.ma.allclose(z1, z3))
+
+        z1, ss1 = sk.execute('masked', gridx, gridy, mask=mask, backend='loop', n_closest_points=10)
+        z2, ss2 = sk.execute('masked', gridx, gridy, mask=mask, backend='C', n_closest_points=10, n_jobs=2)
+        self.assertTrue(np.ma.allclose(z1, z2))
+        self.assertTrue(np.ma.allclose(ss1, ss2))
+        z, ss = sk.execute('points', self.test_data[:5, 0], self.test_data[:5, 1], backend='C', n_closest_points=10)
+        self.assertTrue(np.allclose(z, self.test_data[:5, 2] - np.mean(self.test_data[:, 2])))
+
     def test_uk(self):
 
         # Test to compare UK with linear drift to results from KT3D_H2O.
@@ -291,6 +812,222 @@ class TestPyKrige(unittest.TestCase):
         z, ss = uk.execute('grid', self.uk_test_gridx, self.uk_test_gridy, backend='loop')
         self.assertTrue(np.allclose(z, self.uk_test_answer))
 
+    def test_search_neighborhood(self):
+
+        self.assertRaises(ValueError, core.SearchNeighborhood)
+        self.assertRaises(ValueError, core.SearchNeighborhood, radius=-1.)
+        self.assertRaises(ValueError, core.SearchNeighborhood, max_points=2, min_points=3)
+
+        rng = np.random.RandomState(0)
+        data = rng.rand(200, 2) * 100.
+        points = rng.rand(30, 2) * 100.
+        sn = core.SearchNeighborhood(radius=20., min_points=3, max_points=12, max_per_sector=4)
+        indptr, indices, distances = sn.query(data, points)
+        for i in range(points.shape[0]):
+            dist = np.sqrt(np.sum((data - points[i])**2, axis=1))
+            selected = []
+            in_sector = np.zeros(4)
+            for j in np.argsort(dist):
+                sector = int(data[j, 0] >= points[i, 0]) + 2 * int(data[j, 1] >= points[i, 1])
+                if dist[j] <= 20. and in_sector[sector] < 4 and len(selected) < 12:
+                    in_sector[sector] += 1
+                    selected.append(j)
+            if len(selected) < 3:
+                selected = []
+            self.assertEqual(list(indices[indptr[i]:indptr[i + 1]]), selected)
+            self.assertTrue(np.allclose(distances[indptr[i]:indptr[i + 1]], dist[selected]))
+
+        # without a radius, the search goes on until the sectors are filled, even when
+        # the closest points all lie on one side of the target point
+        clustered = np.concatenate((np.column_stack((10. + rng.rand(40), rng.rand(40) - 0.5)),
+                                    np.column_stack((-20. - rng.rand(4), rng.rand(4)))))
+        for data_, points_, sn in [(clustered, np.zeros((1, 2)), core.SearchNeighborhood(max_points=8,
+                                                                                          max_per_sector=2)),
+                                   (data, points, core.SearchNeighborhood(min_points=3, max_points=12,
+                                                                          max_per_sector=2)),
+                                   (data[:20], points, core.SearchNeighborhood(max_points=12, max_per_sector=4))]:
+            indptr, indices, distances = sn.query(data_, points_)
+            for i in range(points_.shape[0]):
+                dist = np.sqrt(np.sum((data_ - points_[i])**2, axis=1))
+                selected = []
+                in_sector = np.zeros(4)
+                for j in np.argsort(dist):
+                    sector = int(data_[j, 0] >= points_[i, 0]) + 2 * int(data_[j, 1] >= points_[i, 1])
+                    if in_sector[sector] < sn.max_per_sector and len(selected) < sn.max_points:
+                        in_sector[sector] += 1
+                        selected.append(j)
+                if len(selected) < sn.min_points:
+                    selected = []
+                self.assertEqual(list(indices[indptr[i]:indptr[i + 1]]), selected)
+                self.assertTrue(np.allclose(distances[indptr[i]:indptr[i + 1]], dist[selected]))
+        indptr, indices, distances = core.SearchNeighborhood(max_points=8, max_per_sector=2).query(clustered,
+                                                                                                    np.zeros((1, 2)))
+        self.assertEqual(indptr[1], 6)
+
+        z = np.sin(data[:, 0] / 10.) + data[:, 1] / 50.
+        gridx = np.linspace(-30., 130., 40)
+        gridy = np.linspace(0., 100., 30)
+        sn = core.SearchNeighborhood(radius=15., min_points=4, max_points=16, max_per_sector=5)
+        for k in [OrdinaryKriging(data[:, 0], data[:, 1], z, variogram_model='spherical',
+                                  variogram_parameters=[1., 40., 0.01]),
+                  SimpleKriging(data[:, 0], data[:, 1], z - np.mean(z), variogram_model='spherical',
+                                variogram_parameters=[1., 40., 0.01])]:
+            z1, ss1 = k.execute('grid', gridx, gridy, backend='loop', search_neighborhood=sn)
+            z2, ss2 = k.execute('grid', gridx, gridy, backend='C', search_neighborhood=sn, n_jobs=2)
+            self.assertTrue(np.any(np.isnan(z1)))
+            self.assertTrue(np.all(np.isnan(z1) == np.isnan(ss1)))
+            self.assertTrue(np.allclose(z1, z2, equal_nan=True))
+            self.assertTrue(np.allclose(ss1, ss2, equal_nan=True))
+            z1, ss1 = k.execute('grid', gridx, gridy, backend='C', n_closest_points=10)
+            z2, ss2 = k.execute('grid', gridx, gridy, backend='C',
+                                search_neighborhood=core.SearchNeighborhood(max_points=10))
+            self.assertTrue(np.allclose(z1, z2))
+            self.assertTrue(np.allclose(ss1, ss2))
+            self.assertRaises(ValueError, k.execute, 'grid', gridx, gridy, n_closest_points=10,
+                              search_neighborhood=sn)
+
+        data = np.genfromtxt('./test_data/test3d_data.txt', skip_header=1)
+        grid = np.arange(10.)
+        ok3d = OrdinaryKriging3D(data[:, 0], data[:, 1], data[:, 2], data[:, 3], variogram_model='linear',
+                                 variogram_parameters=[1., 0.1])
+        sn = core.SearchNeighborhood(radius=6., min_points=2, max_per_sector=1)
+        k1, ss1 = ok3d.execute('grid', grid, grid, grid, backend='loop', search_neighborhood=sn)
+        k2, ss2 = ok3d.execute('grid', grid, grid, grid, backend='C', search_neighborhood=sn)
+        self.assertTrue(np.allclose(k1, k2, equal_nan=True))
+        self.assertTrue(np.allclose(ss1, ss2, equal_nan=True))
+
+    def test_moving_window_shared_neighborhoods(self):
+
+        indptr = np.array([0, 2, 4, 4, 6, 8])
+        indices = np.array([3, 1, 1, 3, 0, 2, 1, 3])
+        distances = np.array([1., 2., 3., 4., 5., 6., 7., 8.])
+        mask = np.array([False, False, False, False, True])
+        indices, distances, points, group_ptr = core._neighborhood_groups(indptr, indices, distances, mask)
+        self.assertEqual(list(indices), [1, 3, 1, 3, 0, 2, 1, 3])
+        self.assertEqual(list(distances), [2., 1., 3., 4., 5., 6., 7., 8.])
+        self.assertEqual(list(points), [3, 0, 1])
+        self.assertEqual(list(group_ptr), [0, 1, 3])
+
+        # a fine grid over sparse data, where many points share the same neighbors
+        rng = np.random.RandomState(1)
+        data = rng.rand(25, 2) * 100.
+        z = np.cos(data[:, 0] / 20.) + data[:, 1] / 40.
+        gridx = np.linspace(0., 100., 60)
+        gridy = np.linspace(0., 100., 50)
+        mask = rng.rand(50, 60) < 0.1
+        for krige in [OrdinaryKriging, SimpleKriging]:
+            k = krige(data[:, 0], data[:, 1], z, variogram_model='exponential',
+                      variogram_parameters=[1., 30., 0.01])
+            z1, ss1 = k.execute('masked', gridx, gridy, mask=mask, backend='loop', n_closest_points=6)
+            z2, ss2 = k.execute('masked', gridx, gridy, mask=mask, backend='C', n_closest_points=6, n_jobs=2)
+            self.assertTrue(np.allclose(z1, z2))
+            self.assertTrue(np.allclose(ss1, ss2))
+            self.assertTrue(np.all(z1.mask == mask))
+            # each point matches kriging from its own neighbors only
+            for i, j in [(0, 0), (10, 37), (49, 59), (25, 5)]:
+                if mask[i, j]:
+                    continue
+                near = np.argsort((data[:, 0] - gridx[j])**2 + (data[:, 1] - gridy[i])**2)[:6]
+                k_near = krige(data[near, 0], data[near, 1], z[near], variogram_model='exponential',
+                               variogram_parameters=[1., 30., 0.01])
+                z3, ss3 = k_near.execute('points', gridx[j:j + 1], gridy[i:i + 1])
+                self.assertAlmostEqual(z1[i, j], z3[0], 6)
+                self.assertAlmostEqual(ss1[i, j], ss3[0], 6)
+
+        data = np.genfromtxt('./test_data/test3d_data.txt', skip_header=1)
+        grid = np.linspace(0., 10., 15)
+        ok3d = OrdinaryKriging3D(data[:, 0], data[:, 1], data[:, 2], data[:, 3], variogram_model='linear',
+                                 variogram_parameters=[1., 0.1])
+        k1, ss1 = ok3d.execute('grid', grid, grid, grid, backend='loop', n_closest_points=4)
+        k2, ss2 = ok3d.execute('grid', grid, grid, grid, backend='C', n_closest_points=4)
+        self.assertTrue(np.allclose(k1, k2))
+        self.assertTrue(np.allclose(ss1, ss2))
+
+    def test_cython_uk(self):
+
+        gridx = np.linspace(1067000.0, 1072000.0, 30)
+        gridy = np.linspace(241500.0, 244000.0, 20)
+        mask = np.zeros((gridy.size, gridx.size), dtype=bool)
+        mask[::3, ::2] = True
+        func = lambda x, y: (x - 1069000.0) * (y - 242500.0) / 1e6
+        spec = (self.test_data[:, 0] / 1e3 - 1069.0)**2
+        spec_grid = np.tile((gridx / 1e3 - 1069.0)**2, (gridy.size, 1))
+        uk = UniversalKriging(self.test_data[:, 0], self.test_data[:, 1], self.test_data[:, 2],
+                              variogram_model='exponential', variogram_parameters=[500.0, 3000.0, 0.0],
+                              drift_terms=['regional_linear', 'specified', 'functional'],
+                              specified_drift=[spec], functional_drift=[func])
+        z1, ss1 = uk.execute('masked', gridx, gridy, mask=mask, backend='loop', specified_drift_arrays=[spec_grid])
+        z2, ss2 = uk.execute('masked', gridx, gridy, mask=mask, backend='C', specified_drift_arrays=[spec_grid],
+                             n_jobs=2)
+        self.assertTrue(np.ma.allclose(z1, z2))
+        self.assertTrue(np.ma.allclose(ss1, ss2))
+        self.assertTrue(np.all(z2.mask == mask))
+        z3 = uk.execute('masked', gridx, gridy, mask=mask, backend='C', specified_drift_arrays=[spec_grid],
+                        return_variance=False)
+        self.assertTrue(np.ma.allclose(z1, z3))
+
+        # with all of the data points in the window, the moving window is the global system
+        n = self.test_data.shape[0]
+        z4, ss4 = uk.execute('masked', gridx, gridy, mask=mask, backend='C', specified_drift_arrays=[spec_grid],
+                             n_closest_points=n, n_jobs=2)
+        self.assertTrue(np.ma.allclose(z1, z4))
+        self.assertTrue(np.ma.allclose(ss1, ss4))
+        z, ss = uk.execute('points', self.test_data[:, 0], self.test_data[:, 1], backend='C',
+                           specified_drift_arrays=[spec], n_closest_points=n - 1)
+        self.assertTrue(np.allclose(z, self.test_data[:, 2]))
+        z5, ss5 = uk.execute('masked', gridx, gridy, mask=mask, backend='loop', specified_drift_arrays=[spec_grid],
+                             n_closest_points=n)
+        self.assertTrue(np.ma.allclose(z1, z5))
+        self.assertTrue(np.ma.allclose(ss1, ss5))
+        self.assertRaises(ValueError, uk.execute, 'masked', gridx, gridy, mask=mask, backend='vectorized',
+                          specified_drift_arrays=[spec_grid], n_closest_points=n)
+
+    def test_uk_moving_window_rank_deficient_drift(self):
+
+        # samples along three lines far apart: the closest points of a target near a
+        # line lie on that line, which cannot determine the y-component of the drift
+        x = np.tile(np.linspace(0., 10., 11), 3)
+        y = np.repeat([0., 50., 100.], 11)
+        z = np.sin(x) + 0.01 * y
+        uk = UniversalKriging(x, y, z, variogram_model='spherical', variogram_parameters=[1., 20., 0.],
+                              drift_terms=['regional_linear'])
+        f = np.concatenate((x[:5, np.newaxis], y[:5, np.newaxis], np.ones((5, 1))), axis=1)
+        self.assertTrue(np.array_equal(uk._get_independent_drift(f), [0, 2]))
+        self.assertTrue(np.array_equal(uk._get_independent_drift(f[:, [0, 2]]), [0, 1]))
+
+        # a window is flagged as deficient exactly when a drift term is dropped from it
+        n = x.size
+        a = uk._get_kriging_matrix(n, uk._get_n_withdrifts())
+        rng = np.random.RandomState(0)
+        bd_idx = np.array([rng.choice(n, 5, replace=False) for _ in range(200)])
+        bd_idx[:50] = rng.randint(0, 11, size=(50, 5)) + 11 * rng.randint(0, 3, size=(50, 1))
+        deficient = uk._get_deficient_windows(a, bd_idx, a.shape[1] - n)
+        dropped = [uk._get_independent_drift(a[idx, n:]).size < a.shape[1] - n for idx in bd_idx]
+        self.assertTrue(np.array_equal(deficient, dropped))
+        self.assertTrue(deficient[:50].all())
+        self.assertFalse(deficient.all())
+
+        gridx = np.linspace(0.5, 9.5, 10)
+        gridy = np.array([1., 49., 99.])
+        z_l, ss_l = uk.execute('grid', gridx, gridy, backend='loop', n_closest_points=6)
+        self.assertTrue(np.all(np.isfinite(z_l)))
+        self.assertTrue(np.all(ss_l > 0.))
+        z_c, ss_c = uk.execute('grid', gridx, gridy, backend='C', n_closest_points=6)
+        self.assertTrue(np.allclose(z_l, z_c))
+        self.assertTrue(np.allclose(ss_l, ss_c))
+        z_p, ss_p = uk.execute('points', x, y, backend='loop', n_closest_points=6)
+        self.assertTrue(np.allclose(z_p, z))
+
+        # with a single neighbor, only the unbiasedness term is left and each point gets
+        # the value of its closest data point
+        xpts = gridx - 0.2
+        nearest = np.argmin((xpts[:, np.newaxis] - x)**2 + (gridy[1] - y)**2, axis=1)
+        for backend in ['loop', 'C']:
+            z_1, ss_1 = uk.execute('points', xpts, np.full(xpts.size, gridy[1]), backend=backend,
+                                   n_closest_points=1)
+            self.assertTrue(np.allclose(z_1, z[nearest]))
+            self.assertTrue(np.all(ss_1 > 0.))
+
     def test_uk_update_variogram_model(self):
 
         self.assertRaises(ValueError, UniversalKriging, self.test_data[:, 0], self.test_data[:, 1],
@@ -1043,6 +1780,55 @@ class TestPyKrige(unittest.TestCase):
         self.assertTrue(np.allclose(k_k3d_v, k_k3d_l))
         self.assertTrue(np.allclose(ss_k3d_v, ss_k3d_l))
 
+    def test_cython_ok3d_uk3d(self):
+
+        data = np.genfromtxt('./test_data/test3d_data.txt', skip_header=1)
+        grid = np.arange(10.)
+        mask = np.zeros((10, 10, 10), dtype=bool)
+        mask[::2, ::3, ::2] = True
+        func = lambda x, y, z: x * y / 10.
+        spec = data[:, 2]**2
+        zg, yg, xg = np.meshgrid(grid, grid, grid, indexing='ij')
+        for k, kwargs in [(OrdinaryKriging3D(data[:, 0], data[:, 1], data[:, 2], data[:, 3],
+                                             variogram_model='linear', variogram_parameters=[1., 0.1]), {}),
+                          (UniversalKriging3D(data[:, 0], data[:, 1], data[:, 2], data[:, 3],
+                                              variogram_model='linear', variogram_parameters=[1., 0.1],
+                                              drift_terms=['regional_linear', 'specified', 'functional'],
+                                              specified_drift=[spec], functional_drift=[func]),
+                           {'specified_drift_arrays': [zg**2]})]:
+            k_l, ss_l = k.execute('masked', grid, grid, grid, mask=mask, backend='loop', **kwargs)
+            k_c, ss_c = k.execute('masked', grid, grid, grid, mask=mask, backend='C', n_jobs=2, **kwargs)
+            self.assertTrue(np.ma.allclose(k_l, k_c))
+            self.assertTrue(np.ma.allclose(ss_l, ss_c))
+            self.assertTrue(np.all(k_c.mask == mask))
+            k_c = k.execute('masked', grid, grid, grid, mask=mask, backend='C', return_variance=False,
+                            max_memory=1e-2, **kwargs)
+            self.assertTrue(np.ma.allclose(k_l, k_c))
+
+    def test_ok3d_moving_window(self):
+
+        data = np.genfromtxt('./test_data/test3d_data.txt', skip_header=1)
+        grid = np.arange(10.)
+        mask = np.zeros((10, 10, 10), dtype=bool)
+        mask[::2, ::3, ::2] = True
+        ok3d = OrdinaryKriging3D(data[:, 0], data[:, 1], data[:, 2], data[:, 3], variogram_model='linear',
+                                 variogram_parameters=[1., 0.1], anisotropy_scaling_z=2.)
+        k, ss = ok3d.execute('masked', grid, grid, grid, mask=mask, backend='loop')
+        k_l, ss_l = ok3d.execute('masked', grid, grid, grid, mask=mask, backend='loop', n_closest_points=data.shape[0])
+        self.assertTrue(np.ma.allclose(k, k_l))
+        self.assertTrue(np.ma.allclose(ss, ss_l))
+
+        k_l, ss_l = ok3d.execute('masked', grid, grid, grid, mask=mask, backend='loop', n_closest_points=5)
+        k_c, ss_c = ok3d.execute('masked', grid, grid, grid, mask=mask, backend='C', n_closest_points=5, n_jobs=2)
+        self.assertTrue(np.ma.allclose(k_l, k_c))
+        self.assertTrue(np.ma.allclose(ss_l, ss_c))
+        self.assertTrue(np.all(k_c.mask == mask))
+        self.assertFalse(np.ma.allclose(k, k_l))
+        k_p, ss_p = ok3d.execute('points', data[:, 0], data[:, 1], data[:, 2], backend='C', n_closest_points=5)
+        self.assertTrue(np.allclose(k_p, data[:, 3]))
+        self.assertRaises(ValueError, ok3d.execute, 'grid', grid, grid, grid, backend='vectorized',
+                          n_closest_points=5)
+
     def test_ok3d_execute(self):
 
         k3d = OrdinaryKriging3D(self.simple_data_3d[:, 0], self.simple_data_3d[:, 1],
@@ -65,6 +65,22 @@ class UniversalKriging:
             variogram_parameters will be passed to the function as the first argument.
         nlags (int, optional): Number of averaging bins for the semivariogram.
             Default is 6.
+        lag_bins (string or array-like, optional): Specifies the semivariogram lag bins.
+            'linear' gives nlags bins of equal width and 'geometric' gives nlags bins
+            whose widths grow by a constant factor; an array of bin edges may also be
+            given, in which case nlags is ignored. Default is None, which halves
+            the bin widths toward the shortest lags.
+        max_lag (float, optional): Largest separation distance of the data pairs used
+            to calculate the semivariogram. Only the pairs within max_lag are looked up
+            (with a KD-tree), which saves time and memory for large data sets.
+            Default is None, which uses all of the data pairs.
+        sample_pairs (int, optional): If specified, the semivariogram is estimated from
+            a random sample of the data pairs instead of all of them, for very large
+            data sets. Pairs are drawn until each lag bin holds about sample_pairs/nlags
+            of them (or for at most ten rounds of sample_pairs draws). Default is None.
+        random_state (int or numpy RandomState, optional): Seed or random number
+            generator used with sample_pairs, so that the sample can be reproduced.
+            Default is None.
         weight (boolean, optional): Flag that specifies if semivariance at smaller lags
             should be weighted more heavily when automatically calculating variogram model.
             True indicates that weights will be applied. Default is False.
@@ -142,6 +158,22 @@ class UniversalKriging:
                     more information.
                 nlags (int, optional): Number of averaging bins for the semivariogram.
                     Defualt is 6.
+                lag_bins (string or array-like, optional): Specifies the semivariogram lag bins.
+                    'linear' gives nlags bins of equal width and 'geometric' gives nlags bins
+                    whose widths grow by a constant factor; an array of bin edges may also be
+                    given, in which case nlags is ignored. Default is None, which halves
+                    the bin widths toward the shortest lags.
+                max_lag (float, optional): Largest separation distance of the data pairs used
+                    to calculate the semivariogram. Only the pairs within max_lag are looked up
+                    (with a KD-tree), which saves time and memory for large data sets.
+                    Default is None, which uses all of the data pairs.
+                sample_pairs (int, optional): If specified, the semivariogram is estimated from
+                    a random sample of the data pairs instead of all of them, for very large
+                    data sets. Pairs are drawn until each lag bin holds about sample_pairs/nlags
+                    of them (or for at most ten rounds of sample_pairs draws). Default is None.
+                random_state (int or numpy RandomState, optional): Seed or random number
+                    generator used with sample_pairs, so that the sample can be reproduced.
+                    Default is None.
                 weight (boolean, optional): Flag that specifies if semivariance at smaller lags
                     should be weighted more heavily when automatically calculating variogram model.
                     True indicates that weights will be applied. Default is False.
@@ -167,6 +199,13 @@ class UniversalKriging:
             the variogram fit. NOTE that ideally Q1 is close to zero,
             Q2 is close to 1, and cR is as small as possible.
 
+        cross_validate(n_closest_points=None, backend='loop', n_jobs=1): Returns the leave-one-out
+            cross-validation residuals and kriging variances at the data points.
+
+        clear_kriging_cache(): Clears the kriging matrix, its factorization and the dual weights,
+            which are cached (as kriging_matrix, kriging_matrix_factor and dual_weights) and reused
+            by execute until the variogram model is updated or the data coordinates change.
+
         execute(style, xpoints, ypoints, mask=None): Calculates a kriged grid.
             Inputs:
                 style (string): Specifies how to treat input kriging points.
@@ -194,7 +233,16 @@ class UniversalKriging:
                     significant amount of memory for large grids and/or large datasets.
                     Specifying 'loop' will loop through each point at which the kriging system
                     is to be solved. This approach is slower but also less memory-intensive.
-                    Default is 'vectorized'. Note that the Cython backend is not supported for UK.
+                    Specifying 'C' will utilize a loop in Cython.
+                    Specifying 'auto' will pick the fastest of these that fits in memory (max_memory,
+                    or half of the available memory if not given) from a rough estimate of the cost,
+                    and store the choice and the estimates in backend_choice.
+                    Default is 'vectorized'.
+                n_closest_points (int, optional): For kriging with a moving window, specifies the number
+                    of nearby points to use in the calculation. The system of each point is assembled from
+                    the kriging matrix rows of these points and their drift terms. Drift terms that the
+                    selected points cannot determine (e.g., a linear drift over collinear points) are
+                    dropped from that point's system. Supported by the 'loop' and 'C' backends.
                 specified_drift_arrays (list of numpy arrays, optional): Specifies the drift values
                     at the points at which the kriging system is to be evaluated. Required if
                     'specified' drift provided in the list of drift terms when instantiating the
@@ -204,6 +252,15 @@ class UniversalKriging:
                     i.e., the arrays either must be dim MxN, where M is the number of y grid-points
                     and N is the number of x grid-points, or dim M, where M is the number of points
                     at which to evaluate the kriging system.
+                return_variance (bool, optional): If False, only the kriged values are calculated
+                    and returned, using dual kriging: the kriging system is solved once for the data
+                    values, so that each point only costs a dot product instead of a solve.
+                    Default is True.
+                max_memory (float, optional): For the vectorized and C backends, the approximate memory (in MB)
+                    that the temporary arrays may take. The points are then kriged in blocks of the
+                    largest size that fits. Default is None, which kriges all the points at once.
+                n_jobs (int, optional): Number of threads over which the points are spread with the
+                    'C' backend (requires the extension to be built with OpenMP). Default is 1.
             Outputs:
                 zvalues (numpy array, dim MxN or dim Nx1): Z-values of specified grid or at the
                     specified set of points. If style was specified as 'masked', zvalues will
@@ -211,6 +268,7 @@ class UniversalKriging:
                 sigmasq (numpy array, dim MxN or dim Nx1): Variance at specified grid points or
                     at the specified set of points. If style was specified as 'masked', sigmasq
                     will be a numpy masked array.
+                    Only returned if return_variance is True.
 
     References:
         P.K. Kitanidis, Introduction to Geostatistcs: Applications in Hydrogeology,
@@ -219,6 +277,7 @@ class UniversalKriging:
 
     UNBIAS = True   # This can be changed to remove the unbiasedness condition
                     # Really for testing purposes only...
+    DRIFT_TOL = 1e-10   # Relative tolerance below which a drift term is dropped from a moving window
     eps = 1.e-10    # Cutoff for comparison to zero
     variogram_dict = {'linear': variogram_models.linear_variogram_model,
                       'power': variogram_models.power_variogram_model,
@@ -230,7 +289,8 @@ class UniversalKriging:
                  variogram_function=None, nlags=6, weight=False, anisotropy_scaling=1.0,
                  anisotropy_angle=0.0, drift_terms=None, point_drift=None,
                  external_drift=None, external_drift_x=None, external_drift_y=None,
-                 specified_drift=None, functional_drift=None, verbose=False, enable_plotting=False):
+                 specified_drift=None, functional_drift=None, verbose=False, enable_plotting=False,
+                 lag_bins=None, max_lag=None, sample_pairs=None, random_state=None):
 
         # Deal with mutable default argument
         if drift_terms is None:
@@ -247,6 +307,7 @@ class UniversalKriging:
         self.Y_ORIG = np.atleast_1d(np.squeeze(np.array(y, copy=True)))
         self.Z = np.atleast_1d(np.squeeze(np.array(z, copy=True)))
 
+        self.backend_choice = None
         self.verbose = verbose
         self.enable_plotting = enable_plotting
         if self.enable_plotting and self.verbose:
@@ -263,6 +324,7 @@ class UniversalKriging:
                                        self.XCENTER, self.YCENTER,
                                        self.anisotropy_scaling, self.anisotropy_angle)
 
+        self.clear_kriging_cache()
         self.variogram_model = variogram_model
         if self.variogram_model not in self.variogram_dict.keys() and self.variogram_model != 'custom':
             raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
@@ -275,10 +337,12 @@ class UniversalKriging:
             self.variogram_function = self.variogram_dict[self.variogram_model]
         if self.verbose:
             print "Initializing variogram model..."
-        self.lags, self.semivariance, self.variogram_model_parameters = \
+        self.lags, self.semivariance, self.semivariance_error, self.variogram_model_parameters = \
             core.initialize_variogram_model(self.X_ADJUSTED, self.Y_ADJUSTED, self.Z,
                                             self.variogram_model, variogram_parameters,
-                                            self.variogram_function, nlags, weight)
+                                            self.variogram_function, nlags, weight, lag_bins=lag_bins,
+                                            max_lag=max_lag, sample_pairs=sample_pairs,
+                                            random_state=random_state)
         if self.verbose:
             if self.variogram_model == 'linear':
                 print "Using '%s' Variogram Model" % 'linear'
@@ -494,7 +558,8 @@ class UniversalKriging:
 
     def update_variogram_model(self, variogram_model, variogram_parameters=None,
                                variogram_function=None, nlags=6, weight=False,
-                               anisotropy_scaling=1.0, anisotropy_angle=0.0):
+                               anisotropy_scaling=1.0, anisotropy_angle=0.0, lag_bins=None,
+                               max_lag=None, sample_pairs=None, random_state=None):
         """Allows user to update variogram type and/or variogram model parameters."""
 
         if anisotropy_scaling != self.anisotropy_scaling or \
@@ -510,6 +575,7 @@ class UniversalKriging:
                                            self.anisotropy_scaling,
                                            self.anisotropy_angle)
 
+        self.clear_kriging_cache()
         self.variogram_model = variogram_model
         if self.variogram_model not in self.variogram_dict.keys() and self.variogram_model != 'custom':
             raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
@@ -522,10 +588,12 @@ class UniversalKriging:
             self.variogram_function = self.variogram_dict[self.variogram_model]
         if self.verbose:
             print "Updating variogram mode..."
-        self.lags, self.semivariance, self.variogram_model_parameters = \
+        self.lags, self.semivariance, self.semivariance_error, self.variogram_model_parameters = \
             core.initialize_variogram_model(self.X_ADJUSTED, self.Y_ADJUSTED, self.Z,
                                             self.variogram_model, variogram_parameters,
-                                            self.variogram_function, nlags, weight)
+                                            self.variogram_function, nlags, weight, lag_bins=lag_bins,
+                                            max_lag=max_lag, sample_pairs=sample_pairs,
+                                            random_state=random_state)
         if self.verbose:
             if self.variogram_model == 'linear':
                 print "Using '%s' Variogram Model" % 'linear'
@@ -596,6 +664,152 @@ class UniversalKriging:
         print "Q2 =", self.Q2
         print "cR =", self.cR
 
+    def cross_validate(self, n_closest_points=None, backend='loop', n_jobs=1):
+        """Leave-one-out cross-validation of the kriging model. Each data point is
+        kriged from all of the other data points; for a global model, this is done
+        for all of the points at once from a single inversion of the kriging matrix
+        (see core.leave_one_out).
+
+        Inputs:
+            n_closest_points (int, optional): For kriging with a moving window, specifies
+                the number of nearby points to use in kriging each data point (not counting
+                the point itself), as in execute. Each data point is then kriged from its own
+                neighborhood, with the drift terms that the neighborhood can determine.
+                Must be smaller than the number of data points.
+                Default is None, which uses all of the other data points.
+            backend (string, optional): For a moving window, specifies whether the
+                neighborhoods are kriged in a Python loop ('loop') or in Cython ('C'),
+                as in execute. Default is 'loop'.
+            n_jobs (int, optional): Number of threads over which the data points are
+                spread with the 'C' backend. Default is 1.
+
+        Outputs:
+            residuals (numpy array, dim N): Data values minus their kriging estimates
+                from the other data points.
+            sigmasq (numpy array, dim N): Kriging variances at the data points.
+        """
+
+        n = self.X_ADJUSTED.shape[0]
+        n_withdrifts = self._get_n_withdrifts()
+        a = self._get_cached_kriging_matrix(n, n_withdrifts)
+        if n_closest_points is None:
+            return core.leave_one_out(self._get_cached_kriging_matrix_factor(), self.Z)
+
+        xy_data = np.concatenate((self.X_ADJUSTED[:, np.newaxis], self.Y_ADJUSTED[:, np.newaxis]), axis=1)
+        indptr, indices, distances = core._leave_one_out_neighborhoods(xy_data, n_closest_points)
+        bd = distances.reshape((n, n_closest_points))
+        bd_idx = indices.reshape((n, n_closest_points))
+        # the drift rows at the data points are the drift columns of the kriging matrix
+        drift = np.ascontiguousarray(a[:n, n:])
+        mask = np.zeros(n, dtype='bool')
+
+        if backend == 'C':
+            try:
+                from .lib.cuk import _c_exec_loop_moving_window
+            except ImportError:
+                print('Warning: failed to load Cython extensions.\n'\
+                      '   See https://github.com/bsmurphy/PyKrige/issues/8 \n'\
+                      '   Falling back to a pure python backend...')
+                backend = 'loop'
+            except:
+                raise RuntimeError("Unknown error in trying to load Cython extension.")
+
+        if backend == 'loop':
+            zvalues, sigmasq = self._exec_loop_moving_window(a, bd, mask, bd_idx, drift)
+        elif backend == 'C':
+            c_pars = {key: getattr(self, key) for key in ['Z', 'eps', 'variogram_model_parameters',
+                                                          'variogram_function']}
+            deficient = self._get_deficient_windows(a, bd_idx, drift.shape[1])
+            zvalues, sigmasq = _c_exec_loop_moving_window(a, bd, deficient.astype('int8'), bd_idx, n,
+                                                          drift, c_pars, n_jobs)
+            if deficient.any():
+                if self.verbose:
+                    print "Dropping drift terms at", np.sum(deficient), "points.\n"
+                z, ss = self._exec_loop_moving_window(a, bd, ~deficient, bd_idx, drift)
+                zvalues[deficient] = z[deficient]
+                sigmasq[deficient] = ss[deficient]
+        else:
+            raise ValueError('Specified backend {} for a moving window is not supported.'.format(backend))
+
+        return self.Z - zvalues, sigmasq
+
+    def clear_kriging_cache(self):
+        """Clears the cached kriging matrix, its factorization and the dual weights.
+        These are otherwise assembled once and reused by every call to execute; they are
+        also cleared by update_variogram_model and rebuilt if the data coordinates change."""
+        self.kriging_matrix = None
+        self.kriging_matrix_factor = None
+        self.dual_weights = None
+        self._kriging_matrix_coords = None
+
+    def _get_n_withdrifts(self):
+        """Returns the number of data points plus the number of drift terms, i.e. the
+        size of the kriging matrix without its unbiasedness row."""
+
+        n_withdrifts = self.X_ADJUSTED.shape[0]
+        if self.regional_linear_drift:
+            n_withdrifts += 2
+        if self.point_log_drift:
+            n_withdrifts += self.point_log_array.shape[0]
+        if self.external_Z_drift:
+            n_withdrifts += 1
+        if self.specified_drift:
+            n_withdrifts += len(self.specified_drift_data_arrays)
+        if self.functional_drift:
+            n_withdrifts += len(self.functional_drift_terms)
+
+        return n_withdrifts
+
+    def _get_cached_kriging_matrix(self, n, n_withdrifts):
+        """Returns the kriging matrix, assembling it only if it is not cached."""
+
+        coords = (self.X_ADJUSTED, self.Y_ADJUSTED)
+        if self.kriging_matrix is None or \
+                not all([np.array_equal(c, c_) for c, c_ in zip(coords, self._kriging_matrix_coords)]):
+            self.clear_kriging_cache()
+            self.kriging_matrix = self._get_kriging_matrix(n, n_withdrifts)
+            self._kriging_matrix_coords = tuple([np.copy(c) for c in coords])
+
+        return self.kriging_matrix
+
+    def _get_cached_kriging_matrix_factor(self):
+        """Returns the LU factorization of the cached kriging matrix, factoring it
+        only if it is not cached."""
+
+        if self.kriging_matrix_factor is None:
+            lu, piv = scipy.linalg.lu_factor(self.kriging_matrix)
+            if np.any(np.diag(lu) == 0.0):
+                raise np.linalg.LinAlgError("Singular matrix")
+            self.kriging_matrix_factor = (lu, piv)
+
+        return self.kriging_matrix_factor
+
+    def _solve_kriging_system(self, b):
+        """Solves the kriging system for the right hand sides in the columns of b,
+        all at once, with the cached factorization of the kriging matrix. LAPACK is
+        called directly, since scipy's wrappers cost more than the solve itself
+        for one right hand side of a small system."""
+
+        lu, piv = self._get_cached_kriging_matrix_factor()
+        x, info = scipy.linalg.lapack.dgetrs(lu, piv, np.asarray(b))
+
+        return x
+
+    def _get_dual_weights(self):
+        """Solves the kriging system once for the data values (with zeros in the
+        remaining rows). The kriged value at a point is then simply the dot product
+        of these dual weights with the right hand side of the point. The weights are
+        cached with the factorization, so that the points of every block and every
+        call to execute share the one solve."""
+
+        if self.dual_weights is None:
+            n = self.X_ADJUSTED.shape[0]
+            rhs = np.zeros((self.kriging_matrix.shape[0], 1))
+            rhs[:n, 0] = self.Z
+            self.dual_weights = self._solve_kriging_system(rhs)[:, 0]
+
+        return self.dual_weights
+
     def _get_kriging_matrix(self, n, n_withdrifts):
         """Assembles the kriging matrix."""
 
@@ -648,34 +862,23 @@ class UniversalKriging:
 
         return a
 
-    def _exec_vector(self, a, bd, xy, xy_orig, mask, n_withdrifts, spec_drift_grids):
-        """Solves the kriging system as a vectorized operation. This method
-        can take a lot of memory for large grids and/or large datasets."""
+    def _get_drift_rows(self, xy, xy_orig, n_withdrifts, spec_drift_grids):
+        """Returns the drift terms (and the unbiasedness term) of the right hand sides
+        at the specified points, i.e. the rows of the kriging system that follow
+        the variogram values (dim npt x number of drift terms [+1])."""
 
-        npt = bd.shape[0]
+        npt = xy.shape[0]
         n = self.X_ADJUSTED.shape[0]
-        zero_index = None
-        zero_value = False
-
-        a_inv = scipy.linalg.inv(a)
-
-        if np.any(np.absolute(bd) <= self.eps):
-            zero_value = True
-            zero_index = np.where(np.absolute(bd) <= self.eps)
-
         if self.UNBIAS:
-            b = np.zeros((npt, n_withdrifts+1, 1))
+            drift = np.zeros((npt, n_withdrifts - n + 1))
         else:
-            b = np.zeros((npt, n_withdrifts, 1))
-        b[:, :n, 0] = - self.variogram_function(self.variogram_model_parameters, bd)
-        if zero_value:
-            b[zero_index[0], zero_index[1], 0] = 0.0
+            drift = np.zeros((npt, n_withdrifts - n))
 
-        i = n
+        i = 0
         if self.regional_linear_drift:
-            b[:, i, 0] = xy[:, 0]
+            drift[:, i] = xy[:, 0]
             i += 1
-            b[:, i, 0] = xy[:, 1]
+            drift[:, i] = xy[:, 1]
             i += 1
         if self.point_log_drift:
             for well_no in range(self.point_log_array.shape[0]):
@@ -683,38 +886,67 @@ class UniversalKriging:
                                           (xy[:, 1] - self.point_log_array[well_no, 1])**2))
                 if np.any(np.isinf(log_dist)):
                     log_dist[np.isinf(log_dist)] = -100.0
-                b[:, i, 0] = - self.point_log_array[well_no, 2] * log_dist
+                drift[:, i] = - self.point_log_array[well_no, 2] * log_dist
                 i += 1
         if self.external_Z_drift:
-            b[:, i, 0] = self._calculate_data_point_zscalars(xy_orig[:, 0], xy_orig[:, 1])
+            drift[:, i] = self._calculate_data_point_zscalars(xy_orig[:, 0], xy_orig[:, 1])
             i += 1
         if self.specified_drift:
             for spec_vals in spec_drift_grids:
-                b[:, i, 0] = spec_vals.flatten()
+                drift[:, i] = spec_vals.flatten()
                 i += 1
         if self.functional_drift:
             for func in self.functional_drift_terms:
-                b[:, i, 0] = func(xy[:, 0], xy[:, 1])
+                drift[:, i] = func(xy[:, 0], xy[:, 1])
                 i += 1
-        if i != n_withdrifts:
+        if i != n_withdrifts - n:
             print "WARNING: Error in setting up kriging system. Kriging may fail."
         if self.UNBIAS:
-            b[:, n_withdrifts, 0] = 1.0
+            drift[:, i] = 1.0
+
+        return drift
+
+    def _exec_vector(self, a, bd, xy, xy_orig, mask, n_withdrifts, spec_drift_grids, return_variance=True):
+        """Solves the kriging system as a vectorized operation. This method
+        can take a lot of memory for large grids and/or large datasets."""
+
+        npt = bd.shape[0]
+        n = self.X_ADJUSTED.shape[0]
+        zero_index = None
+        zero_value = False
+
+        if np.any(np.absolute(bd) <= self.eps):
+            zero_value = True
+            zero_index = np.where(np.absolute(bd) <= self.eps)
+
+        if self.UNBIAS:
+            b = np.zeros((npt, n_withdrifts+1, 1))
+        else:
+            b = np.zeros((npt, n_withdrifts, 1))
+        b[:, :n, 0] = - self.variogram_function(self.variogram_model_parameters, bd)
+        if zero_value:
+            b[zero_index[0], zero_index[1], 0] = 0.0
+
+        b[:, n:, 0] = self._get_drift_rows(xy, xy_orig, n_withdrifts, spec_drift_grids)
 
-        if (~mask).any():
+        if mask.any():
             mask_b = np.repeat(mask[:, np.newaxis, np.newaxis], n_withdrifts+1, axis=1)
             b = np.ma.array(b, mask=mask_b)
 
+        if not return_variance:
+            zvalues = np.dot(np.asarray(b)[:, :, 0], self._get_dual_weights())
+            return zvalues, None
+
         if self.UNBIAS:
-            x = np.dot(a_inv, b.reshape((npt, n_withdrifts+1)).T).reshape((1, n_withdrifts+1, npt)).T
+            x = self._solve_kriging_system(b.reshape((npt, n_withdrifts+1)).T).reshape((1, n_withdrifts+1, npt)).T
         else:
-            x = np.dot(a_inv, b.reshape((npt, n_withdrifts)).T).reshape((1, n_withdrifts, npt)).T
+            x = self._solve_kriging_system(b.reshape((npt, n_withdrifts)).T).reshape((1, n_withdrifts, npt)).T
         zvalues = np.sum(x[:, :n, 0] * self.Z, axis=1)
         sigmasq = np.sum(x[:, :, 0] * -b[:, :, 0], axis=1)
 
         return zvalues, sigmasq
 
-    def _exec_loop(self, a, bd_all, xy, xy_orig, mask, n_withdrifts, spec_drift_grids):
+    def _exec_loop(self, a, bd_all, xy, xy_orig, mask, n_withdrifts, spec_drift_grids, return_variance=True):
         """Solves the kriging system by looping over all specified points.
         Less memory-intensive, but involves a Python-level loop."""
 
@@ -722,8 +954,9 @@ class UniversalKriging:
         n = self.X_ADJUSTED.shape[0]
         zvalues = np.zeros(npt)
         sigmasq = np.zeros(npt)
-
-        a_inv = scipy.linalg.inv(a)
+        if not return_variance:
+            w = self._get_dual_weights()
+        drift = self._get_drift_rows(xy, xy_orig, n_withdrifts, spec_drift_grids)
 
         for j in np.nonzero(~mask)[0]:   # Note that this is the same thing as range(npt) if mask is not defined,
             bd = bd_all[j]               # otherwise it takes the non-masked elements.
@@ -742,43 +975,103 @@ class UniversalKriging:
             if zero_value:
                 b[zero_index[0], 0] = 0.0
 
-            i = n
-            if self.regional_linear_drift:
-                b[i, 0] = xy[j, 0]
-                i += 1
-                b[i, 0] = xy[j, 1]
-                i += 1
-            if self.point_log_drift:
-                for well_no in range(self.point_log_array.shape[0]):
-                    log_dist = np.log(np.sqrt((xy[j, 0] - self.point_log_array[well_no, 0])**2 +
-                                              (xy[j, 1] - self.point_log_array[well_no, 1])**2))
-                    if np.any(np.isinf(log_dist)):
-                        log_dist[np.isinf(log_dist)] = -100.0
-                    b[i, 0] = - self.point_log_array[well_no, 2] * log_dist
-                    i += 1
-            if self.external_Z_drift:
-                b[i, 0] = self._calculate_data_point_zscalars(xy_orig[j, 0], xy_orig[j, 1], type_='scalar')
-                i += 1
-            if self.specified_drift:
-                for spec_vals in spec_drift_grids:
-                    b[i, 0] = spec_vals.flatten()[i]
-                    i += 1
-            if self.functional_drift:
-                for func in self.functional_drift_terms:
-                    b[i, 0] = func(xy[j, 0], xy[j, 1])
-                    i += 1
-            if i != n_withdrifts:
-                print "WARNING: Error in setting up kriging system. Kriging may fail."
-            if self.UNBIAS:
-                b[n_withdrifts, 0] = 1.0
+            b[n:, 0] = drift[j]
 
-            x = np.dot(a_inv, b)
+            if not return_variance:
+                zvalues[j] = np.sum(b[:, 0] * w)
+                continue
+
+            x = self._solve_kriging_system(b)
             zvalues[j] = np.sum(x[:n, 0] * self.Z)
             sigmasq[j] = np.sum(x[:, 0] * -b[:, 0])
 
         return zvalues, sigmasq
 
-    def execute(self, style, xpoints, ypoints, mask=None, backend='vectorized', specified_drift_arrays=None):
+    def _get_drift_residuals(self, f):
+        """Normalizes the drift columns f (dim k x n_drift, or dim npt x k x n_drift for a
+        stack of windows) of the selected data points and orthogonalizes them in turn
+        (Gram-Schmidt), the unbiasedness term first. Returns the norm of what is left of
+        each column, in the original column order; a column with no more than DRIFT_TOL
+        left depends on the previous ones and is not added to the basis."""
+
+        order = np.arange(f.shape[-1])
+        if self.UNBIAS:
+            order = np.roll(order, 1)
+        norms = np.sqrt(np.sum(f**2, axis=-2))
+        norms[norms == 0.0] = 1.0
+        f = f / norms[..., np.newaxis, :]
+
+        residuals = np.zeros(f.shape[:-2] + f.shape[-1:])
+        basis = []
+        for j in order:
+            v = np.copy(f[..., j])
+            for q in basis:
+                v -= np.sum(q * v, axis=-1)[..., np.newaxis] * q
+            residuals[..., j] = np.sqrt(np.sum(v**2, axis=-1))
+            keep = residuals[..., j] > self.DRIFT_TOL
+            basis.append(np.where(keep[..., np.newaxis], v / np.where(keep, residuals[..., j], 1.0)[..., np.newaxis],
+                                  0.0))
+
+        return residuals
+
+    def _get_independent_drift(self, f):
+        """Returns the indices of the drift columns f of the selected data points that are
+        linearly independent, i.e. the drift terms that these points can determine."""
+
+        return np.nonzero(self._get_drift_residuals(f) > self.DRIFT_TOL)[0]
+
+    def _get_deficient_windows(self, a_all, bd_idx, n_drift):
+        """Flags the points whose closest data points (bd_idx) cannot determine all of the
+        drift terms, by the same criterion as _get_independent_drift. Vectorized over
+        blocks of points."""
+
+        n = self.X_ADJUSTED.shape[0]
+        npt, k = bd_idx.shape
+        if k < n_drift:
+            return np.ones(npt, dtype=bool)
+
+        deficient = np.zeros(npt, dtype=bool)
+        block = 10000
+        for start in range(0, npt, block):
+            residuals = self._get_drift_residuals(a_all[bd_idx[start:start + block], n:n + n_drift])
+            deficient[start:start + block] = ~np.all(residuals > self.DRIFT_TOL, axis=1)
+
+        return deficient
+
+    def _exec_loop_moving_window(self, a_all, bd_all, mask, bd_idx, drift):
+        """Solves the kriging system by looping over all specified points, using only
+        the n closest data points of each (indices in bd_idx) and the drift terms
+        (drift rows in drift) that these points can determine.
+        Less memory-intensive, but involves a Python-level loop."""
+
+        npt = bd_all.shape[0]
+        n_max = self.X_ADJUSTED.shape[0]
+        n = bd_idx.shape[1]
+        zvalues = np.zeros(npt)
+        sigmasq = np.zeros(npt)
+
+        for i in np.nonzero(~mask)[0]:   # Note that this is the same thing as range(npt) if mask is not defined,
+            b_selector = bd_idx[i]       # otherwise it takes the non-masked elements.
+            bd = bd_all[i]
+
+            keep = self._get_independent_drift(a_all[b_selector, n_max:])
+            a_selector = np.concatenate((b_selector, n_max + keep))
+            a = a_all[a_selector[:, None], a_selector]
+
+            b = np.zeros(n + keep.size)
+            b[:n] = - self.variogram_function(self.variogram_model_parameters, bd)
+            b[:n][np.absolute(bd) <= self.eps] = 0.0
+            b[n:] = drift[i, keep]
+
+            x = scipy.linalg.solve(a, b)
+
+            zvalues[i] = x[:n].dot(self.Z[b_selector])
+            sigmasq[i] = - x.dot(b)
+
+        return zvalues, sigmasq
+
+    def execute(self, style, xpoints, ypoints, mask=None, backend='vectorized', specified_drift_arrays=None,
+                return_variance=True, max_memory=None, n_closest_points=None, n_jobs=1):
         """Calculates a kriged grid and the associated variance. Includes drift terms.
 
         This is now the method that performs the main kriging calculation. Note that currently
@@ -826,7 +1119,16 @@ class UniversalKriging:
                 significant amount of memory for large grids and/or large datasets.
                 Specifying 'loop' will loop through each point at which the kriging system
                 is to be solved. This approach is slower but also less memory-intensive.
-                Default is 'vectorized'. Note that Cython backend is not supported for UK.
+                Specifying 'C' will utilize a loop in Cython.
+                Specifying 'auto' will pick the fastest of these that fits in memory (max_memory,
+                or half of the available memory if not given) from a rough estimate of the cost,
+                and store the choice and the estimates in backend_choice.
+                Default is 'vectorized'.
+            n_closest_points (int, optional): For kriging with a moving window, specifies the number
+                of nearby points to use in the calculation. The system of each point is assembled from
+                the kriging matrix rows of these points and their drift terms. Drift terms that the
+                selected points cannot determine (e.g., a linear drift over collinear points) are
+                dropped from that point's system. Supported by the 'loop' and 'C' backends.
             specified_drift_arrays (list of array-like objects, optional): Specifies the drift
                 values at the points at which the kriging system is to be evaluated. Required if
                 'specified' drift provided in the list of drift terms when instantiating the
@@ -836,6 +1138,15 @@ class UniversalKriging:
                 i.e., the arrays either must be dim MxN, where M is the number of y grid-points
                 and N is the number of x grid-points, or dim M, where M is the number of points
                 at which to evaluate the kriging system.
+            return_variance (bool, optional): If False, only the kriged values are calculated
+                and returned, using dual kriging: the kriging system is solved once for the data
+                values, so that each point only costs a dot product instead of a solve.
+                Default is True.
+            max_memory (float, optional): For the vectorized and C backends, the approximate memory (in MB)
+                that the temporary arrays may take. The points are then kriged in blocks of the
+                largest size that fits. Default is None, which kriges all the points at once.
+            n_jobs (int, optional): Number of threads over which the points are spread with the
+                'C' backend (requires the extension to be built with OpenMP). Default is 1.
         Outputs:
             zvalues (numpy array, dim MxN or dim Nx1): Z-values of specified grid or at the
                 specified set of points. If style was specified as 'masked', zvalues will
@@ -843,6 +1154,7 @@ class UniversalKriging:
             sigmasq (numpy array, dim MxN or dim Nx1): Variance at specified grid points or
                 at the specified set of points. If style was specified as 'masked', sigmasq
                 will be a numpy masked array.
+                Only returned if return_variance is True.
         """
 
         if self.verbose:
@@ -852,22 +1164,12 @@ class UniversalKriging:
             raise ValueError("style argument must be 'grid', 'points', or 'masked'")
 
         n = self.X_ADJUSTED.shape[0]
-        n_withdrifts = n
+        n_withdrifts = self._get_n_withdrifts()
         xpts = np.atleast_1d(np.squeeze(np.array(xpoints, copy=True)))
         ypts = np.atleast_1d(np.squeeze(np.array(ypoints, copy=True)))
         nx = xpts.size
         ny = ypts.size
-        if self.regional_linear_drift:
-            n_withdrifts += 2
-        if self.point_log_drift:
-            n_withdrifts += self.point_log_array.shape[0]
-        if self.external_Z_drift:
-            n_withdrifts += 1
-        if self.specified_drift:
-            n_withdrifts += len(self.specified_drift_data_arrays)
-        if self.functional_drift:
-            n_withdrifts += len(self.functional_drift_terms)
-        a = self._get_kriging_matrix(n, n_withdrifts)
+        a = self._get_cached_kriging_matrix(n, n_withdrifts)
 
         if style in ['grid', 'masked']:
             if style == 'masked':
@@ -936,16 +1238,98 @@ class UniversalKriging:
         if style != 'masked':
             mask = np.zeros(npt, dtype='bool')
 
-        bd = cdist(xy_points,  xy_data, 'euclidean')
-        if backend == 'vectorized':
-            zvalues, sigmasq = self._exec_vector(a, bd, xy_points, xy_points_original,
-                                                 mask, n_withdrifts, spec_drift_grids)
+        if backend == 'auto':
+            backends = ['vectorized', 'loop'] if n_closest_points is None else ['loop']
+            try:
+                from .lib.cuk import _c_exec_loop, _c_exec_loop_moving_window
+                backends.append('C')
+            except ImportError:
+                pass
+            self.backend_choice = core._choose_backend(backends, a.shape[0], np.sum(~mask), n_closest_points,
+                                                       max_memory, return_variance, n_jobs)
+            backend = self.backend_choice['backend']
+            max_memory = self.backend_choice['max_memory']
+            if self.verbose:
+                print "Backend chosen automatically:", backend, "\n"
+
+        c_pars = None
+        if backend == 'C':
+            try:
+                from .lib.cuk import _c_exec_loop, _c_exec_loop_moving_window
+            except ImportError:
+                print('Warning: failed to load Cython extensions.\n'\
+                      '   See https://github.com/bsmurphy/PyKrige/issues/8 \n'\
+                      '   Falling back to a pure python backend...')
+                backend = 'loop'
+            except:
+                raise RuntimeError("Unknown error in trying to load Cython extension.")
+
+            c_pars = {key: getattr(self, key) for key in ['Z', 'eps', 'variogram_model_parameters',
+                                                          'variogram_function']}
+
+        if n_closest_points is not None:
+            from scipy.spatial import cKDTree
+            tree = cKDTree(xy_data)
+            bd, bd_idx = tree.query(xy_points, k=n_closest_points, eps=0.0)
+            # a single neighbor comes back as 1D arrays
+            bd = bd.reshape((npt, n_closest_points))
+            bd_idx = bd_idx.reshape((npt, n_closest_points))
+            drift = self._get_drift_rows(xy_points, xy_points_original, n_withdrifts, spec_drift_grids)
+
+            if backend == 'loop':
+                zvalues, sigmasq = self._exec_loop_moving_window(a, bd, mask, bd_idx, drift)
+            elif backend == 'C':
+                # the compiled loop keeps all of the drift terms, so the points whose
+                # neighbourhood cannot determine them are left to the Python loop
+                deficient = self._get_deficient_windows(a, bd_idx, drift.shape[1]) & ~mask
+                zvalues, sigmasq = _c_exec_loop_moving_window(a, bd, (mask | deficient).astype('int8'), bd_idx, n,
+                                                              drift, c_pars, n_jobs)
+                if deficient.any():
+                    if self.verbose:
+                        print "Dropping drift terms at", np.sum(deficient), "points.\n"
+                    z, ss = self._exec_loop_moving_window(a, bd, ~deficient, bd_idx, drift)
+                    zvalues[deficient] = z[deficient]
+                    sigmasq[deficient] = ss[deficient]
+            else:
+                raise ValueError('Specified backend {} for a moving window is not supported.'.format(backend))
+        elif backend == 'vectorized':
+            zvalues = np.zeros(npt)
+            sigmasq = np.zeros(npt)
+            spec_flat = [np.ravel(spec) for spec in spec_drift_grids]
+            for idx in core._point_chunks(mask, a.shape[0], max_memory):
+                bd = cdist(xy_points[idx], xy_data, 'euclidean')
+                z, ss = self._exec_vector(a, bd, xy_points[idx], xy_points_original[idx], mask[idx], n_withdrifts,
+                                          [spec[idx] for spec in spec_flat], return_variance)
+                zvalues[idx] = z
+                if return_variance:
+                    sigmasq[idx] = ss
         elif backend == 'loop':
+            bd = cdist(xy_points,  xy_data, 'euclidean')
             zvalues, sigmasq = self._exec_loop(a, bd, xy_points, xy_points_original,
-                                               mask, n_withdrifts, spec_drift_grids)
+                                               mask, n_withdrifts, spec_drift_grids, return_variance)
+        elif backend == 'C':
+            zvalues = np.zeros(npt)
+            sigmasq = np.zeros(npt)
+            spec_flat = [np.ravel(spec) for spec in spec_drift_grids]
+            c_pars['lu'] = self._get_cached_kriging_matrix_factor()
+            for idx in core._point_chunks(mask, a.shape[0], max_memory):
+                bd = cdist(xy_points[idx], xy_data, 'euclidean')
+                drift = self._get_drift_rows(xy_points[idx], xy_points_original[idx], n_withdrifts,
+                                             [spec[idx] for spec in spec_flat])
+                z, ss = _c_exec_loop(a, bd, np.zeros(idx.size, dtype='int8'), n, drift, c_pars, n_jobs,
+                                     return_variance)
+                zvalues[idx] = z
+                sigmasq[idx] = ss
         else:
             raise ValueError('Specified backend {} is not supported for 2D universal kriging.'.format(backend))
 
+        if not return_variance:
+            if style == 'masked':
+                zvalues = np.ma.array(zvalues, mask=mask)
+            if style in ['masked', 'grid']:
+                zvalues = zvalues.reshape((ny, nx))
+            return zvalues
+
         if style == 'masked':
             zvalues = np.ma.array(zvalues, mask=mask)
             sigmasq = np.ma.array(sigmasq, mask=mask)
@@ -65,6 +65,22 @@ class UniversalKriging3D:
             variogram_parameters will be passed to the function as the first argument.
         nlags (int, optional): Number of averaging bins for the semivariogram.
             Default is 6.
+        lag_bins (string or array-like, optional): Specifies the semivariogram lag bins.
+            'linear' gives nlags bins of equal width and 'geometric' gives nlags bins
+            whose widths grow by a constant factor; an array of bin edges may also be
+            given, in which case nlags is ignored. Default is None, which also gives
+            bins of equal width.
+        max_lag (float, optional): Largest separation distance of the data pairs used
+            to calculate the semivariogram. Only the pairs within max_lag are looked up
+            (with a KD-tree), which saves time and memory for large data sets.
+            Default is None, which uses all of the data pairs.
+        sample_pairs (int, optional): If specified, the semivariogram is estimated from
+            a random sample of the data pairs instead of all of them, for very large
+            data sets. Pairs are drawn until each lag bin holds about sample_pairs/nlags
+            of them (or for at most ten rounds of sample_pairs draws). Default is None.
+        random_state (int or numpy RandomState, optional): Seed or random number
+            generator used with sample_pairs, so that the sample can be reproduced.
+            Default is None.
         weight (boolean, optional): Flag that specifies if semivariance at smaller lags
             should be weighted more heavily when automatically calculating variogram model.
             True indicates that weights will be applied. Default is False.
@@ -130,6 +146,22 @@ class UniversalKriging3D:
                     more information.
                 nlags (int, optional): Number of averaging bins for the semivariogram.
                     Defualt is 6.
+                lag_bins (string or array-like, optional): Specifies the semivariogram lag bins.
+                    'linear' gives nlags bins of equal width and 'geometric' gives nlags bins
+                    whose widths grow by a constant factor; an array of bin edges may also be
+                    given, in which case nlags is ignored. Default is None, which also gives
+                    bins of equal width.
+                max_lag (float, optional): Largest separation distance of the data pairs used
+                    to calculate the semivariogram. Only the pairs within max_lag are looked up
+                    (with a KD-tree), which saves time and memory for large data sets.
+                    Default is None, which uses all of the data pairs.
+                sample_pairs (int, optional): If specified, the semivariogram is estimated from
+                    a random sample of the data pairs instead of all of them, for very large
+                    data sets. Pairs are drawn until each lag bin holds about sample_pairs/nlags
+                    of them (or for at most ten rounds of sample_pairs draws). Default is None.
+                random_state (int or numpy RandomState, optional): Seed or random number
+                    generator used with sample_pairs, so that the sample can be reproduced.
+                    Default is None.
                 weight (boolean, optional): Flag that specifies if semivariance at smaller lags
                     should be weighted more heavily when automatically calculating variogram model.
                     True indicates that weights will be applied. Default is False.
@@ -155,6 +187,13 @@ class UniversalKriging3D:
             the variogram fit. NOTE that ideally Q1 is close to zero,
             Q2 is close to 1, and cR is as small as possible.
 
+        cross_validate(): Returns the leave-one-out cross-validation residuals
+            and kriging variances at the data points.
+
+        clear_kriging_cache(): Clears the kriging matrix, its factorization and the dual weights,
+            which are cached (as kriging_matrix, kriging_matrix_factor and dual_weights) and reused
+            by execute until the variogram model is updated or the data coordinates change.
+
         execute(style, xpoints, ypoints, mask=None): Calculates a kriged grid.
             Inputs:
                 style (string): Specifies how to treat input kriging points.
@@ -189,6 +228,10 @@ class UniversalKriging3D:
                     significant amount of memory for large grids and/or large datasets.
                     Specifying 'loop' will loop through each point at which the kriging system
                     is to be solved. This approach is slower but also less memory-intensive.
+                    Specifying 'C' will utilize a loop in Cython.
+                    Specifying 'auto' will pick the fastest of these that fits in memory (max_memory,
+                    or half of the available memory if not given) from a rough estimate of the cost,
+                    and store the choice and the estimates in backend_choice.
                     Default is 'vectorized'.
                 specified_drift_arrays (list of array-like objects, optional): Specifies the drift
                     values at the points at which the kriging system is to be evaluated. Required if
@@ -199,6 +242,15 @@ class UniversalKriging3D:
                     i.e., the arrays either must be dim LxMxN, where L is the number of z grid-points,
                     M is the number of y grid-points, and N is the number of x grid-points,
                     or dim N, where N is the number of points at which to evaluate the kriging system.
+                return_variance (bool, optional): If False, only the kriged values are calculated
+                    and returned, using dual kriging: the kriging system is solved once for the data
+                    values, so that each point only costs a dot product instead of a solve.
+                    Default is True.
+                max_memory (float, optional): For the vectorized and C backends, the approximate memory (in MB)
+                    that the temporary arrays may take. The points are then kriged in blocks of the
+                    largest size that fits. Default is None, which kriges all the points at once.
+                n_jobs (int, optional): Number of threads over which the points are spread with the
+                    'C' backend (requires the extension to be built with OpenMP). Default is 1.
             Outputs:
                 kvalues (numpy array, dim LxMxN or dim Nx1): Interpolated values of specified grid
                     or at the specified set of points. If style was specified as 'masked',
@@ -206,6 +258,7 @@ class UniversalKriging3D:
                 sigmasq (numpy array, dim LxMxN or dim Nx1): Variance at specified grid points or
                     at the specified set of points. If style was specified as 'masked', sigmasq
                     will be a numpy masked array.
+                    Only returned if return_variance is True.
 
     References:
         P.K. Kitanidis, Introduction to Geostatistcs: Applications in Hydrogeology,
@@ -225,7 +278,8 @@ class UniversalKriging3D:
                  variogram_function=None, nlags=6, weight=False, anisotropy_scaling_y=1.0,
                  anisotropy_scaling_z=1.0, anisotropy_angle_x=0.0, anisotropy_angle_y=0.0,
                  anisotropy_angle_z=0.0, drift_terms=None, specified_drift=None,
-                 functional_drift=None, verbose=False, enable_plotting=False):
+                 functional_drift=None, verbose=False, enable_plotting=False, lag_bins=None,
+                 max_lag=None, sample_pairs=None, random_state=None):
 
         # Deal with mutable default argument
         if drift_terms is None:
@@ -243,6 +297,7 @@ class UniversalKriging3D:
         self.Z_ORIG = np.atleast_1d(np.squeeze(np.array(z, copy=True)))
         self.VALUES = np.atleast_1d(np.squeeze(np.array(val, copy=True)))
 
+        self.backend_choice = None
         self.verbose = verbose
         self.enable_plotting = enable_plotting
         if self.enable_plotting and self.verbose:
@@ -264,6 +319,7 @@ class UniversalKriging3D:
                                           self.anisotropy_scaling_z, self.anisotropy_angle_x, self.anisotropy_angle_y,
                                           self.anisotropy_angle_z)
 
+        self.clear_kriging_cache()
         self.variogram_model = variogram_model
         if self.variogram_model not in self.variogram_dict.keys() and self.variogram_model != 'custom':
             raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
@@ -276,10 +332,11 @@ class UniversalKriging3D:
             self.variogram_function = self.variogram_dict[self.variogram_model]
         if self.verbose:
             print "Initializing variogram model..."
-        self.lags, self.semivariance, self.variogram_model_parameters = \
+        self.lags, self.semivariance, self.semivariance_error, self.variogram_model_parameters = \
             core.initialize_variogram_model_3d(self.X_ADJUSTED, self.Y_ADJUSTED, self.Z_ADJUSTED, self.VALUES,
                                                self.variogram_model, variogram_parameters, self.variogram_function,
-                                               nlags, weight)
+                                               nlags, weight, lag_bins=lag_bins, max_lag=max_lag,
+                                               sample_pairs=sample_pairs, random_state=random_state)
         if self.verbose:
             if self.variogram_model == 'linear':
                 print "Using '%s' Variogram Model" % 'linear'
@@ -357,7 +414,8 @@ class UniversalKriging3D:
 
     def update_variogram_model(self, variogram_model, variogram_parameters=None, variogram_function=None,
                                nlags=6, weight=False, anisotropy_scaling_y=1.0, anisotropy_scaling_z=1.0,
-                               anisotropy_angle_x=0.0, anisotropy_angle_y=0.0, anisotropy_angle_z=0.0):
+                               anisotropy_angle_x=0.0, anisotropy_angle_y=0.0, anisotropy_angle_z=0.0,
+                               lag_bins=None, max_lag=None, sample_pairs=None, random_state=None):
         """Allows user to update variogram type and/or variogram model parameters."""
 
         if anisotropy_scaling_y != self.anisotropy_scaling_y or anisotropy_scaling_z != self.anisotropy_scaling_z or \
@@ -376,6 +434,7 @@ class UniversalKriging3D:
                                               self.anisotropy_scaling_z, self.anisotropy_angle_x,
                                               self.anisotropy_angle_y, self.anisotropy_angle_z)
 
+        self.clear_kriging_cache()
         self.variogram_model = variogram_model
         if self.variogram_model not in self.variogram_dict.keys() and self.variogram_model != 'custom':
             raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
@@ -388,10 +447,11 @@ class UniversalKriging3D:
             self.variogram_function = self.variogram_dict[self.variogram_model]
         if self.verbose:
             print "Updating variogram mode..."
-        self.lags, self.semivariance, self.variogram_model_parameters = \
+        self.lags, self.semivariance, self.semivariance_error, self.variogram_model_parameters = \
             core.initialize_variogram_model_3d(self.X_ADJUSTED, self.Y_ADJUSTED, self.Z_ADJUSTED, self.VALUES,
                                                self.variogram_model, variogram_parameters, self.variogram_function,
-                                               nlags, weight)
+                                               nlags, weight, lag_bins=lag_bins, max_lag=max_lag,
+                                               sample_pairs=sample_pairs, random_state=random_state)
         if self.verbose:
             if self.variogram_model == 'linear':
                 print "Using '%s' Variogram Model" % 'linear'
@@ -463,6 +523,96 @@ class UniversalKriging3D:
         print "Q2 =", self.Q2
         print "cR =", self.cR
 
+    def cross_validate(self):
+        """Leave-one-out cross-validation of the kriging model. Each data point is
+        kriged from all of the other data points, for all of the points at once from
+        a single inversion of the kriging matrix (see core.leave_one_out).
+
+        Outputs:
+            residuals (numpy array, dim N): Data values minus their kriging estimates
+                from the other data points.
+            sigmasq (numpy array, dim N): Kriging variances at the data points.
+        """
+
+        n = self.X_ADJUSTED.shape[0]
+        n_withdrifts = self._get_n_withdrifts()
+        a = self._get_cached_kriging_matrix(n, n_withdrifts)
+
+        return core.leave_one_out(self._get_cached_kriging_matrix_factor(), self.VALUES)
+
+    def clear_kriging_cache(self):
+        """Clears the cached kriging matrix, its factorization and the dual weights.
+        These are otherwise assembled once and reused by every call to execute; they are
+        also cleared by update_variogram_model and rebuilt if the data coordinates change."""
+        self.kriging_matrix = None
+        self.kriging_matrix_factor = None
+        self.dual_weights = None
+        self._kriging_matrix_coords = None
+
+    def _get_n_withdrifts(self):
+        """Returns the number of data points plus the number of drift terms, i.e. the
+        size of the kriging matrix without its unbiasedness row."""
+
+        n_withdrifts = self.X_ADJUSTED.shape[0]
+        if self.regional_linear_drift:
+            n_withdrifts += 3
+        if self.specified_drift:
+            n_withdrifts += len(self.specified_drift_data_arrays)
+        if self.functional_drift:
+            n_withdrifts += len(self.functional_drift_terms)
+
+        return n_withdrifts
+
+    def _get_cached_kriging_matrix(self, n, n_withdrifts):
+        """Returns the kriging matrix, assembling it only if it is not cached."""
+
+        coords = (self.X_ADJUSTED, self.Y_ADJUSTED, self.Z_ADJUSTED)
+        if self.kriging_matrix is None or \
+                not all([np.array_equal(c, c_) for c, c_ in zip(coords, self._kriging_matrix_coords)]):
+            self.clear_kriging_cache()
+            self.kriging_matrix = self._get_kriging_matrix(n, n_withdrifts)
+            self._kriging_matrix_coords = tuple([np.copy(c) for c in coords])
+
+        return self.kriging_matrix
+
+    def _get_cached_kriging_matrix_factor(self):
+        """Returns the LU factorization of the cached kriging matrix, factoring it
+        only if it is not cached."""
+
+        if self.kriging_matrix_factor is None:
+            lu, piv = scipy.linalg.lu_factor(self.kriging_matrix)
+            if np.any(np.diag(lu) == 0.0):
+                raise np.linalg.LinAlgError("Singular matrix")
+            self.kriging_matrix_factor = (lu, piv)
+
+        return self.kriging_matrix_factor
+
+    def _solve_kriging_system(self, b):
+        """Solves the kriging system for the right hand sides in the columns of b,
+        all at once, with the cached factorization of the kriging matrix. LAPACK is
+        called directly, since scipy's wrappers cost more than the solve itself
+        for one right hand side of a small system."""
+
+        lu, piv = self._get_cached_kriging_matrix_factor()
+        x, info = scipy.linalg.lapack.dgetrs(lu, piv, np.asarray(b))
+
+        return x
+
+    def _get_dual_weights(self):
+        """Solves the kriging system once for the data values (with zeros in the
+        remaining rows). The kriged value at a point is then simply the dot product
+        of these dual weights with the right hand side of the point. The weights are
+        cached with the factorization, so that the points of every block and every
+        call to execute share the one solve."""
+
+        if self.dual_weights is None:
+            n = self.X_ADJUSTED.shape[0]
+            rhs = np.zeros((self.kriging_matrix.shape[0], 1))
+            rhs[:n, 0] = self.VALUES
+            self.dual_weights = self._solve_kriging_system(rhs)[:, 0]
+
+        return self.dual_weights
+
     def _get_kriging_matrix(self, n, n_withdrifts):
         """Assembles the kriging matrix."""
 
@@ -506,7 +656,42 @@ class UniversalKriging3D:
 
         return a
 
-    def _exec_vector(self, a, bd, xyz, mask, n_withdrifts, spec_drift_grids):
+    def _get_drift_rows(self, xyz, n_withdrifts, spec_drift_grids):
+        """Returns the drift terms (and the unbiasedness term) of the right hand sides
+        at the specified points, i.e. the rows of the kriging system that follow
+        the variogram values (dim npt x number of drift terms [+1])."""
+
+        npt = xyz.shape[0]
+        n = self.X_ADJUSTED.shape[0]
+        if self.UNBIAS:
+            drift = np.zeros((npt, n_withdrifts - n + 1))
+        else:
+            drift = np.zeros((npt, n_withdrifts - n))
+
+        i = 0
+        if self.regional_linear_drift:
+            drift[:, i] = xyz[:, 2]
+            i += 1
+            drift[:, i] = xyz[:, 1]
+            i += 1
+            drift[:, i] = xyz[:, 0]
+            i += 1
+        if self.specified_drift:
+            for spec_vals in spec_drift_grids:
+                drift[:, i] = spec_vals.flatten()
+                i += 1
+        if self.functional_drift:
+            for func in self.functional_drift_terms:
+                drift[:, i] = func(xyz[:, 2], xyz[:, 1], xyz[:, 0])
+                i += 1
+        if i != n_withdrifts - n:
+            print "WARNING: Error in setting up kriging system. Kriging may fail."
+        if self.UNBIAS:
+            drift[:, i] = 1.0
+
+        return drift
+
+    def _exec_vector(self, a, bd, xyz, mask, n_withdrifts, spec_drift_grids, return_variance=True):
         """Solves the kriging system as a vectorized operation. This method
         can take a lot of memory for large grids and/or large datasets."""
 
@@ -515,8 +700,6 @@ class UniversalKriging3D:
         zero_index = None
         zero_value = False
 
-        a_inv = scipy.linalg.inv(a)
-
         if np.any(np.absolute(bd) <= self.eps):
             zero_value = True
             zero_index = np.where(np.absolute(bd) <= self.eps)
@@ -529,41 +712,26 @@ class UniversalKriging3D:
         if zero_value:
             b[zero_index[0], zero_index[1], 0] = 0.0
 
-        i = n
-        if self.regional_linear_drift:
-            b[:, i, 0] = xyz[:, 2]
-            i += 1
-            b[:, i, 0] = xyz[:, 1]
-            i += 1
-            b[:, i, 0] = xyz[:, 0]
-            i += 1
-        if self.specified_drift:
-            for spec_vals in spec_drift_grids:
-                b[:, i, 0] = spec_vals.flatten()
-                i += 1
-        if self.functional_drift:
-            for func in self.functional_drift_terms:
-                b[:, i, 0] = func(xyz[:, 2], xyz[:, 1], xyz[:, 0])
-                i += 1
-        if i != n_withdrifts:
-            print "WARNING: Error in setting up kriging system. Kriging may fail."
-        if self.UNBIAS:
-            b[:, n_withdrifts, 0] = 1.0
+        b[:, n:, 0] = self._get_drift_rows(xyz, n_withdrifts, spec_drift_grids)
 
-        if (~mask).any():
+        if mask.any():
             mask_b = np.repeat(mask[:, np.newaxis, np.newaxis], n_withdrifts+1, axis=1)
             b = np.ma.array(b, mask=mask_b)
 
+        if not return_variance:
+            kvalues = np.dot(np.asarray(b)[:, :, 0], self._get_dual_weights())
+            return kvalues, None
+
         if self.UNBIAS:
-            x = np.dot(a_inv, b.reshape((npt, n_withdrifts+1)).T).reshape((1, n_withdrifts+1, npt)).T
+            x = self._solve_kriging_system(b.reshape((npt, n_withdrifts+1)).T).reshape((1, n_withdrifts+1, npt)).T
         else:
-            x = np.dot(a_inv, b.reshape((npt, n_withdrifts)).T).reshape((1, n_withdrifts, npt)).T
+            x = self._solve_kriging_system(b.reshape((npt, n_withdrifts)).T).reshape((1, n_withdrifts, npt)).T
         kvalues = np.sum(x[:, :n, 0] * self.VALUES, axis=1)
         sigmasq = np.sum(x[:, :, 0] * -b[:, :, 0], axis=1)
 
         return kvalues, sigmasq
 
-    def _exec_loop(self, a, bd_all, xyz, mask, n_withdrifts, spec_drift_grids):
+    def _exec_loop(self, a, bd_all, xyz, mask, n_withdrifts, spec_drift_grids, return_variance=True):
         """Solves the kriging system by looping over all specified points.
         Less memory-intensive, but involves a Python-level loop."""
 
@@ -571,8 +739,9 @@ class UniversalKriging3D:
         n = self.X_ADJUSTED.shape[0]
         kvalues = np.zeros(npt)
         sigmasq = np.zeros(npt)
-
-        a_inv = scipy.linalg.inv(a)
+        if not return_variance:
+            w = self._get_dual_weights()
+        drift = self._get_drift_rows(xyz, n_withdrifts, spec_drift_grids)
 
         for j in np.nonzero(~mask)[0]:   # Note that this is the same thing as range(npt) if mask is not defined,
             bd = bd_all[j]               # otherwise it takes the non-masked elements.
@@ -591,34 +760,20 @@ class UniversalKriging3D:
             if zero_value:
                 b[zero_index[0], 0] = 0.0
 
-            i = n
-            if self.regional_linear_drift:
-                b[i, 0] = xyz[j, 2]
-                i += 1
-                b[i, 0] = xyz[j, 1]
-                i += 1
-                b[i, 0] = xyz[j, 0]
-                i += 1
-            if self.specified_drift:
-                for spec_vals in spec_drift_grids:
-                    b[i, 0] = spec_vals.flatten()[i]
-                    i += 1
-            if self.functional_drift:
-                for func in self.functional_drift_terms:
-                    b[i, 0] = func(xyz[j, 2], xyz[j, 1], xyz[j, 0])
-                    i += 1
-            if i != n_withdrifts:
-                print "WARNING: Error in setting up kriging system. Kriging may fail."
-            if self.UNBIAS:
-                b[n_withdrifts, 0] = 1.0
+            b[n:, 0] = drift[j]
+
+            if not return_variance:
+                kvalues[j] = np.sum(b[:, 0] * w)
+                continue
 
-            x = np.dot(a_inv, b)
+            x = self._solve_kriging_system(b)
             kvalues[j] = np.sum(x[:n, 0] * self.VALUES)
             sigmasq[j] = np.sum(x[:, 0] * -b[:, 0])
 
         return kvalues, sigmasq
 
-    def execute(self, style, xpoints, ypoints, zpoints, mask=None, backend='vectorized', specified_drift_arrays=None):
+    def execute(self, style, xpoints, ypoints, zpoints, mask=None, backend='vectorized', specified_drift_arrays=None,
+                return_variance=True, max_memory=None, n_jobs=1):
         """Calculates a kriged grid and the associated variance.
 
         This is now the method that performs the main kriging calculation. Note that currently
@@ -671,6 +826,10 @@ class UniversalKriging3D:
                 significant amount of memory for large grids and/or large datasets.
                 Specifying 'loop' will loop through each point at which the kriging system
                 is to be solved. This approach is slower but also less memory-intensive.
+                Specifying 'C' will utilize a loop in Cython.
+                Specifying 'auto' will pick the fastest of these that fits in memory (max_memory,
+                or half of the available memory if not given) from a rough estimate of the cost,
+                and store the choice and the estimates in backend_choice.
                 Default is 'vectorized'.
             specified_drift_arrays (list of array-like objects, optional): Specifies the drift
                 values at the points at which the kriging system is to be evaluated. Required if
@@ -681,6 +840,15 @@ class UniversalKriging3D:
                 i.e., the arrays either must be dim LxMxN, where L is the number of z grid-points,
                 M is the number of y grid-points, and N is the number of x grid-points,
                 or dim N, where N is the number of points at which to evaluate the kriging system.
+            return_variance (bool, optional): If False, only the kriged values are calculated
+                and returned, using dual kriging: the kriging system is solved once for the data
+                values, so that each point only costs a dot product instead of a solve.
+                Default is True.
+            max_memory (float, optional): For the vectorized and C backends, the approximate memory (in MB)
+                that the temporary arrays may take. The points are then kriged in blocks of the
+                largest size that fits. Default is None, which kriges all the points at once.
+            n_jobs (int, optional): Number of threads over which the points are spread with the
+                'C' backend (requires the extension to be built with OpenMP). Default is 1.
         Outputs:
             kvalues (numpy array, dim LxMxN or dim N): Interpolated values of specified grid
                 or at the specified set of points. If style was specified as 'masked',
@@ -688,6 +856,7 @@ class UniversalKriging3D:
             sigmasq (numpy array, dim LxMxN or dim N): Variance at specified grid points or
                 at the specified set of points. If style was specified as 'masked', sigmasq
                 will be a numpy masked array.
+                Only returned if return_variance is True.
         """
 
         if self.verbose:
@@ -700,17 +869,11 @@ class UniversalKriging3D:
         ypts = np.atleast_1d(np.squeeze(np.array(ypoints, copy=True)))
         zpts = np.atleast_1d(np.squeeze(np.array(zpoints, copy=True)))
         n = self.X_ADJUSTED.shape[0]
-        n_withdrifts = n
-        if self.regional_linear_drift:
-            n_withdrifts += 3
-        if self.specified_drift:
-            n_withdrifts += len(self.specified_drift_data_arrays)
-        if self.functional_drift:
-            n_withdrifts += len(self.functional_drift_terms)
+        n_withdrifts = self._get_n_withdrifts()
         nx = xpts.size
         ny = ypts.size
         nz = zpts.size
-        a = self._get_kriging_matrix(n, n_withdrifts)
+        a = self._get_cached_kriging_matrix(n, n_withdrifts)
 
         if style in ['grid', 'masked']:
             if style == 'masked':
@@ -783,15 +946,72 @@ class UniversalKriging3D:
         xyz_points = np.concatenate((zpts[:, np.newaxis], ypts[:, np.newaxis], xpts[:, np.newaxis]), axis=1)
         xyz_data = np.concatenate((self.Z_ADJUSTED[:, np.newaxis], self.Y_ADJUSTED[:, np.newaxis],
                                    self.X_ADJUSTED[:, np.newaxis]), axis=1)
-        bd = cdist(xyz_points, xyz_data, 'euclidean')
+
+        if backend == 'auto':
+            backends = ['vectorized', 'loop']
+            try:
+                from .lib.cuk import _c_exec_loop
+                backends.append('C')
+            except ImportError:
+                pass
+            self.backend_choice = core._choose_backend(backends, a.shape[0], np.sum(~mask), None,
+                                                       max_memory, return_variance, n_jobs)
+            backend = self.backend_choice['backend']
+            max_memory = self.backend_choice['max_memory']
+            if self.verbose:
+                print "Backend chosen automatically:", backend, "\n"
+
+        c_pars = None
+        if backend == 'C':
+            try:
+                from .lib.cuk import _c_exec_loop
+            except ImportError:
+                print('Warning: failed to load Cython extensions.\n'\
+                      '   See https://github.com/bsmurphy/PyKrige/issues/8 \n'\
+                      '   Falling back to a pure python backend...')
+                backend = 'loop'
+            except:
+                raise RuntimeError("Unknown error in trying to load Cython extension.")
+            c_pars = {'Z': self.VALUES, 'eps': self.eps, 'variogram_function': self.variogram_function,
+                      'variogram_model_parameters': self.variogram_model_parameters}
 
         if backend == 'vectorized':
-            kvalues, sigmasq = self._exec_vector(a, bd, xyz_points, mask, n_withdrifts, spec_drift_grids)
+            kvalues = np.zeros(npt)
+            sigmasq = np.zeros(npt)
+            spec_flat = [np.ravel(spec) for spec in spec_drift_grids]
+            for idx in core._point_chunks(mask, a.shape[0], max_memory):
+                bd = cdist(xyz_points[idx], xyz_data, 'euclidean')
+                k, ss = self._exec_vector(a, bd, xyz_points[idx], mask[idx], n_withdrifts,
+                                          [spec[idx] for spec in spec_flat], return_variance)
+                kvalues[idx] = k
+                if return_variance:
+                    sigmasq[idx] = ss
         elif backend == 'loop':
-            kvalues, sigmasq = self._exec_loop(a, bd, xyz_points, mask, n_withdrifts, spec_drift_grids)
+            bd = cdist(xyz_points, xyz_data, 'euclidean')
+            kvalues, sigmasq = self._exec_loop(a, bd, xyz_points, mask, n_withdrifts, spec_drift_grids, return_variance)
+        elif backend == 'C':
+            # the kernels of UniversalKriging only see distances and drift rows, so they serve 3D as well
+            kvalues = np.zeros(npt)
+            sigmasq = np.zeros(npt)
+            spec_flat = [np.ravel(spec) for spec in spec_drift_grids]
+            c_pars['lu'] = self._get_cached_kriging_matrix_factor()
+            for idx in core._point_chunks(mask, a.shape[0], max_memory):
+                bd = cdist(xyz_points[idx], xyz_data, 'euclidean')
+                drift = self._get_drift_rows(xyz_points[idx], n_withdrifts, [spec[idx] for spec in spec_flat])
+                k, ss = _c_exec_loop(a, bd, np.zeros(idx.size, dtype='int8'), n, drift, c_pars, n_jobs,
+                                     return_variance)
+                kvalues[idx] = k
+                sigmasq[idx] = ss
         else:
             raise ValueError('Specified backend {} is not supported for 3D ordinary kriging.'.format(backend))
 
+        if not return_variance:
+            if style == 'masked':
+                kvalues = np.ma.array(kvalues, mask=mask)
+            if style in ['masked', 'grid']:
+                kvalues = kvalues.reshape((nz, ny, nx))
+            return kvalues
+
         if style == 'masked':
             kvalues = np.ma.array(kvalues, mask=mask)
             sigmasq = np.ma.array(sigmasq, mask=mask)
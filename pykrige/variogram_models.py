@@ -21,6 +21,16 @@ Methods:
         params (array-like): [sill, range, nugget]
         dist (array-like): Points at which to calculate variogram model.
 
+    linear_variogram_model_jacobian(params, dist), power_variogram_model_jacobian(params, dist),
+    gaussian_variogram_model_jacobian(params, dist), exponential_variogram_model_jacobian(params, dist),
+    spherical_variogram_model_jacobian(params, dist):
+        Return the derivatives of the variogram models with respect to each of the params
+        at each point in dist, as an array of shape (len(dist), len(params)).
+
+    variogram_dict, jacobian_dict:
+        Map the names of the built-in variogram models to the model functions and to
+        their jacobians.
+
 References:
     P.K. Kitanidis, Introduction to Geostatistcs: Applications in Hydrogeology,
     (Cambridge University Press, 1997) 272 p.
@@ -54,3 +64,57 @@ def spherical_variogram_model(params, dist):
                         [lambda x: (float(params[0]) - float(params[2])) *
                                    ((3*x)/(2*float(params[1])) - (x**3)/(2*float(params[1])**3)) + float(params[2]),
                          float(params[0])])
+
+
+def linear_variogram_model_jacobian(params, dist):
+    dist = np.asarray(dist, dtype=float)
+    return np.column_stack((dist, np.ones(dist.shape)))
+
+
+def power_variogram_model_jacobian(params, dist):
+    dist = np.asarray(dist, dtype=float)
+    power = dist**float(params[1])
+    log_dist = np.log(np.where(dist > 0.0, dist, 1.0))
+    return np.column_stack((power, float(params[0])*power*log_dist, np.ones(dist.shape)))
+
+
+def gaussian_variogram_model_jacobian(params, dist):
+    dist = np.asarray(dist, dtype=float)
+    a = float(params[1])*4.0/7.0
+    e = np.exp(-dist**2/a**2)
+    return np.column_stack((1.0 - e,
+                            -(float(params[0]) - float(params[2]))*e*2.0*dist**2/a**3*4.0/7.0,
+                            e))
+
+
+def exponential_variogram_model_jacobian(params, dist):
+    dist = np.asarray(dist, dtype=float)
+    a = float(params[1])/3.0
+    e = np.exp(-dist/a)
+    return np.column_stack((1.0 - e,
+                            -(float(params[0]) - float(params[2]))*e*dist/a**2/3.0,
+                            e))
+
+
+def spherical_variogram_model_jacobian(params, dist):
+    dist = np.asarray(dist, dtype=float)
+    r = float(params[1])
+    inside = dist <= r
+    h = np.where(inside, dist/r, 1.0)
+    s = 1.5*h - 0.5*h**3
+    return np.column_stack((s,
+                            np.where(inside, (float(params[0]) - float(params[2]))*(-1.5*h + 1.5*h**3)/r, 0.0),
+                            1.0 - s))
+
+
+variogram_dict = {'linear': linear_variogram_model,
+                  'power': power_variogram_model,
+                  'gaussian': gaussian_variogram_model,
+                  'exponential': exponential_variogram_model,
+                  'spherical': spherical_variogram_model}
+
+jacobian_dict = {'linear': linear_variogram_model_jacobian,
+                 'power': power_variogram_model_jacobian,
+                 'gaussian': gaussian_variogram_model_jacobian,
+                 'exponential': exponential_variogram_model_jacobian,
+                 'spherical': spherical_variogram_model_jacobian}
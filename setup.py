@@ -14,13 +14,24 @@ if sys.platform != 'win32':
 else:
     compile_args = {}
 
+# The Cython kriging loops are spread over threads with OpenMP. Without it (e.g. with
+# Apple's clang) they still build, and simply run on one thread.
+if sys.platform != 'win32' and sys.platform != 'darwin':
+    openmp_args = dict(extra_compile_args=compile_args['extra_compile_args'] + ['-fopenmp'],
+                       extra_link_args=compile_args['extra_link_args'] + ['-fopenmp'])
+else:
+    openmp_args = compile_args
+
 
 ext_modules = [Extension("pykrige.lib.cok",
                          ["pykrige/lib/cok.pyx"],
-                                   **compile_args),
-               Extension("pykrige.lib.lapack",
-                         ["pykrige/lib/lapack.pyx"],
-                                   **compile_args),
+                                   **openmp_args),
+               Extension("pykrige.lib.csk",
+                         ["pykrige/lib/csk.pyx"],
+                                   **openmp_args),
+               Extension("pykrige.lib.cuk",
+                         ["pykrige/lib/cuk.pyx"],
+                                   **openmp_args),
                Extension("pykrige.lib.variogram_models",
                          ["pykrige/lib/variogram_models.pyx"],
                                    **compile_args),]